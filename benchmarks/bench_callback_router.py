@@ -0,0 +1,171 @@
+"""Разбор callback_data: старая цепочка if/elif со startswith против таблицы CallbackRouter.
+
+Сравниваются три формата: v0 (через "_", старая цепочка), v1 (маршрут и коды через ":")
+и компактный v2 (тег маршрута и doramas.id в base36). Отдельной строкой - v0 через таблицу
+против цепочки на тех же строках: такие кнопки еще остаются в чатах пользователей.
+Разбор v0 роутер запоминает, поэтому v0 меряется дважды: с кэшем (повторные нажатия тех же
+кнопок) и без него (первое нажатие каждой кнопки).
+
+Запуск: python benchmarks/bench_callback_router.py [итераций]
+Меряется только выбор обработчика и разбор аргументов, без самих обработчиков.
+"""
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('BOT_TOKEN', '0:benchmark')
+os.environ['DB_PATH'] = os.path.join(tempfile.mkdtemp(prefix='bench_router_'), 'unused.db')
+
+import bot  # noqa: E402
+
+CODE = "KoreanDrama2024x042"  # без "_" - иначе старая цепочка его не разберет
+ANCHOR = "KoreanDrama2024x031"
+for i, code in enumerate((CODE, ANCHOR)):
+    bot.database.add_dorama(code, f"Dorama {i}", "", 2024, "drama")
+
+# (v0, v1, v2) - смесь, близкая к реальным нажатиям
+ROUTES = [
+    ("watch", CODE, 7),
+    ("watch", CODE, 8),
+    ("dorama", CODE),
+    ("episodes", CODE, 2),
+    ("all_doramas", 3, ANCHOR, None),
+    ("send_all", CODE),
+    ("main_menu",),
+    ("check_subscription",),
+    ("admin_requests", 1),
+    ("admin_set_archive",),
+]
+V0 = [
+    f"watch_{CODE}_7", f"watch_{CODE}_8", f"dorama_{CODE}", f"episodes_{CODE}_2", f"all_doramas_3_n_{ANCHOR}",
+    f"send_all_{CODE}", "main_menu", "check_subscription", "admin_requests_1", "admin_set_archive",
+]
+V1 = [bot.CALLBACK_SEP.join((route, *('' if arg is None else str(arg) for arg in args))) for route, *args in ROUTES]
+V2 = [bot.callback_data(*route) for route in ROUTES]
+
+
+def legacy_chain(data):
+    """Копия порядка проверок старого handle_callback"""
+    if data == "main_menu":
+        return "main_menu", ()
+    elif data == "search":
+        return "search", ()
+    elif data.startswith("all_doramas_"):
+        parts = data.split("_")
+        page = max(0, int(parts[2]))
+        if len(parts) >= 5 and parts[3] == "n":
+            return "all_doramas", (page, parts[4], None)
+        if len(parts) >= 5 and parts[3] == "p":
+            return "all_doramas", (page, None, parts[4])
+        return "all_doramas", (0, None, None)
+    elif data.startswith("recent_doramas_"):
+        return "recent_doramas", (int(data.split("_")[2]),)
+    elif data.startswith("popular_doramas_"):
+        return "popular_doramas", (int(data.split("_")[2]),)
+    elif data == "random_dorama":
+        return "random_dorama", ()
+    elif data == "help":
+        return "help", ()
+    elif data.startswith("dorama_"):
+        return "dorama", (data.split("_")[1],)
+    elif data.startswith("send_all_"):
+        return "send_all", (data.split("_")[2],)
+    elif data.startswith("watch_"):
+        parts = data.split("_")
+        return "watch", (parts[1], int(parts[2]))
+    elif data.startswith("all_episodes_"):
+        return "all_episodes", (data.split("_")[2],)
+    elif data.startswith("episodes_"):
+        parts = data.split("_")
+        return "episodes", (parts[1], int(parts[2]))
+    elif data == "check_subscription":
+        return "check_subscription", ()
+    elif data == "admin_menu":
+        return "admin_menu", ()
+    elif data == "admin_stats":
+        return "admin_stats", ()
+    elif data.startswith("admin_doramas_"):
+        return "admin_doramas", ()
+    elif data.startswith("admin_delete_"):
+        return "admin_delete", ()
+    elif data.startswith("admin_confirm_delete_"):
+        return "admin_confirm_delete", (data.split("_")[3],)
+    elif data.startswith("admin_dorama_info_"):
+        return "admin_dorama_info", (data.split("_")[3],)
+    elif data == "admin_channels":
+        return "admin_channels", ()
+    elif data.startswith("admin_requests_"):
+        return "admin_requests", (int(data.split("_")[2]),)
+    elif data == "admin_settings":
+        return "admin_settings", ()
+    elif data == "admin_broadcast":
+        return "admin_broadcast", ()
+    elif data == "admin_set_welcome":
+        return "admin_set_welcome", ()
+    elif data == "admin_set_help":
+        return "admin_set_help", ()
+    elif data == "admin_set_archive":
+        return "admin_set_archive", ()
+    elif data == "current_page":
+        return "current_page", ()
+    return None, ()
+
+
+def resolve_cold(data):
+    """Разбор v0 без кэша - как при первом нажатии кнопки"""
+    bot.callbacks._legacy_cache.clear()
+    return bot.callbacks.resolve(data)
+
+
+def measure(func, inputs, iterations, batch=100):
+    inputs = inputs * batch
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        for data in inputs:
+            func(data)
+        samples.append((time.perf_counter() - started) * 1e9 / len(inputs))
+    return statistics.fmean(samples), statistics.median(samples)
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    for v0, v1, v2 in zip(V0, V1, V2):
+        names = {bot.callbacks.resolve(data)[0].name for data in (v0, v1, v2)}
+        assert names == {legacy_chain(v0)[0]}, (v0, v1, v2)
+
+    print(f"{len(ROUTES)} видов нажатий, {iterations} x 100 повторов, на одно нажатие:\n")
+    results = {
+        'цепочка if/elif (v0)': (V0, measure(legacy_chain, V0, iterations)),
+        'CallbackRouter (v2)': (V2, measure(bot.callbacks.resolve, V2, iterations)),
+        'CallbackRouter (v1)': (V1, measure(bot.callbacks.resolve, V1, iterations)),
+        'CallbackRouter (v0)': (V0, measure(bot.callbacks.resolve, V0, iterations)),
+        'CallbackRouter (v0, 1-е)': (V0, measure(resolve_cold, V0, iterations)),
+    }
+    chain = results['цепочка if/elif (v0)'][1][0]
+    for label, (inputs, (mean, p50)) in results.items():
+        size = max(len(data.encode()) for data in inputs)
+        print(f"{label:<24} mean {mean:7.0f} ns   p50 {p50:7.0f} ns   x{mean / chain:4.2f} к цепочке"
+              f"   макс. {size:2d} байт из 64")
+
+    # Старые кнопки v0 - те же строки, что разбирала цепочка. Первое нажатие кнопки медленнее
+    # цепочки: кроме поиска префикса таблица вызывает разбор хвоста и декодеры аргументов
+    # (в "1-е" входит и очистка кэша). Повторные нажатия берут готовый разбор из кэша
+    print()
+    for label in ('CallbackRouter (v0)', 'CallbackRouter (v0, 1-е)'):
+        legacy = results[label][1][0]
+        print(f"{label}: таблица {legacy:.0f} ns, цепочка {chain:.0f} ns,"
+              f" {'медленнее' if legacy > chain else 'быстрее'} в {max(legacy, chain) / min(legacy, chain):.2f} раза")
+
+    # Худший случай цепочки - маршрут в самом конце
+    tail = measure(legacy_chain, ["admin_set_archive"], iterations)[0]
+    routed = measure(bot.callbacks.resolve, ["admin_set_archive"], iterations)[0]
+    print(f"последняя ветка (admin_set_archive): цепочка {tail:.0f} ns, таблица {routed:.0f} ns")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""Сравнение: агрегаты по episodes на каждый запрос против колонок episode_count/total_views.
+
+Запуск: python benchmarks/bench_counters.py [размер каталога ...]
+По умолчанию - 10 000 и 50 000 дорам по 16 эпизодов.
+"""
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WORKDIR = tempfile.mkdtemp(prefix='bench_counters_')
+os.environ.setdefault('BOT_TOKEN', '0:benchmark')
+os.environ['DB_PATH'] = os.path.join(WORKDIR, 'unused.db')
+
+import bot  # noqa: E402
+
+EPISODES = 16
+
+QUERIES = {
+    'каталог (get_all_doramas)': (
+        '''
+        SELECT d.dorama_code, d.title, d.release_year, d.genre, d.rating,
+               COUNT(e.id) as episode_count
+        FROM doramas d
+        LEFT JOIN episodes e ON d.dorama_code = e.dorama_code
+        GROUP BY d.dorama_code
+        ORDER BY d.title
+        ''',
+        '''
+        SELECT dorama_code, title, release_year, genre, rating, episode_count
+        FROM doramas
+        ORDER BY title
+        ''',
+    ),
+    'популярные (get_admin_stats)': (
+        '''
+        SELECT d.title, d.dorama_code, SUM(e.views) as total_views
+        FROM doramas d
+        JOIN episodes e ON d.dorama_code = e.dorama_code
+        GROUP BY d.dorama_code
+        ORDER BY total_views DESC
+        LIMIT 5
+        ''',
+        '''
+        SELECT title, dorama_code, total_views
+        FROM doramas
+        WHERE episode_count > 0
+        ORDER BY total_views DESC
+        LIMIT 5
+        ''',
+    ),
+    'недавние (get_recent_doramas)': (
+        '''
+        SELECT d.dorama_code, d.title, d.release_year, d.genre, d.rating,
+               (SELECT COUNT(*) FROM episodes e WHERE e.dorama_code = d.dorama_code) as episode_count
+        FROM doramas d
+        ORDER BY d.created_date DESC, d.id DESC
+        LIMIT 10
+        ''',
+        '''
+        SELECT dorama_code, title, release_year, genre, rating, episode_count
+        FROM doramas
+        ORDER BY created_date DESC, id DESC
+        LIMIT 10
+        ''',
+    ),
+}
+
+
+def build(size, rng):
+    database = bot.Database(os.path.join(WORKDIR, f'counters_{size}.db'))
+    doramas = [(f"DR{i:06d}", f"Dorama {rng.random():.8f}", "", 2000 + i % 25, "drama") for i in range(size)]
+    episodes = [(code, ep, f"file_{code}_{ep}", rng.randrange(10_000))
+                for code, *_ in doramas for ep in range(1, EPISODES + 1)]
+    with database.pool.connection() as conn:
+        conn.executemany(
+            'INSERT INTO doramas (dorama_code, title, description, release_year, genre) VALUES (?, ?, ?, ?, ?)',
+            doramas
+        )
+        started = time.perf_counter()
+        conn.executemany('INSERT INTO episodes (dorama_code, episode_number, file_id, views) VALUES (?, ?, ?, ?)',
+                         episodes)
+        conn.commit()
+        print(f"{size} дорам: вставка {len(episodes)} эпизодов с триггерами {time.perf_counter() - started:.2f} s")
+    return database
+
+
+def measure(database, sql, repeat):
+    samples = []
+    with database.pool.connection() as conn:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            conn.execute(sql).fetchall()
+            samples.append((time.perf_counter() - started) * 1000)
+    return statistics.fmean(samples), statistics.median(samples)
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10_000, 50_000]
+    rng = random.Random(12)
+
+    for size in sizes:
+        database = build(size, rng)
+        for label, (legacy_sql, denormalized_sql) in QUERIES.items():
+            legacy_mean, legacy_p50 = measure(database, legacy_sql, 20)
+            new_mean, new_p50 = measure(database, denormalized_sql, 20)
+            print(f"  {label:<30} GROUP BY: mean {legacy_mean:8.2f} ms, p50 {legacy_p50:8.2f} ms"
+                  f" | колонки: mean {new_mean:7.2f} ms, p50 {new_p50:7.2f} ms"
+                  f" | x{legacy_mean / new_mean:.1f}")
+        database.close()
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""Сравнение задержки запросов: соединение на каждый запрос против пула.
+
+Запуск: python benchmarks/bench_db_pool.py [итераций]
+"""
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WORKDIR = tempfile.mkdtemp(prefix='bench_pool_')
+os.environ.setdefault('BOT_TOKEN', '0:benchmark')
+os.environ['DB_PATH'] = os.path.join(WORKDIR, 'bench.db')
+
+import bot  # noqa: E402
+
+
+def seed(database, doramas=500, episodes=12):
+    for i in range(doramas):
+        code = f"BN{i:05d}"
+        database.add_dorama(code, f"Dorama {i}", "", 2020 + i % 5, "drama")
+        for ep in range(1, episodes + 1):
+            database.add_episode(code, ep, f"file_{i}_{ep}")
+
+
+def legacy_get_dorama(db_path, code):
+    """Старый путь: connect + запрос + close"""
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT dorama_code, title, description, release_year, genre, rating, poster_file_id
+        FROM doramas WHERE dorama_code = ?
+    ''', (code,))
+    result = cursor.fetchone()
+    conn.close()
+    return result
+
+
+def legacy_increment_views(db_path, code, episode):
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute('UPDATE episodes SET views = views + 1 WHERE dorama_code = ? AND episode_number = ?',
+                   (code, episode))
+    conn.commit()
+    conn.close()
+
+
+def buffered_increment(database, code, i):
+    """Новый путь: приращение в буфере и сброс пачкой каждые 100 вызовов"""
+    database.increment_views(code, 1)
+    if i % 100 == 99:
+        database.flush_counters()
+
+
+def measure(label, func, iterations):
+    samples = []
+    for i in range(iterations):
+        started = time.perf_counter()
+        func(i)
+        samples.append((time.perf_counter() - started) * 1e6)
+    samples.sort()
+    p50 = statistics.median(samples)
+    p99 = samples[int(len(samples) * 0.99) - 1]
+    print(f"{label:<44} mean {statistics.fmean(samples):8.1f} µs   p50 {p50:8.1f} µs   p99 {p99:8.1f} µs")
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    database = bot.database
+    seed(database)
+    path = database.db_path
+    code = lambda i: f"BN{i % 500:05d}"
+
+    print(f"SQLite {sqlite3.sqlite_version}, {iterations} итераций\n")
+    measure("get_dorama: connect per query", lambda i: legacy_get_dorama(path, code(i)), iterations)
+    measure("get_dorama: pool", lambda i: database.get_dorama(code(i)), iterations)
+    measure("increment_views: connect per query", lambda i: legacy_increment_views(path, code(i), 1), iterations)
+    measure("increment_views: write-behind, flush/100", lambda i: buffered_increment(database, code(i), i), iterations)
+    database.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Задержка нечеткого поиска SearchIndex на большом каталоге.
+
+Запуск: python benchmarks/bench_fuzzy_search.py [количество названий]
+По умолчанию - 50 000 названий; цель - меньше 1 мс на запрос.
+"""
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('BOT_TOKEN', '0:benchmark')
+os.environ['DB_PATH'] = os.path.join(tempfile.mkdtemp(prefix='bench_fuzzy_'), 'unused.db')
+
+import bot  # noqa: E402
+
+# Слоги вида согласная + гласная (+ кода) - по разнообразию триграмм близко к реальным названиям
+ONSETS = ['', 'b', 'ch', 'd', 'f', 'g', 'h', 'j', 'k', 'l', 'm', 'n', 'p', 'q', 'r', 's', 'sh', 't', 'v', 'y', 'z']
+VOWELS = ['a', 'e', 'i', 'o', 'u', 'yu', 'ya']
+CODAS = ['', '', '', 'n', 'r', 'l', 'm', 'k', 'ng', 's']
+SYLLABLES = [onset + vowel + coda for onset in ONSETS for vowel in VOWELS for coda in CODAS]
+LATIN_TO_CYRILLIC = {'sh': 'ш', 'ch': 'ч', 'yu': 'ю', 'a': 'а', 'b': 'б', 'd': 'д', 'e': 'е', 'g': 'г',
+                     'h': 'ҳ', 'i': 'и', 'j': 'ж', 'k': 'к', 'l': 'л', 'm': 'м', 'n': 'н', 'o': 'о',
+                     'p': 'п', 'q': 'қ', 'r': 'р', 's': 'с', 't': 'т', 'u': 'у', 'v': 'в', 'y': 'й',
+                     'z': 'з'}
+
+
+def word(rng):
+    return ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 3)))
+
+
+def to_cyrillic(text):
+    for latin, cyrillic in LATIN_TO_CYRILLIC.items():
+        text = text.replace(latin, cyrillic)
+    return text
+
+
+def typo(text, rng):
+    chars = list(text)
+    i = rng.randrange(len(chars) - 1)
+    if rng.random() < 0.5:
+        chars[i], chars[i + 1] = chars[i + 1], chars[i]
+    else:
+        del chars[i]
+    return ''.join(chars)
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    rng = random.Random(7)
+    titles = [(f"DR{i:06d}", ' '.join(word(rng) for _ in range(rng.randint(1, 3))).capitalize())
+              for i in range(size)]
+
+    tracemalloc.start()
+    index = bot.SearchIndex()
+    started = time.perf_counter()
+    index.rebuild(titles)
+    build_time = time.perf_counter() - started
+    memory = tracemalloc.get_traced_memory()[0] / 2 ** 20
+    tracemalloc.stop()
+    print(f"{size} названий: построение {build_time:.2f} s, память индекса ~{memory:.0f} MB\n")
+
+    picks = [rng.choice(titles) for _ in range(500)]
+    workloads = {
+        'точное слово': [title.split()[0].lower() for _, title in picks],
+        'опечатка': [typo(title.lower(), rng) for _, title in picks],
+        'кириллица': [to_cyrillic(title.lower()) for _, title in picks],
+        'код': [code for code, _ in picks],
+    }
+    for label, queries in workloads.items():
+        samples, found = [], 0
+        for (code, _), query in zip(picks, queries):
+            started = time.perf_counter()
+            result = index.search(query)
+            samples.append((time.perf_counter() - started) * 1000)
+            found += any(hit == code for hit, _ in result)
+        samples.sort()
+        print(f"{label:<14} mean {statistics.fmean(samples):6.3f} ms  p50 {statistics.median(samples):6.3f} ms"
+              f"  p95 {samples[int(len(samples) * 0.95)]:6.3f} ms  найдено {found / len(queries):.0%}")
+
+
+if __name__ == '__main__':
+    main()
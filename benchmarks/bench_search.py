@@ -0,0 +1,94 @@
+"""Сравнение поиска: старый LIKE '%q%' против полнотекстового индекса FTS5.
+
+Запуск: python benchmarks/bench_search.py [размер каталога ...]
+По умолчанию - 10 000 и 100 000 дорам.
+"""
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WORKDIR = tempfile.mkdtemp(prefix='bench_search_')
+os.environ.setdefault('BOT_TOKEN', '0:benchmark')
+os.environ['DB_PATH'] = os.path.join(WORKDIR, 'unused.db')
+
+import bot  # noqa: E402
+
+SYLLABLES = ['yu', 'ldu', 'zlar', 'sev', 'gi', 'go', 'blin', 'ko', 'rey', 'ma', 'lik', 'ha', 'yot',
+             'qal', 'bim', 'shi', 'ro', 'na', 'dil', 'tun', 'ke', 'cha', 'sa', 'rang', 'bo', 'la']
+GENRES = ['romance', 'drama', 'fantasy', 'thriller', 'comedy', 'history']
+
+LEGACY_SQL = '''
+    SELECT d.dorama_code, d.title, d.release_year, d.genre,
+           COUNT(e.id) as episode_count
+    FROM doramas d
+    LEFT JOIN episodes e ON d.dorama_code = e.dorama_code
+    WHERE d.title LIKE ? OR d.dorama_code LIKE ? OR d.genre LIKE ?
+    GROUP BY d.dorama_code
+    ORDER BY d.title
+    LIMIT 20
+'''
+
+
+def word(rng):
+    return ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+
+
+def build(size, rng):
+    database = bot.Database(os.path.join(WORKDIR, f'search_{size}.db'))
+    doramas, episodes = [], []
+    for i in range(size):
+        code = f"DR{i:06d}"
+        title = ' '.join(word(rng) for _ in range(rng.randint(1, 3))).capitalize()
+        doramas.append((code, title, f"{word(rng)} {word(rng)}", 2000 + i % 25, rng.choice(GENRES)))
+        for ep in range(1, 4):
+            episodes.append((code, ep, f"file_{i}_{ep}"))
+
+    with database.pool.connection() as conn:
+        conn.executemany(
+            'INSERT INTO doramas (dorama_code, title, description, release_year, genre) VALUES (?, ?, ?, ?, ?)',
+            doramas
+        )
+        conn.executemany('INSERT INTO episodes (dorama_code, episode_number, file_id) VALUES (?, ?, ?)', episodes)
+        conn.commit()
+    return database, [title for _, title, _, _, _ in doramas]
+
+
+def legacy_search(database, query):
+    pattern = f'%{query}%'
+    with database.pool.connection() as conn:
+        return conn.execute(LEGACY_SQL, (pattern, pattern, pattern)).fetchall()
+
+
+def measure(func, queries):
+    samples = []
+    for query in queries:
+        started = time.perf_counter()
+        func(query)
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.fmean(samples), statistics.median(samples)
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10_000, 100_000]
+    rng = random.Random(42)
+
+    for size in sizes:
+        database, titles = build(size, rng)
+        # Запросы - начала реальных слов из каталога
+        queries = [rng.choice(titles).split()[0][:5].lower() for _ in range(200)]
+
+        legacy_mean, legacy_p50 = measure(lambda q: legacy_search(database, q), queries)
+        fts_mean, fts_p50 = measure(database.search_doramas, queries)
+        print(f"{size:>7} дорам | LIKE: mean {legacy_mean:7.2f} ms, p50 {legacy_p50:7.2f} ms"
+              f" | FTS5: mean {fts_mean:6.2f} ms, p50 {fts_p50:6.2f} ms"
+              f" | x{legacy_mean / fts_mean:.1f}")
+        database.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""Нагрузочный тест вебхука: записанные обновления отправляются на WebhookServer.
+
+Запуск: python benchmarks/bench_webhook.py [запросов] [соединений] [обработка/с] [url]
+По умолчанию - 20 000 запросов по 40 keep-alive соединениям (как max_connections у Telegram)
+на локальный сервер в этом процессе. Обработчик снимает обновления из очереди без ограничения;
+если задать скорость обработки ниже входящего потока, видно, как ограниченная очередь
+отвечает 503. Если указан url, например http://127.0.0.1:8443/telegram, нагрузка идет на
+запущенного бота (секрет - WEBHOOK_SECRET).
+"""
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('BOT_TOKEN', '0:benchmark')
+os.environ['DB_PATH'] = os.path.join(tempfile.mkdtemp(prefix='bench_webhook_'), 'unused.db')
+
+import bot  # noqa: E402
+from telegram import Bot  # noqa: E402
+
+SAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'webhook_updates.json')
+
+
+def load_bodies(count):
+    with open(SAMPLES, encoding='utf-8') as f:
+        samples = json.load(f)
+    bodies = []
+    for update_id in range(1, count + 1):
+        update = dict(samples[update_id % len(samples)], update_id=update_id)
+        bodies.append(json.dumps(update).encode())
+    return bodies
+
+
+async def post(reader, writer, host, path, secret, body):
+    writer.write(
+        f"POST {path} HTTP/1.1\r\n"
+        f"Host: {host}\r\n"
+        f"Content-Type: application/json\r\n"
+        f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while (line := await reader.readline()) not in (b'\r\n', b''):
+        name, _, value = line.decode().partition(':')
+        if name.lower() == 'content-length':
+            length = int(value)
+    if length:
+        await reader.readexactly(length)
+    return status
+
+
+async def client(host, port, path, secret, bodies, latencies, statuses):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for body in bodies:
+            started = time.perf_counter()
+            status = await post(reader, writer, host, path, secret, body)
+            latencies.append((time.perf_counter() - started) * 1000)
+            statuses[status] = statuses.get(status, 0) + 1
+    finally:
+        writer.close()
+
+
+async def consume(update_queue, rate):
+    """Имитация обработчика: снимает обновления пачками каждые 10 мс (rate=0 - без ограничения)"""
+    while True:
+        await update_queue.get()
+        if rate:
+            for _ in range(max(0, int(rate / 100) - 1)):
+                if update_queue.empty():
+                    break
+                update_queue.get_nowait()
+            await asyncio.sleep(0.01)
+
+
+async def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    connections = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    rate = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    target = sys.argv[4] if len(sys.argv) > 4 else None
+    bodies = load_bodies(total)
+
+    server = consumer = None
+    if target:
+        parts = urlsplit(target)
+        host, port, path = parts.hostname, parts.port or 80, parts.path
+        secret = bot.webhook_secret()
+    else:
+        update_queue = asyncio.Queue(maxsize=bot.WEBHOOK_QUEUE_SIZE)
+        secret = 'bench-secret'
+        server = bot.WebhookServer(update_queue, Bot(bot.BOT_TOKEN), '/telegram', secret)
+        host, path = '127.0.0.1', '/telegram'
+        port = await server.start(host, 0)
+        consumer = asyncio.create_task(consume(update_queue, rate))
+
+    # Чужой секрет должен отклоняться
+    reader, writer = await asyncio.open_connection(host, port)
+    forged = await post(reader, writer, host, path, 'wrong', bodies[0])
+    writer.close()
+
+    latencies, statuses = [], {}
+    chunks = [bodies[i::connections] for i in range(connections)]
+    started = time.perf_counter()
+    await asyncio.gather(*(client(host, port, path, secret, chunk, latencies, statuses) for chunk in chunks))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"{total} запросов, {connections} соединений: {elapsed:.2f} s, {total / elapsed:.0f} запросов/с")
+    print(f"задержка ответа: mean {statistics.fmean(latencies):.2f} ms, p50 {statistics.median(latencies):.2f} ms,"
+          f" p99 {latencies[int(len(latencies) * 0.99) - 1]:.2f} ms")
+    print(f"статусы: {dict(sorted(statuses.items()))}, неверный секрет -> {forged}")
+    if server:
+        print(f"сервер: {server.stats()}")
+        consumer.cancel()
+        await server.stop()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,16 +1,71 @@
 import os
 import logging
 import sqlite3
+import math
 import re
+import unicodedata
 import asyncio
 import datetime
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, ChatJoinRequest
-from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, CallbackQueryHandler, filters, ChatMemberHandler, ChatJoinRequestHandler
+import functools
+import hashlib
+import heapq
+import json
+import operator
+import queue
+import signal
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, ChatJoinRequest, InputMediaVideo
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.ext import Application, BaseRateLimiter, BaseUpdateProcessor, CommandHandler, MessageHandler, ContextTypes, CallbackQueryHandler, filters, ChatMemberHandler, ChatJoinRequestHandler
 
 # Загрузка переменных окружения
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_IDS = [6531897948,7540286215]
 ARCHIVE_CHANNEL_ID = os.getenv('ARCHIVE_CHANNEL_ID', '')
+DB_PATH = os.getenv('DB_PATH', '/data/korean_doramas.db')
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '4'))
+DB_QUEUE_SIZE = int(os.getenv('DB_QUEUE_SIZE', '256'))
+COUNTER_FLUSH_INTERVAL = float(os.getenv('COUNTER_FLUSH_INTERVAL', '5'))
+COUNTER_FLUSH_THRESHOLD = int(os.getenv('COUNTER_FLUSH_THRESHOLD', '500'))
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv('SUBSCRIPTION_CACHE_SIZE', '50000'))
+SUBSCRIPTION_TTL_POSITIVE = float(os.getenv('SUBSCRIPTION_TTL_POSITIVE', '21600'))  # подписка в зеркале старше - перепроверяем
+SUBSCRIPTION_TTL_NEGATIVE = float(os.getenv('SUBSCRIPTION_TTL_NEGATIVE', '30'))
+SUBSCRIPTION_CHECK_CONCURRENCY = int(os.getenv('SUBSCRIPTION_CHECK_CONCURRENCY', '16'))
+SUBSCRIPTION_CHECK_TIMEOUT = float(os.getenv('SUBSCRIPTION_CHECK_TIMEOUT', '3'))
+CATALOG_PAGE_SIZE = int(os.getenv('CATALOG_PAGE_SIZE', '10'))
+CATALOG_MAX_PAGE_SIZE = 50  # больше не влезает в одно сообщение (4096 символов) и клавиатуру
+SEARCH_AUTOSEND_SIMILARITY = float(os.getenv('SEARCH_AUTOSEND_SIMILARITY', '0.85'))  # нечеткое совпадение, при котором сразу шлем серии
+EPISODE_CACHE_SIZE = int(os.getenv('EPISODE_CACHE_SIZE', '2048'))
+MEDIA_GROUP_SIZE = 10  # максимум элементов в одном альбоме Telegram
+RENDER_CACHE_SIZE = int(os.getenv('RENDER_CACHE_SIZE', '1024'))
+CALLBACK_LEGACY_CACHE_SIZE = int(os.getenv('CALLBACK_LEGACY_CACHE_SIZE', '4096'))  # разобранных кнопок старого формата
+EPISODE_DELIVERY_MODE = os.getenv('EPISODE_DELIVERY_MODE', 'album')  # album - альбомами по 10, single - по одному
+PROTECT_CONTENT = os.getenv('PROTECT_CONTENT', 'true').lower() != 'false'
+DELIVERY_WORKERS = int(os.getenv('DELIVERY_WORKERS', '4'))
+DELIVERY_PROGRESS_INTERVAL = float(os.getenv('DELIVERY_PROGRESS_INTERVAL', '3'))
+DELIVERY_MAX_RETRIES = int(os.getenv('DELIVERY_MAX_RETRIES', '5'))          # повторов задания подряд без прогресса
+DELIVERY_RETRY_DELAY = float(os.getenv('DELIVERY_RETRY_DELAY', '5'))        # первая пауза перед повтором, дальше вдвое больше
+RATE_LIMIT_GLOBAL = float(os.getenv('RATE_LIMIT_GLOBAL', '30'))                     # сообщений в секунду на весь бот
+RATE_LIMIT_PER_CHAT = float(os.getenv('RATE_LIMIT_PER_CHAT', '1'))                  # в секунду в личный чат
+RATE_LIMIT_GROUP_PER_MINUTE = float(os.getenv('RATE_LIMIT_GROUP_PER_MINUTE', '20'))  # в минуту в группу/канал
+RATE_LIMIT_MAX_RETRIES = int(os.getenv('RATE_LIMIT_MAX_RETRIES', '3'))
+BROADCAST_SENDERS = int(os.getenv('BROADCAST_SENDERS', '20'))
+BROADCAST_PAGE_SIZE = int(os.getenv('BROADCAST_PAGE_SIZE', '500'))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv('BROADCAST_PROGRESS_INTERVAL', '5'))
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', '32'))     # обновлений, обрабатываемых одновременно
+UPDATE_BACKLOG = int(os.getenv('UPDATE_BACKLOG', '4096'))   # обновлений в работе и в ожидании своей очереди
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()  # polling или webhook
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')            # публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', os.getenv('PORT', '8443')))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')      # пусто - выводится из токена (одинаков на всех репликах)
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
 
 # Проверка обязательных переменных
 if not BOT_TOKEN:
@@ -23,376 +78,1579 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# МЕТРИКИ
+METRICS = {}
+
+def register_metrics(name, provider):
+    """Регистрирует источник метрик (функцию, возвращающую dict) для команды /metrics"""
+    METRICS[name] = provider
+
 # БАЗА ДАННЫХ
+class ConnectionPool:
+    """Пул долгоживущих соединений SQLite с привязкой соединения к потоку"""
+
+    # Прагмы применяются к каждому новому соединению
+    PRAGMAS = (
+        ('journal_mode', 'WAL'),        # читатели не блокируются писателем
+        ('synchronous', 'NORMAL'),      # в режиме WAL безопасно и без fsync на каждый commit
+        ('cache_size', -16000),         # ~16 МБ страничного кэша на соединение
+        ('mmap_size', 134217728),       # 128 МБ memory-mapped I/O
+        ('busy_timeout', 5000),         # ждем блокировку до 5 секунд вместо ошибки
+        ('temp_store', 'MEMORY'),
+    )
+
+    def __init__(self, db_path, size=4, timeout=30):
+        self.db_path = db_path
+        self.size = max(1, size)
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._owners = {}  # соединение -> поток, за которым оно закреплено
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _connect(self):
+        """Открывает новое соединение и применяет прагмы"""
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        for name, value in self.PRAGMAS:
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def _reclaim_dead(self):
+        """Возвращает в пул соединения потоков, которые уже завершились"""
+        with self._lock:
+            dead = [conn for conn, owner in self._owners.items() if not owner.is_alive()]
+            for conn in dead:
+                del self._owners[conn]
+                if conn.in_transaction:
+                    conn.rollback()
+                self._idle.put(conn)
+
+    def _lease(self):
+        """Выдает соединение текущему потоку: свободное, новое или освободившееся"""
+        thread = threading.current_thread()
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._lock:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    conn = self._connect() if len(self._owners) < self.size else None
+                if conn is not None:
+                    self._owners[conn] = thread
+                    return conn
+
+            self._reclaim_dead()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"Нет свободных соединений в пуле ({self.size})")
+            try:
+                conn = self._idle.get(timeout=min(remaining, 0.5))
+            except queue.Empty:
+                continue
+            with self._lock:
+                self._owners[conn] = thread
+            return conn
+
+    @contextmanager
+    def connection(self):
+        """Соединение текущего потока; незавершенная транзакция откатывается на выходе"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._lease()
+            self._local.conn = conn
+            self._local.depth = 0
+
+        self._local.depth += 1
+        try:
+            yield conn
+        finally:
+            self._local.depth -= 1
+            if self._local.depth == 0 and conn.in_transaction:
+                conn.rollback()
+
+    def release_thread(self):
+        """Открепляет соединение от текущего потока и возвращает его в пул"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            return
+        self._local.conn = None
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            self._owners.pop(conn, None)
+        self._idle.put(conn)
+
+    def close(self):
+        """Закрывает все соединения пула"""
+        with self._lock:
+            connections = list(self._owners)
+            self._owners.clear()
+        while True:
+            try:
+                connections.append(self._idle.get_nowait())
+            except queue.Empty:
+                break
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error as e:
+                logger.warning(f"Ошибка закрытия соединения: {e}")
+        self._local = threading.local()
+
+
+class WriteBehindBuffer:
+    """Накапливает в памяти приращения просмотров и активность пользователей"""
+
+    def __init__(self, threshold=COUNTER_FLUSH_THRESHOLD):
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._views = {}     # (dorama_code, episode_number) -> приращение
+        self._activity = {}  # user_id -> [количество запросов, последняя активность]
+        self._watches = {}   # (dorama_code, user_id) -> последний просмотр
+
+        self._pending_events = 0
+
+        # Метрики
+        self.flushes = 0
+        self.flushed_events = 0
+        self.flushed_rows = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._views) + len(self._activity) + len(self._watches)
+
+    def add_views(self, dorama_code, episode_number, count=1):
+        """Учитывает просмотры; возвращает True, если пора сбросить буфер"""
+        with self._lock:
+            key = (dorama_code, episode_number)
+            self._views[key] = self._views.get(key, 0) + count
+            self._pending_events += 1
+            return len(self._views) + len(self._activity) + len(self._watches) >= self.threshold
+
+    def touch_user(self, user_id):
+        """Учитывает запрос пользователя; возвращает True, если пора сбросить буфер"""
+        now = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        with self._lock:
+            entry = self._activity.get(user_id)
+            if entry:
+                entry[0] += 1
+                entry[1] = now
+            else:
+                self._activity[user_id] = [1, now]
+            self._pending_events += 1
+            return len(self._views) + len(self._activity) + len(self._watches) >= self.threshold
+
+    def add_watch(self, user_id, dorama_code):
+        """Учитывает, что пользователь смотрел дораму; возвращает True, если пора сбросить буфер"""
+        now = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        with self._lock:
+            self._watches[(dorama_code, user_id)] = now
+            self._pending_events += 1
+            return len(self._views) + len(self._activity) + len(self._watches) >= self.threshold
+
+    def drain(self):
+        """Забирает накопленные данные, оставляя буфер пустым"""
+        with self._lock:
+            views, self._views = self._views, {}
+            activity, self._activity = self._activity, {}
+            watches, self._watches = self._watches, {}
+            events, self._pending_events = self._pending_events, 0
+        return views, activity, watches, events
+
+    def restore(self, views, activity, watches, events):
+        """Возвращает в буфер данные, которые не удалось записать"""
+        with self._lock:
+            self._pending_events += events
+            for key, count in views.items():
+                self._views[key] = self._views.get(key, 0) + count
+            for user_id, (requests, last_activity) in activity.items():
+                entry = self._activity.get(user_id)
+                if entry:
+                    entry[0] += requests
+                else:
+                    self._activity[user_id] = [requests, last_activity]
+            for key, last_viewed in watches.items():
+                self._watches.setdefault(key, last_viewed)
+
+    def record_flush(self, rows, events):
+        with self._lock:
+            self.flushes += 1
+            self.flushed_rows += rows
+            self.flushed_events += events
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending_keys': len(self._views) + len(self._activity) + len(self._watches),
+                'pending_events': self._pending_events,
+                'flushes': self.flushes,
+                'flushed_rows': self.flushed_rows,
+                'saved_writes': self.flushed_events - self.flushed_rows,
+            }
+
+
+# ПОИСК С ОПЕЧАТКАМИ И ТРАНСЛИТЕРАЦИЕЙ
+# Узбекская кириллица и русский приводятся к узбекской латинице
+CYRILLIC_TO_LATIN = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'ғ': 'g', 'д': 'd', 'е': 'e', 'ё': 'yo',
+    'ж': 'j', 'з': 'z', 'и': 'i', 'й': 'y', 'к': 'k', 'қ': 'q', 'л': 'l', 'м': 'm',
+    'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u', 'ў': 'o',
+    'ф': 'f', 'х': 'x', 'ҳ': 'h', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'sh', 'ъ': '',
+    'ы': 'i', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya',
+})
+# Звуки, которые пользователи путают между раскладками: қ/к, х/ҳ, w/v
+LATIN_FOLD = str.maketrans({'q': 'k', 'x': 'h', 'w': 'v'})
+APOSTROPHES = str.maketrans({ch: '' for ch in "'`’‘ʻʼ´"})
+NONZERO_BYTE = re.compile(rb'[^\x00]')
+
+# Откуда взят результат поиска
+SEARCH_FTS = 'fts'      # полнотекстовый индекс
+SEARCH_EXACT = 'exact'  # точное совпадение кода дорамы
+SEARCH_FUZZY = 'fuzzy'  # триграммы - догадка, возможно по опечатке
+
+
+def normalize_search_text(text):
+    """Приводит строку к нормальной форме для нечеткого поиска"""
+    text = unicodedata.normalize('NFKC', text or '').lower().translate(CYRILLIC_TO_LATIN)
+    if not text.isascii():
+        text = ''.join(ch for ch in unicodedata.normalize('NFKD', text) if not unicodedata.combining(ch))
+    text = text.translate(APOSTROPHES).translate(LATIN_FOLD)
+    return ' '.join(re.findall(r'[^\W_]+', text))
+
+
+def search_trigrams(text):
+    """Множество триграмм нормализованной строки (слова дополняются пробелами)"""
+    grams = set()
+    for word in text.split():
+        padded = f"  {word} "
+        for i in range(len(padded) - 2):
+            grams.add(padded[i:i + 3])
+    return grams
+
+
+class SearchIndex:
+    """Триграммный индекс в памяти по названиям и кодам дорам.
+
+    Для каждой триграммы хранится битовая маска номеров документов (int),
+    а число совпавших триграмм считается сразу для всех документов
+    побитовым сумматором по маскам запроса - это операции над длинными
+    целыми в C, без цикла Python по спискам документов.
+    """
+
+    def __init__(self, min_similarity=0.3, min_coverage=0.35, max_candidates=100):
+        self.min_similarity = min_similarity
+        self.min_coverage = min_coverage      # доля триграмм запроса, которая должна совпасть
+        self.max_candidates = max_candidates
+        self._lock = threading.Lock()
+        self._masks = {}      # триграмма -> битовая маска номеров документов
+        self._docs = {}       # номер документа -> (dorama_code, нормализованный текст, число триграмм)
+        self._by_code = {}    # dorama_code -> номер документа
+        self._exact = {}      # нормализованный код -> dorama_code
+        self._free_ids = []   # номера удаленных документов для повторного использования
+        self._next_id = 0
+
+    def __len__(self):
+        return len(self._docs)
+
+    def _add(self, dorama_code, title):
+        self._remove(dorama_code)
+        text = normalize_search_text(f"{title} {dorama_code}")
+        grams = search_trigrams(text)
+
+        doc_id = heapq.heappop(self._free_ids) if self._free_ids else self._next_id
+        self._next_id = max(self._next_id, doc_id + 1)
+        self._docs[doc_id] = (dorama_code, text, len(grams))
+        self._by_code[dorama_code] = doc_id
+        self._exact[normalize_search_text(dorama_code)] = dorama_code
+        bit = 1 << doc_id
+        for gram in grams:
+            self._masks[gram] = self._masks.get(gram, 0) | bit
+
+    def _remove(self, dorama_code):
+        doc_id = self._by_code.pop(dorama_code, None)
+        if doc_id is None:
+            return
+        _, text, _ = self._docs.pop(doc_id)
+        self._exact.pop(normalize_search_text(dorama_code), None)
+        bit = 1 << doc_id
+        for gram in search_trigrams(text):
+            mask = self._masks.get(gram, 0) & ~bit
+            if mask:
+                self._masks[gram] = mask
+            else:
+                self._masks.pop(gram, None)
+        heapq.heappush(self._free_ids, doc_id)
+
+    def add(self, dorama_code, title):
+        """Добавляет или обновляет дораму в индексе"""
+        with self._lock:
+            self._add(dorama_code, title)
+
+    def remove(self, dorama_code):
+        with self._lock:
+            self._remove(dorama_code)
+
+    def find_code(self, query):
+        """Код дорамы, если запрос совпадает с ним после нормализации"""
+        with self._lock:
+            return self._exact.get(normalize_search_text(query))
+
+    def rebuild(self, rows):
+        """Строит индекс заново из пар (dorama_code, title)"""
+        docs, by_code, exact, postings = {}, {}, {}, {}
+        for doc_id, (dorama_code, title) in enumerate(rows):
+            text = normalize_search_text(f"{title} {dorama_code}")
+            grams = search_trigrams(text)
+            docs[doc_id] = (dorama_code, text, len(grams))
+            by_code[dorama_code] = doc_id
+            exact[normalize_search_text(dorama_code)] = dorama_code
+            for gram in grams:
+                postings.setdefault(gram, []).append(doc_id)
+
+        # Маски собираем через bytearray: так быстрее, чем сдвигать длинные int
+        size = len(docs) // 8 + 1
+        masks = {}
+        for gram, doc_ids in postings.items():
+            bits = bytearray(size)
+            for doc_id in doc_ids:
+                bits[doc_id >> 3] |= 1 << (doc_id & 7)
+            masks[gram] = int.from_bytes(bits, 'little')
+
+        with self._lock:
+            self._masks, self._docs, self._by_code, self._exact = masks, docs, by_code, exact
+            self._free_ids = []
+            self._next_id = len(docs)
+
+    @staticmethod
+    def _count_planes(masks):
+        """Побитовый сумматор: planes[i] - i-й бит счетчика совпадений каждого документа"""
+        planes = []
+        for mask in masks:
+            carry, i = mask, 0
+            while carry:
+                if i == len(planes):
+                    planes.append(carry)
+                    break
+                plane = planes[i]
+                planes[i] = plane ^ carry
+                carry &= plane
+                i += 1
+        return planes
+
+    @staticmethod
+    def _equal(planes, value):
+        """Маска документов, у которых счетчик равен value"""
+        if value >> len(planes):
+            return 0
+        result = -1
+        for i, plane in enumerate(planes):
+            result &= plane if (value >> i) & 1 else ~plane
+        return result
+
+    def search(self, query, limit=20):
+        """Возвращает [(dorama_code, сходство)] по убыванию сходства"""
+        text = normalize_search_text(query)
+        grams = search_trigrams(text)
+        if not grams:
+            return []
+
+        with self._lock:
+            # Код дорамы уникален - точное совпадение кода и есть ответ
+            exact = self._exact.get(text)
+            if exact:
+                return [(exact, 1.0)]
+
+            planes = self._count_planes([self._masks[gram] for gram in grams if gram in self._masks])
+            required = max(1, math.ceil(len(grams) * self.min_coverage))
+
+            # Кандидатов берем от большего числа совпадений к меньшему
+            candidates = []
+            size = self._next_id // 8 + 1
+            for shared in range(len(grams), required - 1, -1):
+                mask = self._equal(planes, shared) & ((1 << self._next_id) - 1)
+                if not mask:
+                    continue
+                # Ненулевые байты маски ищет регулярное выражение (в C), биты внутри байта - Python
+                for match in NONZERO_BYTE.finditer(mask.to_bytes(size, 'little')):
+                    byte, base = match.group()[0], match.start() * 8
+                    while byte:
+                        low = byte & -byte
+                        candidates.append((base + low.bit_length() - 1, shared))
+                        byte ^= low
+                    if len(candidates) >= self.max_candidates:
+                        break
+                if len(candidates) >= self.max_candidates:
+                    break
+
+            results = []
+            for doc_id, shared in candidates:
+                code, doc_text, doc_grams = self._docs[doc_id]
+                # Среднее коэффициента Дайса и покрытия запроса: длинное название,
+                # в котором есть искомое слово, не проигрывает короткому.
+                # Точное вхождение запроса поднимаем вверх отдельным ключом сортировки,
+                # сходство остается в [0, 1] - по нему решается, слать ли серии сразу
+                score = (2 * shared / (len(grams) + doc_grams) + shared / len(grams)) / 2
+                contains = text in doc_text
+                if contains or score >= self.min_similarity:
+                    results.append((code, score, contains, len(doc_text)))
+
+        results.sort(key=lambda item: (not item[2], -item[1], item[3]))
+        return [(code, round(score, 3)) for code, score, _, _ in results[:limit]]
+
+
+# КЭШ КАТАЛОГА
+class CatalogCache:
+    """Кэш каталога в памяти: компактные записи дорам с количеством эпизодов"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._records = None  # dorama_code -> (dorama_code, title, release_year, genre, rating, episode_count)
+        self._sorted = None   # записи, отсортированные по названию (собираются лениво)
+        self.version = 0      # растет при каждом изменении каталога
+        self.hits = 0
+        self.misses = 0
+
+    def get_all(self, loader):
+        """Все записи по названию; при пустом кэше загружает их через loader()"""
+        with self._lock:
+            if self._records is not None:
+                self.hits += 1
+                if self._sorted is None:
+                    self._sorted = sorted(self._records.values(), key=lambda record: (record[1], record[0]))
+                return self._sorted
+            self.misses += 1
+            version = self.version
+
+        rows = loader()
+        with self._lock:
+            # Пока шла загрузка, каталог могли изменить - тогда не кэшируем устаревшие данные
+            if self.version == version:
+                self._records = {row[0]: tuple(row) for row in rows}
+                self._sorted = list(rows)
+        return rows
+
+    def patch(self, dorama_code, record):
+        """Обновляет одну запись (record=None - удаляет ее)"""
+        with self._lock:
+            self.version += 1
+            if self._records is None:
+                return
+            if record is None:
+                self._records.pop(dorama_code, None)
+            else:
+                self._records[dorama_code] = tuple(record)
+            self._sorted = None
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+            self._records = None
+            self._sorted = None
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'records': len(self._records) if self._records is not None else 0,
+                'version': self.version,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': f"{self.hits / total:.1%}" if total else '-',
+            }
+
+
+# КЭШ НОМЕРОВ ЭПИЗОДОВ
+class DoramaIds:
+    """Соответствие dorama_code <-> doramas.id в памяти (для компактных callback_data)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = {}    # dorama_code -> id
+        self._codes = {}  # id -> dorama_code
+
+    def __len__(self):
+        return len(self._ids)
+
+    def rebuild(self, rows):
+        """Заполняет карту из пар (id, dorama_code)"""
+        with self._lock:
+            self._ids = {code: dorama_id for dorama_id, code in rows}
+            self._codes = {dorama_id: code for dorama_id, code in rows}
+
+    def put(self, dorama_id, dorama_code):
+        with self._lock:
+            self._ids[dorama_code] = dorama_id
+            self._codes[dorama_id] = dorama_code
+
+    def remove(self, dorama_code):
+        with self._lock:
+            dorama_id = self._ids.pop(dorama_code, None)
+            self._codes.pop(dorama_id, None)
+
+    def id_of(self, dorama_code):
+        return self._ids.get(dorama_code)
+
+    def code_of(self, dorama_id):
+        return self._codes.get(dorama_id)
+
+class EpisodeNumbersCache:
+    """Отсортированные номера эпизодов по дорамам (array('i')) в ограниченном LRU"""
+
+    def __init__(self, maxsize=EPISODE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._data = OrderedDict()  # dorama_code -> array('i')
+        self.version = 0            # растет при каждой инвалидации
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, dorama_code):
+        with self._lock:
+            numbers = self._data.get(dorama_code)
+            if numbers is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(dorama_code)
+            self.hits += 1
+            return numbers
+
+    def put(self, dorama_code, numbers, version):
+        """Сохраняет номера, если с момента начала загрузки эпизоды не менялись"""
+        with self._lock:
+            if self.version != version:
+                return
+            self._data[dorama_code] = numbers
+            self._data.move_to_end(dorama_code)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, dorama_code):
+        with self._lock:
+            self.version += 1
+            self._data.pop(dorama_code, None)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'doramas': len(self._data),
+                'episodes': sum(len(numbers) for numbers in self._data.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': f"{self.hits / total:.1%}" if total else '-',
+            }
+
+
+# КЭШ КОНФИГУРАЦИИ
+class ConfigCache:
+    """Снимок таблиц channels и bot_settings: меняются только командами админа"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._channels = {}         # channel_id -> строка канала
+        self._channel_list = ()     # те же строки в порядке таблицы
+        self._settings = {}
+        self.version = 0            # растет при каждой перезагрузке
+
+    def load(self, channels, settings):
+        with self._lock:
+            self._channel_list = tuple(tuple(row) for row in channels)
+            self._channels = {row[0]: row for row in self._channel_list}
+            self._settings = dict(settings)
+            self.version += 1
+
+    def channels(self):
+        return self._channel_list
+
+    def channel(self, channel_id):
+        return self._channels.get(channel_id)
+
+    def setting(self, key):
+        return self._settings.get(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'channels': len(self._channel_list),
+                'settings': len(self._settings),
+                'version': self.version,
+            }
+
+
+# ЗЕРКАЛО ПОДПИСОК
+class MembershipMirror:
+    """Известные статусы подписки на публичные каналы: channel_id -> {user_id: (подписан ли, updated_at)}
+
+    updated_at - unix-время последнего подтверждения статуса (апдейт chat_member или ответ Bot API).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._channels = {}
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def load(self, rows):
+        """Заполняет зеркало строками (user_id, channel_id, status, updated_at)"""
+        with self._lock:
+            self._channels = {}
+            for user_id, channel_id, status, updated_at in rows:
+                entry = (status not in ['left', 'kicked'], updated_at or 0)
+                self._channels.setdefault(channel_id, {})[user_id] = entry
+
+    def get(self, user_id, channel_id, max_age=None):
+        """True/False - статус известен, None - нужно спросить Bot API.
+
+        Подписка старше max_age секунд тоже считается неизвестной: апдейт о выходе
+        из канала мог потеряться (Telegram хранит апдейты только сутки).
+        """
+        with self._lock:
+            entry = self._channels.get(channel_id, {}).get(user_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            is_member, updated_at = entry
+            if is_member and max_age is not None and time.time() - updated_at > max_age:
+                self.stale += 1
+                return None
+            self.hits += 1
+            return is_member
+
+    def peek(self, user_id, channel_id):
+        """Статус без учета срока и без метрик: True/False или None"""
+        with self._lock:
+            entry = self._channels.get(channel_id, {}).get(user_id)
+            return None if entry is None else entry[0]
+
+    def set(self, user_id, channel_id, is_member):
+        with self._lock:
+            self._channels.setdefault(channel_id, {})[user_id] = (is_member, time.time())
+
+    def drop_channel(self, channel_id):
+        with self._lock:
+            self._channels.pop(channel_id, None)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'channels': len(self._channels),
+                'entries': sum(len(users) for users in self._channels.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'hit_rate': f"{self.hits / total:.1%}" if total else '-',
+            }
+
+
+# МИГРАЦИИ СХЕМЫ
+# Каждая миграция применяется один раз в своей транзакции, номер последней
+# примененной хранится в bot_settings под ключом schema_version.
+# Шаг миграции - SQL-строка или функция, принимающая соединение.
+MIGRATIONS = [
+    (1, "индекс users.last_activity", (
+        # get_active_users_count, daily_active в get_admin_stats:
+        #   было:  SCAN users
+        #   стало: SEARCH users USING COVERING INDEX idx_users_last_activity (last_activity>?)
+        'CREATE INDEX IF NOT EXISTS idx_users_last_activity ON users (last_activity)',
+    )),
+    (2, "индекс channel_requests.status", (
+        # get_pending_requests_count (с channel_id и без):
+        #   было:  SCAN channel_requests
+        #   стало: SEARCH channel_requests USING COVERING INDEX idx_channel_requests_status (status=? AND channel_id=?)
+        'CREATE INDEX IF NOT EXISTS idx_channel_requests_status ON channel_requests (status, channel_id)',
+    )),
+    (3, "индекс doramas.created_date", (
+        # get_recent_doramas:
+        #   было:  SCAN d ... USE TEMP B-TREE FOR ORDER BY
+        #   стало: SCAN d USING INDEX idx_doramas_created_date
+        'CREATE INDEX IF NOT EXISTS idx_doramas_created_date ON doramas (created_date)',
+    )),
+    (4, "полнотекстовый индекс doramas_fts", (
+        # search_doramas:
+        #   было:  SCAN d (LIKE '%q%' по title, dorama_code, genre) + GROUP BY по episodes
+        #   стало: SCAN doramas_fts VIRTUAL TABLE INDEX 0:M4, SEARCH d USING INTEGER PRIMARY KEY (rowid=?)
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS doramas_fts USING fts5(
+            title, description, genre, dorama_code,
+            content='doramas', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS doramas_fts_ai AFTER INSERT ON doramas BEGIN
+            INSERT INTO doramas_fts (rowid, title, description, genre, dorama_code)
+            VALUES (new.id, new.title, new.description, new.genre, new.dorama_code);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS doramas_fts_ad AFTER DELETE ON doramas BEGIN
+            INSERT INTO doramas_fts (doramas_fts, rowid, title, description, genre, dorama_code)
+            VALUES ('delete', old.id, old.title, old.description, old.genre, old.dorama_code);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS doramas_fts_au AFTER UPDATE OF title, description, genre, dorama_code ON doramas BEGIN
+            INSERT INTO doramas_fts (doramas_fts, rowid, title, description, genre, dorama_code)
+            VALUES ('delete', old.id, old.title, old.description, old.genre, old.dorama_code);
+            INSERT INTO doramas_fts (rowid, title, description, genre, dorama_code)
+            VALUES (new.id, new.title, new.description, new.genre, new.dorama_code);
+        END
+        ''',
+        "INSERT INTO doramas_fts (doramas_fts) VALUES ('rebuild')",
+    )),
+    (5, "политика канала при ошибке проверки", (
+        # fail_open = TRUE: если Bot API не ответил или ответил ошибкой, канал считается пройденным.
+        # По умолчанию FALSE - прежнее поведение, ошибка проверки требует подписки.
+        'ALTER TABLE channels ADD COLUMN fail_open BOOLEAN DEFAULT FALSE',
+    )),
+    (6, "таблица channel_memberships", (
+        # Статусы подписки на публичные каналы из апдейтов chat_member и первых ответов get_chat_member.
+        # Ключ начинается с channel_id, чтобы delete_channel удалял строки канала по префиксу ключа.
+        '''
+        CREATE TABLE IF NOT EXISTS channel_memberships (
+            channel_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (channel_id, user_id)
+        ) WITHOUT ROWID
+        ''',
+    )),
+    (7, "счетчики doramas.episode_count и doramas.total_views", (
+        # _load_all_doramas, search_doramas, get_recent_doramas:
+        #   было:  SCAN d + CORRELATED SCALAR SUBQUERY / LEFT JOIN episodes ... GROUP BY
+        #   стало: чтение колонки из строки doramas
+        # популярные дорамы в get_admin_stats:
+        #   было:  SCAN e USING INDEX sqlite_autoindex_episodes_1, SEARCH d ..., USE TEMP B-TREE FOR ORDER BY
+        #   стало: SCAN doramas USING INDEX idx_doramas_total_views
+        'ALTER TABLE doramas ADD COLUMN episode_count INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE doramas ADD COLUMN total_views INTEGER NOT NULL DEFAULT 0',
+        '''
+        CREATE TRIGGER IF NOT EXISTS episodes_counters_ai AFTER INSERT ON episodes BEGIN
+            UPDATE doramas SET episode_count = episode_count + 1,
+                               total_views = total_views + COALESCE(new.views, 0)
+            WHERE dorama_code = new.dorama_code;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS episodes_counters_ad AFTER DELETE ON episodes BEGIN
+            UPDATE doramas SET episode_count = episode_count - 1,
+                               total_views = total_views - COALESCE(old.views, 0)
+            WHERE dorama_code = old.dorama_code;
+        END
+        ''',
+        # Два UPDATE вместо одного - эпизод мог переехать в другую дораму
+        '''
+        CREATE TRIGGER IF NOT EXISTS episodes_counters_au AFTER UPDATE OF views, dorama_code ON episodes BEGIN
+            UPDATE doramas SET episode_count = episode_count - 1,
+                               total_views = total_views - COALESCE(old.views, 0)
+            WHERE dorama_code = old.dorama_code;
+            UPDATE doramas SET episode_count = episode_count + 1,
+                               total_views = total_views + COALESCE(new.views, 0)
+            WHERE dorama_code = new.dorama_code;
+        END
+        ''',
+        '''
+        UPDATE doramas SET
+            episode_count = (SELECT COUNT(*) FROM episodes e WHERE e.dorama_code = doramas.dorama_code),
+            total_views = (SELECT COALESCE(SUM(e.views), 0) FROM episodes e WHERE e.dorama_code = doramas.dorama_code)
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_doramas_total_views ON doramas (total_views)',
+    )),
+    (8, "индекс doramas (title, dorama_code)", (
+        # get_doramas_page (keyset-пагинация), _load_all_doramas:
+        #   было:  SCAN doramas + USE TEMP B-TREE FOR ORDER BY
+        #   стало: SEARCH doramas USING INDEX idx_doramas_title ((title,dorama_code)>(?,?))
+        'CREATE INDEX IF NOT EXISTS idx_doramas_title ON doramas (title, dorama_code)',
+    )),
+    (9, "таблица delivery_jobs", (
+        # Задание «отправить все эпизоды»: курсор - номер последнего доставленного эпизода
+        '''
+        CREATE TABLE IF NOT EXISTS delivery_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            dorama_code TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            cursor INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            progress_message_id INTEGER,
+            error TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # get_unfinished_delivery_jobs, find_active_delivery_job:
+        #   SEARCH delivery_jobs USING INDEX idx_delivery_jobs_status (status=?)
+        'CREATE INDEX IF NOT EXISTS idx_delivery_jobs_status ON delivery_jobs (status, chat_id)',
+    )),
+    (10, "таблица broadcasts", (
+        # Рассылка: курсор - последний обработанный user_id, пользователи идут по возрастанию ключа
+        '''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_chat_id INTEGER NOT NULL,
+            from_chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            progress_message_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'running',
+            cursor INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            elapsed REAL NOT NULL DEFAULT 0,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            finished_at DATETIME
+        )
+        ''',
+    )),
+    (11, "флаг users.is_reachable", (
+        # Пользователь заблокировал бота или удалил аккаунт - рассылки его пропускают.
+        # Любая активность пользователя (flush_counters) снова делает его достижимым.
+        'ALTER TABLE users ADD COLUMN is_reachable BOOLEAN NOT NULL DEFAULT TRUE',
+        'ALTER TABLE users ADD COLUMN unreachable_at DATETIME',
+        # get_users_count, get_unreachable_stats: недостижимых мало - частичный индекс только по ним
+        #   SEARCH users USING COVERING INDEX idx_users_unreachable
+        'CREATE INDEX IF NOT EXISTS idx_users_unreachable ON users (unreachable_at) WHERE is_reachable = FALSE',
+        'ALTER TABLE broadcasts ADD COLUMN unreachable INTEGER NOT NULL DEFAULT 0',
+    )),
+    (12, "таблица user_views и сегменты рассылок", (
+        # Кто какую дораму смотрел - для рассылок по сегменту dorama=CODE.
+        # Ключ (dorama_code, user_id): зрители одной дорамы читаются диапазоном в порядке user_id
+        #   SEARCH v USING PRIMARY KEY (dorama_code=? AND user_id>?)
+        '''
+        CREATE TABLE IF NOT EXISTS user_views (
+            dorama_code TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            last_viewed DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (dorama_code, user_id)
+        ) WITHOUT ROWID
+        ''',
+        # Фильтры сегмента хранятся вместе с рассылкой, чтобы продолжить ее после перезапуска
+        'ALTER TABLE broadcasts ADD COLUMN active_days INTEGER',
+        'ALTER TABLE broadcasts ADD COLUMN dorama_code TEXT',
+    )),
+    (13, "счетчик broadcasts.skipped", (
+        # Сколько недостижимых пользователей сегмента рассылка пропустила при запуске -
+        # это и есть сэкономленные отправки (get_unreachable_stats)
+        'ALTER TABLE broadcasts ADD COLUMN skipped INTEGER NOT NULL DEFAULT 0',
+    )),
+]
+
+
 class Database:
-    def __init__(self, db_path="/data/korean_doramas.db"):
+    def __init__(self, db_path=DB_PATH, pool_size=DB_POOL_SIZE):
         # Используем /data для Railway persistent storage
-        os.makedirs('/data', exist_ok=True)
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
         self.db_path = db_path
+        self.pool = ConnectionPool(db_path, size=pool_size)
+        self.counters = WriteBehindBuffer()
+        self.search_index = SearchIndex()
+        self.catalog = CatalogCache()
+        self.dorama_ids = DoramaIds()
+        self.memberships = MembershipMirror()
+        self.config = ConfigCache()
+        self.episode_numbers = EpisodeNumbersCache()
+        self._doramas_count = None  # (версия каталога, количество)
         self.init_db()
-    
+
+    def close(self):
+        """Закрывает все соединения с базой"""
+        self.pool.close()
+
     def init_db(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Основная таблица для дорам
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS doramas (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                dorama_code TEXT UNIQUE NOT NULL,
-                title TEXT NOT NULL,
-                description TEXT,
-                release_year INTEGER,
-                genre TEXT,
-                rating REAL DEFAULT 0,
-                poster_file_id TEXT,
-                created_date DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Таблица для эпизодов
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS episodes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                dorama_code TEXT NOT NULL,
-                episode_number INTEGER NOT NULL,
-                file_id TEXT NOT NULL,
-                caption TEXT,
-                duration INTEGER DEFAULT 0,
-                file_size INTEGER DEFAULT 0,
-                views INTEGER DEFAULT 0,
-                added_date DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (dorama_code) REFERENCES doramas (dorama_code),
-                UNIQUE(dorama_code, episode_number)
-            )
-        ''')
-        
-        # Пользователи
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                joined_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                last_activity DATETIME DEFAULT CURRENT_TIMESTAMP,
-                total_requests INTEGER DEFAULT 0
-            )
-        ''')
-        
-        # Каналы для подписки
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS channels (
-                channel_id INTEGER PRIMARY KEY,
-                username TEXT,
-                title TEXT,
-                invite_link TEXT,
-                is_active BOOLEAN DEFAULT TRUE,
-                is_private BOOLEAN DEFAULT FALSE
-            )
-        ''')
-        
-        # Заявки на вступление в приватные каналы
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS channel_requests (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                channel_id INTEGER,
-                status TEXT DEFAULT 'pending',
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id),
-                FOREIGN KEY (channel_id) REFERENCES channels (channel_id),
-                UNIQUE(user_id, channel_id)
-            )
-        ''')
-        
-        # Настройки бота
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS bot_settings (
-                key TEXT PRIMARY KEY,
-                value TEXT
-            )
-        ''')
-        
-        # Добавляем начальные настройки
-        cursor.execute('''
-            INSERT OR IGNORE INTO bot_settings (key, value) VALUES 
-            ('welcome_message', '🎬 Xush kelibsiz! Koreys doramalarini tomosha qilish uchun maxsus bot.'),
-            ('help_message', '🤖 Botdan foydalanish uchun kerakli bolimni tanlang.'),
-            ('archive_channel', ?)
-        ''', (ARCHIVE_CHANNEL_ID,))
-        
-        conn.commit()
-        conn.close()
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+
+            # Основная таблица для дорам
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS doramas (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    dorama_code TEXT UNIQUE NOT NULL,
+                    title TEXT NOT NULL,
+                    description TEXT,
+                    release_year INTEGER,
+                    genre TEXT,
+                    rating REAL DEFAULT 0,
+                    poster_file_id TEXT,
+                    created_date DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # Таблица для эпизодов
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS episodes (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    dorama_code TEXT NOT NULL,
+                    episode_number INTEGER NOT NULL,
+                    file_id TEXT NOT NULL,
+                    caption TEXT,
+                    duration INTEGER DEFAULT 0,
+                    file_size INTEGER DEFAULT 0,
+                    views INTEGER DEFAULT 0,
+                    added_date DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (dorama_code) REFERENCES doramas (dorama_code),
+                    UNIQUE(dorama_code, episode_number)
+                )
+            ''')
+
+            # Пользователи
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id INTEGER PRIMARY KEY,
+                    username TEXT,
+                    first_name TEXT,
+                    last_name TEXT,
+                    joined_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    last_activity DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    total_requests INTEGER DEFAULT 0
+                )
+            ''')
+
+            # Каналы для подписки
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS channels (
+                    channel_id INTEGER PRIMARY KEY,
+                    username TEXT,
+                    title TEXT,
+                    invite_link TEXT,
+                    is_active BOOLEAN DEFAULT TRUE,
+                    is_private BOOLEAN DEFAULT FALSE
+                )
+            ''')
+
+            # Заявки на вступление в приватные каналы
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS channel_requests (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    channel_id INTEGER,
+                    status TEXT DEFAULT 'pending',
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users (user_id),
+                    FOREIGN KEY (channel_id) REFERENCES channels (channel_id),
+                    UNIQUE(user_id, channel_id)
+                )
+            ''')
+
+            # Настройки бота
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS bot_settings (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                )
+            ''')
+
+            # Добавляем начальные настройки
+            cursor.execute('''
+                INSERT OR IGNORE INTO bot_settings (key, value) VALUES
+                ('welcome_message', '🎬 Xush kelibsiz! Koreys doramalarini tomosha qilish uchun maxsus bot.'),
+                ('help_message', '🤖 Botdan foydalanish uchun kerakli bolimni tanlang.'),
+                ('archive_channel', ?)
+            ''', (ARCHIVE_CHANNEL_ID,))
+
+            conn.commit()
+
+        self.migrate()
+        self.rebuild_search_index()
+        self.load_channel_memberships()
+        self.reload_config()
         logger.info("✅ База данных корейских дорам инициализирована")
 
+    def rebuild_search_index(self):
+        """Строит триграммный индекс для нечеткого поиска и карту dorama_code <-> id"""
+        with self.pool.connection() as conn:
+            rows = conn.execute('SELECT id, dorama_code, title FROM doramas').fetchall()
+        self.search_index.rebuild([(code, title) for _, code, title in rows])
+        self.dorama_ids.rebuild([(dorama_id, code) for dorama_id, code, _ in rows])
+        logger.info(f"✅ Индекс поиска построен: {len(self.search_index)} дорам")
+
+    def get_schema_version(self):
+        """Возвращает номер последней примененной миграции"""
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT value FROM bot_settings WHERE key = 'schema_version'").fetchone()
+        return int(row[0]) if row else 0
+
+    def migrate(self):
+        """Применяет недостающие миграции из MIGRATIONS по порядку"""
+        with self.pool.connection() as conn:
+            for version, description, steps in MIGRATIONS:
+                # Версию перечитываем под блокировкой записи, чтобы два процесса
+                # не применили одну миграцию дважды
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    row = conn.execute("SELECT value FROM bot_settings WHERE key = 'schema_version'").fetchone()
+                    if row and int(row[0]) >= version:
+                        conn.rollback()
+                        continue
+
+                    for step in steps:
+                        if callable(step):
+                            step(conn)
+                        else:
+                            conn.execute(step)
+
+                    conn.execute(
+                        "INSERT OR REPLACE INTO bot_settings (key, value) VALUES ('schema_version', ?)",
+                        (str(version),)
+                    )
+                    conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    logger.error(f"❌ Ошибка миграции {version} ({description}): {e}")
+                    raise
+
+                logger.info(f"✅ Применена миграция {version}: {description}")
+
     # МЕТОДЫ ДЛЯ РАБОТЫ С ДОРАМАМИ
     def add_dorama(self, dorama_code, title, description="", release_year=None, genre="", poster_file_id=None):
         """Добавляет новую дораму"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute('''
-                INSERT OR REPLACE INTO doramas 
-                (dorama_code, title, description, release_year, genre, poster_file_id) 
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (dorama_code, title, description, release_year, genre, poster_file_id))
-            
-            conn.commit()
-            logger.info(f"✅ Добавлена дорама: {title} (Код: {dorama_code})")
-            return True
-        except Exception as e:
-            logger.error(f"❌ Ошибка добавления дорамы: {e}")
-            return False
-        finally:
-            conn.close()
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+
+            try:
+                # UPSERT вместо INSERT OR REPLACE: строка не пересоздается, поэтому id
+                # сохраняется, а триггеры doramas_fts видят обычный UPDATE
+                cursor.execute('''
+                    INSERT INTO doramas
+                    (dorama_code, title, description, release_year, genre, poster_file_id)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(dorama_code) DO UPDATE SET
+                        title = excluded.title,
+                        description = excluded.description,
+                        release_year = excluded.release_year,
+                        genre = excluded.genre,
+                        poster_file_id = excluded.poster_file_id
+                ''', (dorama_code, title, description, release_year, genre, poster_file_id))
+
+                conn.commit()
+                dorama_id = conn.execute('SELECT id FROM doramas WHERE dorama_code = ?', (dorama_code,)).fetchone()[0]
+                self.dorama_ids.put(dorama_id, dorama_code)
+                self.search_index.add(dorama_code, title)
+                self._refresh_catalog_entry(dorama_code)
+                logger.info(f"✅ Добавлена дорама: {title} (Код: {dorama_code})")
+                return True
+            except Exception as e:
+                logger.error(f"❌ Ошибка добавления дорамы: {e}")
+                return False
 
     def get_dorama(self, dorama_code):
         """Получает информацию о дораме"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT dorama_code, title, description, release_year, genre, rating, poster_file_id
-            FROM doramas WHERE dorama_code = ?
-        ''', (dorama_code,))
-        
-        result = cursor.fetchone()
-        conn.close()
-        return result
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute('''
+                SELECT dorama_code, title, description, release_year, genre, rating, poster_file_id
+                FROM doramas WHERE dorama_code = ?
+            ''', (dorama_code,))
+
+            return cursor.fetchone()
+
+    def get_dorama_by_id(self, dorama_id):
+        """Получает информацию о дораме по первичному ключу (те же колонки, что get_dorama)"""
+        with self.pool.connection() as conn:
+            return conn.execute('''
+                SELECT dorama_code, title, description, release_year, genre, rating, poster_file_id
+                FROM doramas WHERE id = ?
+            ''', (dorama_id,)).fetchone()
 
     def get_all_doramas(self):
-        """Получает все дорамы"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT d.dorama_code, d.title, d.release_year, d.genre, d.rating,
-                   COUNT(e.id) as episode_count
-            FROM doramas d
-            LEFT JOIN episodes e ON d.dorama_code = e.dorama_code
-            GROUP BY d.dorama_code
-            ORDER BY d.title
-        ''')
-        
-        result = cursor.fetchall()
-        conn.close()
-        return result
+        """Получает все дорамы (из кэша каталога)"""
+        return self.catalog.get_all(self._load_all_doramas)
 
-    def search_doramas(self, query):
-        """Поиск дорам"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        search_pattern = f'%{query}%'
-        cursor.execute('''
-            SELECT d.dorama_code, d.title, d.release_year, d.genre,
-                   COUNT(e.id) as episode_count
-            FROM doramas d
-            LEFT JOIN episodes e ON d.dorama_code = e.dorama_code
-            WHERE d.title LIKE ? OR d.dorama_code LIKE ? OR d.genre LIKE ?
-            GROUP BY d.dorama_code
-            ORDER BY d.title
-            LIMIT 20
-        ''', (search_pattern, search_pattern, search_pattern))
-        
-        result = cursor.fetchall()
-        conn.close()
-        return result
+    def _load_all_doramas(self):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute('''
+                SELECT dorama_code, title, release_year, genre, rating, episode_count
+                FROM doramas
+                ORDER BY title, dorama_code
+            ''')
+
+            return cursor.fetchall()
+
+    def get_doramas_page(self, after=None, before=None, limit=CATALOG_PAGE_SIZE):
+        """Страница каталога по (title, dorama_code) без OFFSET: (строки, есть ли назад, есть ли вперед)
+
+        after - код последней дорамы предыдущей страницы, before - код первой дорамы следующей.
+        """
+        limit = max(1, min(limit, CATALOG_MAX_PAGE_SIZE))
+        columns = 'dorama_code, title, release_year, genre, rating, episode_count'
+
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+
+            anchor = None
+            if after or before:
+                cursor.execute('SELECT title, dorama_code FROM doramas WHERE dorama_code = ?', (after or before,))
+                anchor = cursor.fetchone()
+
+            # Якорную дораму успели удалить - начинаем с первой страницы
+            if anchor is None:
+                cursor.execute(f'SELECT {columns} FROM doramas ORDER BY title, dorama_code LIMIT ?', (limit + 1,))
+                rows = cursor.fetchall()
+                return rows[:limit], False, len(rows) > limit
+
+            if after:
+                cursor.execute(f'''
+                    SELECT {columns} FROM doramas
+                    WHERE (title, dorama_code) > (?, ?)
+                    ORDER BY title, dorama_code
+                    LIMIT ?
+                ''', (*anchor, limit + 1))
+                rows = cursor.fetchall()
+                return rows[:limit], True, len(rows) > limit
+
+            cursor.execute(f'''
+                SELECT {columns} FROM doramas
+                WHERE (title, dorama_code) < (?, ?)
+                ORDER BY title DESC, dorama_code DESC
+                LIMIT ?
+            ''', (*anchor, limit + 1))
+            rows = cursor.fetchall()
+            return rows[:limit][::-1], len(rows) > limit, True
+
+    def get_doramas_count(self):
+        """Количество дорам; пересчитывается только после изменения каталога"""
+        version = self.catalog.version
+        cached = self._doramas_count
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        with self.pool.connection() as conn:
+            count = conn.execute('SELECT COUNT(*) FROM doramas').fetchone()[0]
+        self._doramas_count = (version, count)
+        return count
+
+    def _refresh_catalog_entry(self, dorama_code):
+        """Перечитывает одну запись каталога после изменения дорамы или ее эпизодов"""
+        with self.pool.connection() as conn:
+            record = conn.execute('''
+                SELECT dorama_code, title, release_year, genre, rating, episode_count
+                FROM doramas
+                WHERE dorama_code = ?
+            ''', (dorama_code,)).fetchone()
+        self.catalog.patch(dorama_code, record)
+
+    def get_recent_doramas(self, limit=10):
+        """Получает недавно добавленные дорамы"""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute('''
+                SELECT dorama_code, title, release_year, genre, rating, episode_count
+                FROM doramas
+                ORDER BY created_date DESC, id DESC
+                LIMIT ?
+            ''', (limit,))
+
+            return cursor.fetchall()
+
+    @staticmethod
+    def _fts_query(query):
+        """Превращает пользовательский ввод в запрос FTS5: все слова, с префиксным поиском"""
+        terms = re.findall(r'\w+', query.lower())
+        return ' '.join(f'"{term}"*' for term in terms[:8])
+
+    def search_doramas(self, query, limit=20):
+        """Поиск дорам: полнотекстовый индекс, а если он ничего не нашел - нечеткий поиск.
+
+        Возвращает (строки, источник, сходство): источник - SEARCH_FTS, SEARCH_EXACT или
+        SEARCH_FUZZY, сходство - лучшая оценка нечеткого поиска (для остальных 1.0)
+        """
+        result = self._search_fts(query, limit)
+        if result:
+            return result, SEARCH_FTS, 1.0
+
+        exact = self.search_index.find_code(query)
+        if exact:
+            return self._load_search_rows([exact]), SEARCH_EXACT, 1.0
+
+        matches = self.search_index.search(query, limit)
+        if not matches:
+            return [], SEARCH_FUZZY, 0.0
+        return self._load_search_rows([code for code, score in matches]), SEARCH_FUZZY, matches[0][1]
+
+    def _load_search_rows(self, codes):
+        """Строки дорам для найденных кодов в порядке кодов"""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            placeholders = ', '.join('?' * len(codes))
+            cursor.execute(f'''
+                SELECT dorama_code, title, release_year, genre, episode_count
+                FROM doramas
+                WHERE dorama_code IN ({placeholders})
+            ''', codes)
+            rows = {row[0]: row for row in cursor.fetchall()}
+
+        # Сохраняем порядок по сходству
+        return [rows[code] for code in codes if code in rows]
+
+    def _search_fts(self, query, limit):
+        """Поиск по полнотекстовому индексу с ранжированием bm25"""
+        match = self._fts_query(query)
+        if not match:
+            return []
+
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+
+            # Веса bm25 по колонкам: title, description, genre, dorama_code
+            cursor.execute('''
+                SELECT d.dorama_code, d.title, d.release_year, d.genre, d.episode_count
+                FROM doramas_fts
+                JOIN doramas d ON d.id = doramas_fts.rowid
+                WHERE doramas_fts MATCH ?
+                ORDER BY bm25(doramas_fts, 10.0, 1.0, 3.0, 8.0)
+                LIMIT ?
+            ''', (match, limit))
+
+            return cursor.fetchall()
 
     def delete_dorama(self, dorama_code):
         """Удаляет дораму и все её эпизоды"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        try:
-            # Сначала удаляем эпизоды
-            cursor.execute('DELETE FROM episodes WHERE dorama_code = ?', (dorama_code,))
-            # Затем удаляем дораму
-            cursor.execute('DELETE FROM doramas WHERE dorama_code = ?', (dorama_code,))
-            
-            conn.commit()
-            logger.info(f"✅ Дорама {dorama_code} удалена")
-            return True
-        except Exception as e:
-            logger.error(f"❌ Ошибка удаления дорамы: {e}")
-            return False
-        finally:
-            conn.close()
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+
+            try:
+                # Сначала удаляем эпизоды
+                cursor.execute('DELETE FROM episodes WHERE dorama_code = ?', (dorama_code,))
+                # Затем удаляем дораму
+                cursor.execute('DELETE FROM doramas WHERE dorama_code = ?', (dorama_code,))
+
+                conn.commit()
+                self.search_index.remove(dorama_code)
+                self.dorama_ids.remove(dorama_code)
+                self.catalog.patch(dorama_code, None)
+                self.episode_numbers.invalidate(dorama_code)
+                logger.info(f"✅ Дорама {dorama_code} удалена")
+                return True
+            except Exception as e:
+                logger.error(f"❌ Ошибка удаления дорамы: {e}")
+                return False
 
     # МЕТОДЫ ДЛЯ РАБОТЫ С ЭПИЗОДАМИ
     def add_episode(self, dorama_code, episode_number, file_id, caption="", duration=0, file_size=0):
         """Добавляет эпизод к дораме"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute('''
-                INSERT OR REPLACE INTO episodes 
-                (dorama_code, episode_number, file_id, caption, duration, file_size) 
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (dorama_code, episode_number, file_id, caption, duration, file_size))
-            
-            conn.commit()
-            logger.info(f"✅ Добавлен эпизод {episode_number} для дорамы {dorama_code}")
-            return True
-        except Exception as e:
-            logger.error(f"❌ Ошибка добавления эпизода: {e}")
-            return False
-        finally:
-            conn.close()
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+
+            try:
+                # UPSERT, а не REPLACE: REPLACE удаляет старую строку без триггера DELETE,
+                # и счетчики doramas.episode_count/total_views разошлись бы с эпизодами
+                cursor.execute('''
+                    INSERT INTO episodes
+                    (dorama_code, episode_number, file_id, caption, duration, file_size)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(dorama_code, episode_number) DO UPDATE SET
+                        file_id = excluded.file_id,
+                        caption = excluded.caption,
+                        duration = excluded.duration,
+                        file_size = excluded.file_size
+                ''', (dorama_code, episode_number, file_id, caption, duration, file_size))
+                conn.commit()
+                self._refresh_catalog_entry(dorama_code)
+                self.episode_numbers.invalidate(dorama_code)
+                logger.info(f"✅ Добавлен эпизод {episode_number} для дорамы {dorama_code}")
+                return True
+            except Exception as e:
+                logger.error(f"❌ Ошибка добавления эпизода: {e}")
+                return False
 
     def get_episode(self, dorama_code, episode_number):
         """Получает информацию об эпизоде"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT e.episode_number, e.file_id, e.caption, e.duration, e.file_size, e.views,
-                   d.title, d.dorama_code
-            FROM episodes e
-            JOIN doramas d ON e.dorama_code = d.dorama_code
-            WHERE e.dorama_code = ? AND e.episode_number = ?
-        ''', (dorama_code, episode_number))
-        
-        result = cursor.fetchone()
-        conn.close()
-        return result
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute('''
+                SELECT e.episode_number, e.file_id, e.caption, e.duration, e.file_size, e.views,
+                       d.title, d.dorama_code
+                FROM episodes e
+                JOIN doramas d ON e.dorama_code = d.dorama_code
+                WHERE e.dorama_code = ? AND e.episode_number = ?
+            ''', (dorama_code, episode_number))
+
+            return cursor.fetchone()
 
     def get_all_episodes(self, dorama_code):
         """Получает все эпизоды дорамы"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT episode_number, file_id, caption, duration, file_size, views
-            FROM episodes 
-            WHERE dorama_code = ?
-            ORDER BY episode_number
-        ''', (dorama_code,))
-        
-        result = cursor.fetchall()
-        conn.close()
-        return result
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute('''
+                SELECT episode_number, file_id, caption, duration, file_size, views
+                FROM episodes
+                WHERE dorama_code = ?
+                ORDER BY episode_number
+            ''', (dorama_code,))
+
+            return cursor.fetchall()
+
+    def get_episode_numbers(self, dorama_code):
+        """Номера эпизодов дорамы по порядку (из кэша или узким запросом по индексу)"""
+        numbers = self.episode_numbers.get(dorama_code)
+        if numbers is None:
+            numbers = self._load_episode_numbers(dorama_code)
+        return numbers
+
+    def _load_episode_numbers(self, dorama_code):
+        version = self.episode_numbers.version
+        with self.pool.connection() as conn:
+            # Только номера: запрос читается из индекса UNIQUE(dorama_code, episode_number), без file_id и подписей
+            rows = conn.execute(
+                'SELECT episode_number FROM episodes WHERE dorama_code = ? ORDER BY episode_number',
+                (dorama_code,)
+            ).fetchall()
+        numbers = array('i', (row[0] for row in rows))
+        self.episode_numbers.put(dorama_code, numbers, version)
+        return numbers
+
+    @staticmethod
+    def paginate_episode_numbers(numbers, page, per_page):
+        """Номера эпизодов одной страницы и общее количество"""
+        start = max(page, 0) * per_page
+        return numbers[start:start + per_page].tolist(), len(numbers)
+
+    def get_episode_numbers_page(self, dorama_code, page=0, per_page=15):
+        """Страница номеров эпизодов: (номера, всего эпизодов)"""
+        return self.paginate_episode_numbers(self.get_episode_numbers(dorama_code), page, per_page)
+
+    def get_episodes_after(self, dorama_code, after_episode, limit):
+        """Следующие эпизоды после курсора: (номер, file_id, подпись)"""
+        with self.pool.connection() as conn:
+            return conn.execute('''
+                SELECT episode_number, file_id, caption
+                FROM episodes
+                WHERE dorama_code = ? AND episode_number > ?
+                ORDER BY episode_number
+                LIMIT ?
+            ''', (dorama_code, after_episode, limit)).fetchall()
 
     def get_total_episodes(self, dorama_code):
         """Получает общее количество эпизодов"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT COUNT(*) FROM episodes WHERE dorama_code = ?', (dorama_code,))
-        result = cursor.fetchone()[0]
-        conn.close()
-        return result
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute('SELECT episode_count FROM doramas WHERE dorama_code = ?', (dorama_code,))
+            result = cursor.fetchone()
+        return result[0] if result else 0
 
     def delete_episode(self, dorama_code, episode_number):
         """Удаляет эпизод"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute('DELETE FROM episodes WHERE dorama_code = ? AND episode_number = ?', 
-                         (dorama_code, episode_number))
-            conn.commit()
-            logger.info(f"✅ Эпизод {episode_number} дорамы {dorama_code} удален")
-            return True
-        except Exception as e:
-            logger.error(f"❌ Ошибка удаления эпизода: {e}")
-            return False
-        finally:
-            conn.close()
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
 
-    def increment_views(self, dorama_code, episode_number):
-        """Увеличивает счетчик просмотров"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE episodes SET views = views + 1 
-            WHERE dorama_code = ? AND episode_number = ?
-        ''', (dorama_code, episode_number))
-        conn.commit()
-        conn.close()
+            try:
+                cursor.execute('DELETE FROM episodes WHERE dorama_code = ? AND episode_number = ?',
+                             (dorama_code, episode_number))
+                conn.commit()
+                self._refresh_catalog_entry(dorama_code)
+                self.episode_numbers.invalidate(dorama_code)
+                logger.info(f"✅ Эпизод {episode_number} дорамы {dorama_code} удален")
+                return True
+            except Exception as e:
+                logger.error(f"❌ Ошибка удаления эпизода: {e}")
+                return False
+
+    def increment_views(self, dorama_code, episode_number, count=1):
+        """Увеличивает счетчик просмотров (через буфер, см. flush_counters)"""
+        return self.counters.add_views(dorama_code, episode_number, count)
 
     # ПОЛЬЗОВАТЕЛИ
     def add_user(self, user_id, username=None, first_name=None, last_name=None):
         """Добавляет пользователя"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute(
-            'INSERT OR IGNORE INTO users (user_id, username, first_name, last_name) VALUES (?, ?, ?, ?)',
-            (user_id, username, first_name, last_name)
-        )
-        conn.commit()
-        conn.close()
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'INSERT OR IGNORE INTO users (user_id, username, first_name, last_name) VALUES (?, ?, ?, ?)',
+                (user_id, username, first_name, last_name)
+            )
+            conn.commit()
 
     def update_user_activity(self, user_id):
-        """Обновляет активность пользователя"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute(
-            'UPDATE users SET last_activity = CURRENT_TIMESTAMP, total_requests = total_requests + 1 WHERE user_id = ?',
-            (user_id,)
-        )
-        conn.commit()
-        conn.close()
+        """Обновляет активность пользователя (через буфер, см. flush_counters)"""
+        return self.counters.touch_user(user_id)
+
+    def record_watch(self, user_id, dorama_code):
+        """Запоминает, что пользователь смотрел дораму (через буфер, см. flush_counters)"""
+        return self.counters.add_watch(user_id, dorama_code)
+
+    def flush_counters(self):
+        """Записывает накопленные просмотры и активность одной транзакцией"""
+        views, activity, watches, events = self.counters.drain()
+        if not views and not activity and not watches:
+            return 0
+
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.executemany(
+                    'UPDATE episodes SET views = views + ? WHERE dorama_code = ? AND episode_number = ?',
+                    [(count, code, number) for (code, number), count in views.items()]
+                )
+                cursor.executemany(
+                    '''
+                    UPDATE users SET last_activity = ?, total_requests = total_requests + ?,
+                                     is_reachable = TRUE, unreachable_at = NULL
+                    WHERE user_id = ?
+                    ''',
+                    [(last_activity, requests, user_id) for user_id, (requests, last_activity) in activity.items()]
+                )
+                cursor.executemany(
+                    '''
+                    INSERT INTO user_views (dorama_code, user_id, last_viewed) VALUES (?, ?, ?)
+                    ON CONFLICT (dorama_code, user_id) DO UPDATE SET last_viewed = excluded.last_viewed
+                    ''',
+                    [(code, user_id, last_viewed) for (code, user_id), last_viewed in watches.items()]
+                )
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                self.counters.restore(views, activity, watches, events)
+                logger.error(f"❌ Ошибка записи счетчиков: {e}")
+                return 0
+
+        rows = len(views) + len(activity) + len(watches)
+        self.counters.record_flush(rows, events)
+        return rows
 
     def get_all_users(self):
         """Получает всех пользователей"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('SELECT user_id, username, first_name, last_name FROM users')
-        result = cursor.fetchall()
-        conn.close()
-        return result
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT user_id, username, first_name, last_name FROM users')
+            return cursor.fetchall()
+
+    def get_users_count(self):
+        """Получает количество достижимых пользователей"""
+        with self.pool.connection() as conn:
+            return conn.execute('''
+                SELECT (SELECT COUNT(*) FROM users) - (SELECT COUNT(*) FROM users WHERE is_reachable = FALSE)
+            ''').fetchone()[0]
+
+    def get_user_ids_after(self, after_user_id, limit, active_days=None, dorama_code=None):
+        """Следующая страница достижимых user_id сегмента (keyset по user_id, без OFFSET)
+
+        Сегмент не материализуется целиком: каждая страница - короткий диапазон по ключу.
+        active_days - только активные за последние N дней, dorama_code - только зрители дорамы.
+        """
+        params = [after_user_id]
+        if dorama_code:
+            # Диапазон первичного ключа user_views, users - поиск по rowid
+            sql = '''
+                SELECT v.user_id FROM user_views v JOIN users u ON u.user_id = v.user_id
+                WHERE v.dorama_code = ? AND v.user_id > ? AND u.is_reachable
+            '''
+            params.insert(0, dorama_code)
+            order = 'v.user_id'
+        else:
+            sql = 'SELECT u.user_id FROM users u WHERE u.user_id > ? AND u.is_reachable'
+            order = 'u.user_id'
+        if active_days:
+            sql += " AND u.last_activity >= datetime('now', ?)"
+            params.append(f'-{int(active_days)} days')
+        sql += f' ORDER BY {order} LIMIT ?'
+        params.append(limit)
+
+        with self.pool.connection() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        return [row[0] for row in rows]
+
+    def get_segment_count(self, active_days=None, dorama_code=None, reachable=True):
+        """Размер сегмента рассылки (для пробного запуска и прогресса).
+
+        reachable=False - сколько недостижимых пользователей сегмента рассылка пропустит
+        """
+        reachable_sql = 'u.is_reachable' if reachable else 'u.is_reachable = FALSE'
+        if not active_days and not dorama_code:
+            if reachable:
+                return self.get_users_count()
+            with self.pool.connection() as conn:
+                # SEARCH users USING COVERING INDEX idx_users_unreachable
+                return conn.execute('SELECT COUNT(*) FROM users WHERE is_reachable = FALSE').fetchone()[0]
+        params = []
+        if dorama_code:
+            sql = f'''
+                SELECT COUNT(*) FROM user_views v JOIN users u ON u.user_id = v.user_id
+                WHERE v.dorama_code = ? AND {reachable_sql}
+            '''
+            params.append(dorama_code)
+        else:
+            # SEARCH users USING INDEX idx_users_last_activity (last_activity>?)
+            sql = f'SELECT COUNT(*) FROM users u WHERE {reachable_sql}'
+        if active_days:
+            sql += " AND u.last_activity >= datetime('now', ?)"
+            params.append(f'-{int(active_days)} days')
+        with self.pool.connection() as conn:
+            return conn.execute(sql, params).fetchone()[0]
+
+    def mark_users_unreachable(self, user_ids):
+        """Помечает пользователей, которые заблокировали бота или удалили аккаунт"""
+        if not user_ids:
+            return
+        with self.pool.connection() as conn:
+            conn.executemany(
+                'UPDATE users SET is_reachable = FALSE, unreachable_at = CURRENT_TIMESTAMP WHERE user_id = ? AND is_reachable',
+                [(user_id,) for user_id in user_ids]
+            )
+            conn.commit()
+
+    def get_unreachable_stats(self):
+        """Недостижимые пользователи и сколько отправок рассылок на них уже сэкономлено"""
+        with self.pool.connection() as conn:
+            unreachable = conn.execute('SELECT COUNT(*) FROM users WHERE is_reachable = FALSE').fetchone()[0]
+            # broadcasts.skipped - недостижимые пользователи сегмента, пропущенные при запуске рассылки
+            saved_sends = conn.execute('SELECT COALESCE(SUM(skipped), 0) FROM broadcasts').fetchone()[0]
+        return unreachable, saved_sends
 
     def get_active_users_count(self):
         """Получает количество активных пользователей (за последние 30 дней)"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM users WHERE last_activity >= datetime("now", "-30 days")')
-        result = cursor.fetchone()[0]
-        conn.close()
-        return result
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM users WHERE last_activity >= datetime('now', '-30 days') AND is_reachable")
+            return cursor.fetchone()[0]
 
     def get_admin_stats(self):
         """Получает статистику для админов"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Общее количество дорам
-        cursor.execute('SELECT COUNT(*) FROM doramas')
-        total_doramas = cursor.fetchone()[0]
-        
-        # Общее количество эпизодов
-        cursor.execute('SELECT COUNT(*) FROM episodes')
-        total_episodes = cursor.fetchone()[0]
-        
-        # Общее количество пользователей
-        cursor.execute('SELECT COUNT(*) FROM users')
-        total_users = cursor.fetchone()[0]
-        
-        # Самые популярные дорамы (по просмотрам)
-        cursor.execute('''
-            SELECT d.title, d.dorama_code, SUM(e.views) as total_views
-            FROM doramas d
-            JOIN episodes e ON d.dorama_code = e.dorama_code
-            GROUP BY d.dorama_code
-            ORDER BY total_views DESC
-            LIMIT 5
-        ''')
-        popular_doramas = cursor.fetchall()
-        
-        # Количество активных пользователей за сегодня
-        cursor.execute('''
-            SELECT COUNT(DISTINCT user_id) FROM users 
-            WHERE DATE(last_activity) = DATE("now")
-        ''')
-        daily_active = cursor.fetchone()[0]
-        
-        conn.close()
-        
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+
+            # Общее количество дорам
+            cursor.execute('SELECT COUNT(*) FROM doramas')
+            total_doramas = cursor.fetchone()[0]
+
+            # Общее количество эпизодов
+            cursor.execute('SELECT COUNT(*) FROM episodes')
+            total_episodes = cursor.fetchone()[0]
+
+            # Общее количество пользователей (без заблокировавших бота)
+            cursor.execute('''
+                SELECT (SELECT COUNT(*) FROM users) - (SELECT COUNT(*) FROM users WHERE is_reachable = FALSE)
+            ''')
+            total_users = cursor.fetchone()[0]
+
+            # Самые популярные дорамы (по просмотрам)
+            cursor.execute('''
+                SELECT title, dorama_code, total_views
+                FROM doramas
+                WHERE episode_count > 0
+                ORDER BY total_views DESC
+                LIMIT 5
+            ''')
+            popular_doramas = cursor.fetchall()
+
+            # Количество активных пользователей за сегодня
+            # Диапазонное условие вместо DATE(last_activity), чтобы работал индекс
+            cursor.execute('''
+                SELECT COUNT(*) FROM users
+                WHERE last_activity >= DATE('now') AND is_reachable
+            ''')
+            daily_active = cursor.fetchone()[0]
+
         return {
             'total_doramas': total_doramas,
             'total_episodes': total_episodes,
@@ -402,163 +1660,757 @@ class Database:
         }
 
     # МЕТОДЫ ДЛЯ РАБОТЫ С КАНАЛАМИ
+    def reload_config(self):
+        """Перечитывает каналы и настройки в кэш конфигурации"""
+        with self.pool.connection() as conn:
+            channels = conn.execute('''
+                SELECT channel_id, username, title, invite_link, is_private, fail_open
+                FROM channels WHERE is_active = TRUE
+            ''').fetchall()
+            settings = conn.execute('SELECT key, value FROM bot_settings').fetchall()
+        self.config.load(channels, settings)
+
     def get_all_channels(self):
         """Получает все каналы"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('SELECT channel_id, username, title, invite_link, is_private FROM channels WHERE is_active = TRUE')
-        result = cursor.fetchall()
-        conn.close()
-        return result
-    
+        return self.config.channels()
+
+    def get_channel(self, channel_id):
+        """Получает активный канал по ID (None - канала нет)"""
+        return self.config.channel(channel_id)
+
     def add_channel(self, channel_id, username="", title=None, invite_link=None, is_private=False):
         """Добавляет канал в базу данных"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        try:
-            cursor.execute(
-                'INSERT OR REPLACE INTO channels (channel_id, username, title, invite_link, is_private) VALUES (?, ?, ?, ?, ?)',
-                (channel_id, username, title, invite_link, is_private)
-            )
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                # UPSERT, а не REPLACE: повторное добавление канала не сбрасывает его политику fail_open
+                cursor.execute('''
+                    INSERT INTO channels (channel_id, username, title, invite_link, is_private)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(channel_id) DO UPDATE SET
+                        username = excluded.username,
+                        title = excluded.title,
+                        invite_link = excluded.invite_link,
+                        is_private = excluded.is_private,
+                        is_active = TRUE
+                ''', (channel_id, username, title, invite_link, is_private))
+                conn.commit()
+            except Exception as e:
+                logger.error(f"❌ Kanal qoshishda xato: {e}")
+                return False
+        self.reload_config()
+        return True
+
+    def set_channel_fail_open(self, channel_id, fail_open):
+        """Задает политику канала на случай ошибки проверки подписки"""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('UPDATE channels SET fail_open = ? WHERE channel_id = ?', (fail_open, channel_id))
             conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"❌ Kanal qoshishda xato: {e}")
-            return False
-        finally:
-            conn.close()
-    
+            updated = cursor.rowcount > 0
+        self.reload_config()
+        return updated
+
     def delete_channel(self, channel_id):
         """Удаляет канал из базы данных"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute('DELETE FROM channels WHERE channel_id = ?', (channel_id,))
+                cursor.execute('DELETE FROM channel_memberships WHERE channel_id = ?', (channel_id,))
+                conn.commit()
+            except Exception as e:
+                logger.error(f"❌ Kanalni ochirishda xato: {e}")
+                return False
+        self.memberships.drop_channel(channel_id)
+        self.reload_config()
+        return True
+
+    # МЕТОДЫ ДЛЯ ЗЕРКАЛА ПОДПИСОК
+    def load_channel_memberships(self):
+        """Загружает известные статусы подписки в память"""
+        with self.pool.connection() as conn:
+            rows = conn.execute('''
+                SELECT user_id, channel_id, status, CAST(strftime('%s', updated_at) AS INTEGER)
+                FROM channel_memberships
+            ''').fetchall()
+        self.memberships.load(rows)
+        logger.info(f"✅ Зеркало подписок загружено: {len(rows)} записей")
+
+    def save_channel_membership(self, user_id, channel_id, status):
+        """Сохраняет статус пользователя в канале"""
+        with self.pool.connection() as conn:
+            conn.execute('''
+                INSERT INTO channel_memberships (channel_id, user_id, status)
+                VALUES (?, ?, ?)
+                ON CONFLICT(channel_id, user_id) DO UPDATE SET
+                    status = excluded.status,
+                    updated_at = CURRENT_TIMESTAMP
+            ''', (channel_id, user_id, status))
+            conn.commit()
+
+    def set_channel_membership(self, user_id, channel_id, status):
+        """Обновляет статус пользователя в канале: в зеркале и в таблице"""
+        self.memberships.set(user_id, channel_id, status not in ['left', 'kicked'])
+        self.save_channel_membership(user_id, channel_id, status)
+
+    # МЕТОДЫ ДЛЯ РАБОТЫ С ЗАЯВКАМИ
+    def add_channel_request(self, user_id, channel_id, status='pending'):
+        """Добавляет или обновляет заявку на вступление в канал"""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute('''
+                    INSERT OR REPLACE INTO channel_requests
+                    (user_id, channel_id, status, updated_at)
+                    VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                ''', (user_id, channel_id, status))
+                conn.commit()
+                return True
+            except Exception as e:
+                logger.error(f"❌ So'rov qoshishda xato: {e}")
+                return False
+
+    def get_channel_request(self, user_id, channel_id):
+        """Получает информацию о заявке пользователя"""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'SELECT status, created_at FROM channel_requests WHERE user_id = ? AND channel_id = ?',
+                (user_id, channel_id)
+            )
+            return cursor.fetchone()
+
+    def get_channel_requests(self, user_id, channel_ids):
+        """Статусы заявок пользователя сразу по нескольким каналам: {channel_id: status}"""
+        if not channel_ids:
+            return {}
+        placeholders = ','.join('?' * len(channel_ids))
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f'SELECT channel_id, status FROM channel_requests WHERE user_id = ? AND channel_id IN ({placeholders})',
+                (user_id, *channel_ids)
+            )
+            return dict(cursor.fetchall())
+
+    def get_pending_requests_count(self, channel_id=None):
+        """Получает количество ожидающих заявок"""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+
+            if channel_id:
+                cursor.execute(
+                    "SELECT COUNT(*) FROM channel_requests WHERE status = 'pending' AND channel_id = ?",
+                    (channel_id,)
+                )
+            else:
+                cursor.execute("SELECT COUNT(*) FROM channel_requests WHERE status = 'pending'")
+
+            return cursor.fetchone()[0]
+
+    def update_channel_request_status(self, user_id, channel_id, status):
+        """Обновляет статус заявки"""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute('''
+                    UPDATE channel_requests
+                    SET status = ?, updated_at = CURRENT_TIMESTAMP
+                    WHERE user_id = ? AND channel_id = ?
+                ''', (status, user_id, channel_id))
+                conn.commit()
+                return cursor.rowcount > 0
+            except Exception as e:
+                logger.error(f"❌ So'rov yangilashda xato: {e}")
+                return False
+
+    # МЕТОДЫ ДЛЯ ОЧЕРЕДИ ДОСТАВКИ
+    def create_delivery_job(self, chat_id, dorama_code, total, progress_message_id=None):
+        """Создает задание на доставку эпизодов и возвращает его ID"""
+        with self.pool.connection() as conn:
+            cursor = conn.execute('''
+                INSERT INTO delivery_jobs (chat_id, dorama_code, total, progress_message_id)
+                VALUES (?, ?, ?, ?)
+            ''', (chat_id, dorama_code, total, progress_message_id))
+            conn.commit()
+            return cursor.lastrowid
+
+    def find_active_delivery_job(self, chat_id, dorama_code):
+        """ID незавершенного задания этого чата на эту дораму (None - такого нет)"""
+        with self.pool.connection() as conn:
+            row = conn.execute('''
+                SELECT id FROM delivery_jobs
+                WHERE status IN ('pending', 'running') AND chat_id = ? AND dorama_code = ?
+            ''', (chat_id, dorama_code)).fetchone()
+        return row[0] if row else None
+
+    def get_delivery_job(self, job_id):
+        """Получает задание доставки"""
+        with self.pool.connection() as conn:
+            return conn.execute('''
+                SELECT id, chat_id, dorama_code, status, cursor, sent, total, progress_message_id
+                FROM delivery_jobs WHERE id = ?
+            ''', (job_id,)).fetchone()
+
+    def get_unfinished_delivery_jobs(self):
+        """Задания, прерванные остановкой бота или ожидающие очереди, по порядку создания"""
+        with self.pool.connection() as conn:
+            return conn.execute('''
+                SELECT id, chat_id FROM delivery_jobs
+                WHERE status IN ('pending', 'running')
+                ORDER BY id
+            ''').fetchall()
+
+    def update_delivery_job(self, job_id, status=None, cursor=None, sent=None, error=None):
+        """Сохраняет статус и курсор задания"""
+        with self.pool.connection() as conn:
+            conn.execute('''
+                UPDATE delivery_jobs SET
+                    status = COALESCE(?, status),
+                    cursor = COALESCE(?, cursor),
+                    sent = COALESCE(?, sent),
+                    error = COALESCE(?, error),
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (status, cursor, sent, error, job_id))
+            conn.commit()
+
+    # МЕТОДЫ ДЛЯ РАССЫЛОК
+    def create_broadcast(self, admin_chat_id, from_chat_id, message_id, progress_message_id, total,
+                         active_days=None, dorama_code=None, skipped=0):
+        """Создает рассылку и возвращает ее ID"""
+        with self.pool.connection() as conn:
+            cursor = conn.execute('''
+                INSERT INTO broadcasts (admin_chat_id, from_chat_id, message_id, progress_message_id, total,
+                                        active_days, dorama_code, skipped)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (admin_chat_id, from_chat_id, message_id, progress_message_id, total, active_days, dorama_code,
+                  skipped))
+            conn.commit()
+            return cursor.lastrowid
+
+    def get_broadcast(self, broadcast_id):
+        """Получает рассылку"""
+        with self.pool.connection() as conn:
+            return conn.execute('''
+                SELECT id, admin_chat_id, from_chat_id, message_id, progress_message_id,
+                       status, cursor, total, sent, failed, unreachable, elapsed, active_days, dorama_code
+                FROM broadcasts WHERE id = ?
+            ''', (broadcast_id,)).fetchone()
+
+    def get_running_broadcasts(self):
+        """ID рассылок, прерванных остановкой бота"""
+        with self.pool.connection() as conn:
+            rows = conn.execute("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id").fetchall()
+        return [row[0] for row in rows]
+
+    def update_broadcast(self, broadcast_id, cursor, sent, failed, unreachable, elapsed, status='running'):
+        """Сохраняет курсор и счетчики рассылки"""
+        with self.pool.connection() as conn:
+            conn.execute('''
+                UPDATE broadcasts SET
+                    cursor = ?, sent = ?, failed = ?, unreachable = ?, elapsed = ?, status = ?,
+                    finished_at = CASE WHEN ? = 'running' THEN NULL ELSE CURRENT_TIMESTAMP END
+                WHERE id = ?
+            ''', (cursor, sent, failed, unreachable, elapsed, status, status, broadcast_id))
+            conn.commit()
+
+    # МЕТОДЫ ДЛЯ НАСТРОЕК
+    def get_setting(self, key):
+        """Получает значение настройки"""
+        return self.config.setting(key)
+
+    def update_setting(self, key, value):
+        """Обновляет значение настройки"""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('INSERT OR REPLACE INTO bot_settings (key, value) VALUES (?, ?)', (key, value))
+            conn.commit()
+        self.reload_config()
+        return True
+
+class AsyncDatabase:
+    """Асинхронный фасад над Database: запросы выполняются в отдельном потоке"""
+
+    def __init__(self, database, max_queue=DB_QUEUE_SIZE):
+        self.database = database
+        self.dorama_ids = database.dorama_ids  # читается при каждом нажатии - без __getattr__
+        self.max_queue = max(1, max_queue)
+        self._queue = queue.Queue()
+        self._slots = None
+        self._lock = threading.Lock()
+
+        # Метрики очереди
+        self.depth = 0
+        self.max_depth = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_exec = 0.0
+
+        self._flush_requested = None
+        self._flusher = None
+
+        self._thread = threading.Thread(target=self._worker, name='db-executor', daemon=True)
+        self._thread.start()
+
+    def __getattr__(self, name):
+        attr = getattr(self.database, name)
+        if not callable(attr):
+            return attr
+
+        async def call(*args, **kwargs):
+            return await self.run(attr, *args, **kwargs)
+
+        call.__name__ = name
+        call.__doc__ = attr.__doc__
+        setattr(self, name, call)
+        return call
+
+    async def run(self, func, *args, **kwargs):
+        """Ставит вызов в очередь потока базы и ждет результат"""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_queue)
+
+        loop = asyncio.get_running_loop()
+        requested = time.perf_counter()
+        async with self._slots:
+            future = loop.create_future()
+            with self._lock:
+                self.depth += 1
+                self.max_depth = max(self.max_depth, self.depth)
+            self._queue.put((func, args, kwargs, future, loop, requested))
+            return await future
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            func, args, kwargs, future, loop, requested = item
+            started = time.perf_counter()
+            result, error = None, None
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                error = e
+            finished = time.perf_counter()
+
+            wait = started - requested
+            with self._lock:
+                self.depth -= 1
+                self.completed += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                self.total_exec += finished - started
+
+            try:
+                loop.call_soon_threadsafe(self._resolve, future, result, error)
+            except RuntimeError:
+                # Цикл событий уже закрыт - результат некому отдавать
+                pass
+
+        self.database.pool.release_thread()
+
+    # Буферизованные счетчики не обращаются к SQLite и выполняются прямо в цикле событий
+    async def increment_views(self, dorama_code, episode_number, count=1):
+        """Увеличивает счетчик просмотров"""
+        if self.database.increment_views(dorama_code, episode_number, count):
+            self.request_flush()
+
+    async def update_user_activity(self, user_id):
+        """Обновляет активность пользователя"""
+        if self.database.update_user_activity(user_id):
+            self.request_flush()
+
+    async def record_watch(self, user_id, dorama_code):
+        """Запоминает, что пользователь смотрел дораму"""
+        if self.database.record_watch(user_id, dorama_code):
+            self.request_flush()
+
+    # Каналы и настройки отдаются из кэша конфигурации, без очереди к SQLite
+    async def get_all_channels(self):
+        """Получает все каналы"""
+        return self.database.get_all_channels()
+
+    async def get_channel(self, channel_id):
+        """Получает активный канал по ID"""
+        return self.database.get_channel(channel_id)
+
+    async def get_setting(self, key):
+        """Получает значение настройки"""
+        return self.database.get_setting(key)
+
+    async def get_episode_numbers_page(self, dorama_code, page=0, per_page=15):
+        """Страница номеров эпизодов: из кэша сразу, при промахе - через очередь"""
+        numbers = self.database.episode_numbers.get(dorama_code)
+        if numbers is None:
+            numbers = await self.run(self.database._load_episode_numbers, dorama_code)
+        return Database.paginate_episode_numbers(numbers, page, per_page)
+
+    # Зеркало подписок живет в памяти: читаем и обновляем его сразу, в таблицу пишем через очередь
+    async def get_membership(self, user_id, channel_id, max_age=None):
+        """Известен ли статус подписки: True/False или None (в том числе подписка старше max_age)"""
+        return self.database.memberships.get(user_id, channel_id, max_age)
+
+    async def peek_membership(self, user_id, channel_id):
+        """Статус из зеркала без учета срока и без метрик"""
+        return self.database.memberships.peek(user_id, channel_id)
+
+    async def set_channel_membership(self, user_id, channel_id, status):
+        """Обновляет статус пользователя в канале"""
+        self.database.memberships.set(user_id, channel_id, status not in ['left', 'kicked'])
+        await self.run(self.database.save_channel_membership, user_id, channel_id, status)
+
+    def request_flush(self):
+        """Будит фоновый сброс счетчиков раньше срока"""
+        if self._flush_requested is not None:
+            self._flush_requested.set()
+
+    def start_flusher(self, interval=COUNTER_FLUSH_INTERVAL):
+        """Запускает периодический сброс буфера счетчиков"""
+        self._flush_requested = asyncio.Event()
+        self._flusher = asyncio.create_task(self._flush_loop(interval))
+
+    async def _flush_loop(self, interval):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            try:
+                await self.flush_counters()
+            except Exception as e:
+                logger.error(f"❌ Ошибка фонового сброса счетчиков: {e}")
+
+    @staticmethod
+    def _resolve(future, result, error):
+        if future.cancelled():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def stats(self):
+        """Метрики очереди: глубина и время ожидания"""
+        with self._lock:
+            completed = self.completed or 1
+            return {
+                'depth': self.depth,
+                'max_depth': self.max_depth,
+                'completed': self.completed,
+                'avg_wait_ms': round(self.total_wait / completed * 1000, 3),
+                'max_wait_ms': round(self.max_wait * 1000, 3),
+                'avg_exec_ms': round(self.total_exec / completed * 1000, 3),
+            }
+
+    async def close(self):
+        """Сбрасывает буфер счетчиков, дожидается выполнения очереди и закрывает соединения"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        await self.flush_counters()
+
+        self._queue.put(None)
+        await asyncio.get_running_loop().run_in_executor(None, self._thread.join)
+        self.database.close()
+
+# СОЗДАЕМ ОБЪЕКТ БАЗЫ ДАННЫХ
+database = Database()
+db = AsyncDatabase(database)
+register_metrics('db_queue', db.stats)
+register_metrics('write_behind', database.counters.stats)
+register_metrics('catalog', database.catalog.stats)
+register_metrics('memberships', database.memberships.stats)
+register_metrics('config', database.config.stats)
+register_metrics('episode_numbers', database.episode_numbers.stats)
+
+# ОГРАНИЧЕНИЕ ИСХОДЯЩИХ ЗАПРОСОВ
+INTERACTIVE = 'interactive'  # ответы пользователю - по умолчанию
+BULK = 'bulk'                # рассылки и доставка серий: rate_limit_args=BULK
+
+def retry_after_seconds(error):
+    """RetryAfter.retry_after - число секунд или timedelta (в новых версиях библиотеки)"""
+    if isinstance(error.retry_after, datetime.timedelta):
+        return error.retry_after.total_seconds()
+    return float(error.retry_after)
+
+# Исход отправки конкретному пользователю
+SENT = 'sent'
+FORBIDDEN = 'forbidden'            # бот заблокирован, аккаунт удален - навсегда
+CHAT_NOT_FOUND = 'chat_not_found'  # чата больше нет - навсегда
+TRANSIENT = 'transient'            # сеть, флуд, прочие ошибки - попробуем в следующий раз
+
+def classify_send_error(error):
+    """Относит ошибку отправки к одному из классов: FORBIDDEN, CHAT_NOT_FOUND, TRANSIENT"""
+    if isinstance(error, Forbidden):
+        return FORBIDDEN
+    if isinstance(error, BadRequest) and 'chat not found' in str(error).lower():
+        return CHAT_NOT_FOUND
+    return TRANSIENT
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity про запас"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, cost=1):
+        """Сколько секунд ждать, пока наберется cost токенов (0 - можно сейчас)"""
+        self._refill(time.monotonic())
+        cost = min(cost, self.capacity)
+        return 0.0 if self.tokens >= cost else (cost - self.tokens) / self.rate
+
+    def take(self, cost=1):
+        self.tokens -= min(cost, self.capacity)
+
+    def is_full(self):
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """Общий планировщик исходящих сообщений: лимит на весь бот и на каждый чат
+
+    Пока в очереди есть хоть один интерактивный запрос, массовые (BULK) не получают
+    токены общего ведра. После RetryAfter все отправки встают на паузу, которую
+    назвал Telegram, и запрос повторяется.
+    """
+
+    # Ограничиваются только сообщения; getChatMember, answerCallbackQuery и т.п. идут сразу
+    THROTTLED_PREFIXES = ('send', 'forward', 'copy', 'edit')
+    CHAT_BURST = 3
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self, global_rate=RATE_LIMIT_GLOBAL, chat_rate=RATE_LIMIT_PER_CHAT,
+                 group_rate=RATE_LIMIT_GROUP_PER_MINUTE / 60, max_retries=RATE_LIMIT_MAX_RETRIES):
+        self.global_bucket = TokenBucket(global_rate, max(global_rate, MEDIA_GROUP_SIZE))
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._chats = {}
+        self._paused_until = 0.0
+        self._waiting = {INTERACTIVE: 0, BULK: 0}
+        self._waits = {INTERACTIVE: [0, 0.0, 0.0, 0.0], BULK: [0, 0.0, 0.0, 0.0]}  # кол-во, сумма, максимум, последнее
+        self.flood_waits = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.MAX_CHAT_BUCKETS:
+                # Полные ведра ничего не помнят - их можно выбросить
+                self._chats = {key: value for key, value in self._chats.items() if not value.is_full()}
+            is_group = not isinstance(chat_id, int) or chat_id < 0
+            bucket = TokenBucket(self.group_rate if is_group else self.chat_rate, self.CHAT_BURST)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _acquire(self, chat_id, priority, cost):
+        started = time.monotonic()
         try:
-            cursor.execute('DELETE FROM channels WHERE channel_id = ?', (channel_id,))
-            conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"❌ Kanalni ochirishda xato: {e}")
-            return False
+            if chat_id is not None:
+                bucket = self._chat_bucket(chat_id)
+                while (wait := bucket.delay()) > 0:
+                    await asyncio.sleep(wait)
+                bucket.take()
+
+            # Ожидающим общий токен запрос считается только после лимита своего чата:
+            # интерактивный запрос, упершийся в лимит чата, не должен тормозить рассылки
+            self._waiting[priority] += 1
+            try:
+                while True:
+                    wait = max(self._paused_until - time.monotonic(), self.global_bucket.delay(cost))
+                    if wait <= 0:
+                        if priority == INTERACTIVE or not self._waiting[INTERACTIVE]:
+                            self.global_bucket.take(cost)
+                            break
+                        # Токен есть, но его ждет интерактивный запрос - уступаем
+                        wait = 1 / self.global_bucket.rate
+                    await asyncio.sleep(wait)
+            finally:
+                self._waiting[priority] -= 1
         finally:
-            conn.close()
+            self._record_wait(priority, time.monotonic() - started)
 
-    # МЕТОДЫ ДЛЯ РАБОТЫ С ЗАЯВКАМИ
-    def add_channel_request(self, user_id, channel_id, status='pending'):
-        """Добавляет или обновляет заявку на вступление в канал"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def _record_wait(self, priority, waited):
+        stats = self._waits[priority]
+        stats[0] += 1
+        stats[1] += waited
+        stats[2] = max(stats[2], waited)
+        stats[3] = waited
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = BULK if rate_limit_args == BULK else INTERACTIVE
+        throttled = endpoint.startswith(self.THROTTLED_PREFIXES)
+        chat_id = data.get('chat_id')
         try:
-            cursor.execute('''
-                INSERT OR REPLACE INTO channel_requests 
-                (user_id, channel_id, status, updated_at) 
-                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-            ''', (user_id, channel_id, status))
-            conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"❌ So'rov qoshishda xato: {e}")
-            return False
-        finally:
-            conn.close()
-    
-    def get_channel_request(self, user_id, channel_id):
-        """Получает информацию о заявке пользователя"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute(
-            'SELECT status, created_at FROM channel_requests WHERE user_id = ? AND channel_id = ?',
-            (user_id, channel_id)
-        )
-        result = cursor.fetchone()
-        conn.close()
-        return result
-    
-    def get_pending_requests_count(self, channel_id=None):
-        """Получает количество ожидающих заявок"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        if channel_id:
-            cursor.execute(
-                'SELECT COUNT(*) FROM channel_requests WHERE status = "pending" AND channel_id = ?',
-                (channel_id,)
-            )
-        else:
-            cursor.execute('SELECT COUNT(*) FROM channel_requests WHERE status = "pending"')
-        
-        result = cursor.fetchone()[0]
-        conn.close()
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+        # Альбом расходует общий лимит как отдельные сообщения
+        cost = len(data.get('media') or ()) or 1
+
+        for attempt in range(self.max_retries + 1):
+            if throttled:
+                await self._acquire(chat_id, priority, cost)
+            elif (pause := self._paused_until - time.monotonic()) > 0:
+                await asyncio.sleep(pause)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                self.flood_waits += 1
+                retry_after = retry_after_seconds(e) + 0.1
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                logger.warning(f"⏳ Flood limit ({endpoint}): {retry_after:.1f}s kutamiz")
+
+    def stats(self):
+        result = {'flood_waits': self.flood_waits, 'chats': len(self._chats)}
+        for priority, (count, total, longest, last) in self._waits.items():
+            result[f'{priority}_waiting'] = self._waiting[priority]
+            result[f'{priority}_last_wait_ms'] = round(last * 1000, 1)
+            result[f'{priority}_avg_wait_ms'] = round(total / count * 1000, 1) if count else 0
+            result[f'{priority}_max_wait_ms'] = round(longest * 1000, 1)
         return result
-    
-    def update_channel_request_status(self, user_id, channel_id, status):
-        """Обновляет статус заявки"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        try:
-            cursor.execute('''
-                UPDATE channel_requests 
-                SET status = ?, updated_at = CURRENT_TIMESTAMP 
-                WHERE user_id = ? AND channel_id = ?
-            ''', (status, user_id, channel_id))
-            conn.commit()
-            return cursor.rowcount > 0
-        except Exception as e:
-            logger.error(f"❌ So'rov yangilashda xato: {e}")
-            return False
-        finally:
-            conn.close()
 
-    # МЕТОДЫ ДЛЯ НАСТРОЕК
-    def get_setting(self, key):
-        """Получает значение настройки"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('SELECT value FROM bot_settings WHERE key = ?', (key,))
-        result = cursor.fetchone()
-        conn.close()
-        return result[0] if result else None
-    
-    def update_setting(self, key, value):
-        """Обновляет значение настройки"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('INSERT OR REPLACE INTO bot_settings (key, value) VALUES (?, ?)', (key, value))
-        conn.commit()
-        conn.close()
-        return True
+rate_limiter = PriorityRateLimiter()
+register_metrics('rate_limiter', rate_limiter.stats)
 
-# СОЗДАЕМ ОБЪЕКТ БАЗЫ ДАННЫХ
-db = Database()
+# КЭШ ПРОВЕРОК ПОДПИСКИ
+class TTLCache:
+    """Ограниченный LRU-кэш, у каждой записи свой срок жизни"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()  # ключ -> (значение, момент истечения)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        value, expires_at = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl):
+        self._data[key] = (value, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': f"{self.hits / total:.1%}" if total else '-',
+        }
+
+# (user_id, channel_id) -> статус left/kicked из последнего ответа Bot API
+membership_cache = TTLCache(SUBSCRIPTION_CACHE_SIZE)
+register_metrics('subscription_cache', membership_cache.stats)
+
+# Сколько запросов get_chat_member бот держит в полете одновременно (на всех пользователей)
+subscription_check_slots = asyncio.Semaphore(SUBSCRIPTION_CHECK_CONCURRENCY)
 
 # ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ДЛЯ ПРОВЕРКИ ПОДПИСКИ
-async def check_subscription(user_id: int, context: ContextTypes.DEFAULT_TYPE):
+async def get_member_status(user_id: int, channel_id: int, context: ContextTypes.DEFAULT_TYPE, use_cache=True):
+    """Статус пользователя в публичном канале: зеркало подписок, кэш отказов или Bot API"""
+    key = (user_id, channel_id)
+    if use_cache:
+        # Подписку из зеркала перепроверяем раз в SUBSCRIPTION_TTL_POSITIVE - на случай потерянного апдейта о выходе
+        known = await db.get_membership(user_id, channel_id, SUBSCRIPTION_TTL_POSITIVE)
+        if known is not None:
+            return 'member' if known else 'left'
+        status = membership_cache.get(key)
+        if status is not None:
+            return status
+
+    member = await context.bot.get_chat_member(chat_id=channel_id, user_id=user_id)
+    status = member.status
+    if status not in ['left', 'kicked']:
+        # Подписку запоминаем надолго: о выходе из канала Telegram сообщит апдейтом chat_member,
+        # а запись обновляет updated_at - следующая перепроверка через SUBSCRIPTION_TTL_POSITIVE
+        await db.set_channel_membership(user_id, channel_id, status)
+    else:
+        # Отказ живет недолго: пользователь вот-вот подпишется, а апдейт о вступлении мог потеряться
+        membership_cache.set(key, status, SUBSCRIPTION_TTL_NEGATIVE)
+        if await db.peek_membership(user_id, channel_id):
+            await db.set_channel_membership(user_id, channel_id, status)
+    return status
+
+async def check_subscription(user_id: int, context: ContextTypes.DEFAULT_TYPE, use_cache=True):
     """Проверяет подписку на все каналы - РАЗДЕЛЬНАЯ ПРОВЕРКА"""
-    channels = db.get_all_channels()
-    not_subscribed = []
+    channels = await db.get_all_channels()
     
     if not channels:
         return []
     
-    for channel_id, username, title, invite_link, is_private in channels:
+    # ДЛЯ ПРИВАТНЫХ КАНАЛОВ - проверяем заявки, одним запросом по всем каналам
+    private_ids = [channel[0] for channel in channels if channel[4]]
+    requests = await db.get_channel_requests(user_id, private_ids) if private_ids else {}
+    
+    async def is_subscribed(channel):
+        channel_id, username, title, invite_link, is_private, fail_open = channel
+        if is_private:
+            # Нет активной заявки - канал не пройден
+            return requests.get(channel_id) in ['pending', 'approved']
+        
+        # ДЛЯ ПУБЛИЧНЫХ КАНАЛОВ - стандартная проверка подписки, все каналы одновременно
         try:
-            if is_private:
-                # ДЛЯ ПРИВАТНЫХ КАНАЛОВ - проверяем заявки
-                request = db.get_channel_request(user_id, channel_id)
-                if not request or request[0] not in ['pending', 'approved']:
-                    # Нет активной заявки - добавляем в список
-                    not_subscribed.append((channel_id, username, title, invite_link, is_private))
-                    
-            else:
-                # ДЛЯ ПУБЛИЧНЫХ КАНАЛОВ - стандартная проверка подписки
-                member = await context.bot.get_chat_member(chat_id=channel_id, user_id=user_id)
-                if member.status in ['left', 'kicked']:
-                    not_subscribed.append((channel_id, username, title, invite_link, is_private))
-                    
+            async with subscription_check_slots:
+                status = await asyncio.wait_for(
+                    get_member_status(user_id, channel_id, context, use_cache),
+                    SUBSCRIPTION_CHECK_TIMEOUT
+                )
+            return status not in ['left', 'kicked']
+        except asyncio.TimeoutError:
+            logger.warning(f"Kanal {channel_id} tekshirish vaqti tugadi ({SUBSCRIPTION_CHECK_TIMEOUT}s)")
         except Exception as e:
             logger.warning(f"Kanal {channel_id} tekshirishda xato: {e}")
-            not_subscribed.append((channel_id, username, title, invite_link, is_private))
+        return bool(fail_open)
     
-    return not_subscribed
+    results = await asyncio.gather(*(is_subscribed(channel) for channel in channels))
+    return [channel[:5] for channel, subscribed in zip(channels, results) if not subscribed]
 
 async def require_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Проверяет подписку перед выполнением действия"""
@@ -569,7 +2421,7 @@ async def require_subscription(update: Update, context: ContextTypes.DEFAULT_TYP
     if user.id in ADMIN_IDS:
         return True
     
-    db.update_user_activity(user.id)
+    await db.update_user_activity(user.id)
     
     not_subscribed = await check_subscription(user.id, context)
     
@@ -633,10 +2485,10 @@ async def show_subscription_required(update: Update, context: ContextTypes.DEFAU
 
 async def check_subscription_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
     
+    # Кнопка «✅ Tekshirish» всегда проверяет заново, минуя кэш
     user = query.from_user
-    not_subscribed = await check_subscription(user.id, context)
+    not_subscribed = await check_subscription(user.id, context, use_cache=False)
     
     if not not_subscribed:
         await query.edit_message_text(
@@ -654,10 +2506,10 @@ async def handle_chat_join_request(update: Update, context: ContextTypes.DEFAULT
     chat = join_request.chat
     
     # Добавляем пользователя в базу если его нет
-    db.add_user(user.id, user.username, user.first_name, user.last_name)
+    await db.add_user(user.id, user.username, user.first_name, user.last_name)
     
     # Сохраняем заявку в базу данных
-    success = db.add_channel_request(user.id, chat.id, 'pending')
+    success = await db.add_channel_request(user.id, chat.id, 'pending')
     
     if success:
         logger.info(f"Yangi so'rov: {user.id} -> {chat.id}")
@@ -671,7 +2523,8 @@ async def handle_chat_join_request(update: Update, context: ContextTypes.DEFAULT
                          f"👤 Foydalanuvchi: {user.first_name} (@{user.username or 'Noma lum'})\n"
                          f"📢 Kanal: {chat.title}\n"
                          f"🆔 User ID: {user.id}\n"
-                         f"🆔 Chat ID: {chat.id}"
+                         f"🆔 Chat ID: {chat.id}",
+                    rate_limit_args=BULK
                 )
             except Exception as e:
                 logger.error(f"Adminni xabarlashda xato {admin_id}: {e}")
@@ -682,40 +2535,398 @@ async def handle_chat_member_update(update: Update, context: ContextTypes.DEFAUL
     user = chat_member.new_chat_member.user
     chat = update.chat_member.chat
     
-    # Проверяем, является ли канал приватным в нашей базе
-    channels = db.get_all_channels()
-    channel_ids = [channel[0] for channel in channels]
-    
-    if chat.id not in channel_ids:
-        return
-    
-    # Получаем информацию о канале
-    channel_info = next((c for c in channels if c[0] == chat.id), None)
+    # Проверяем, есть ли канал в нашей базе
+    channel_info = await db.get_channel(chat.id)
     if not channel_info:
         return
     
-    channel_id, username, title, invite_link, is_private = channel_info
-    
-    if not is_private:
-        return  # Только для приватных каналов
+    channel_id, username, title, invite_link, is_private, fail_open = channel_info
     
     # Обрабатываем изменения статуса
     new_status = chat_member.new_chat_member.status
     old_status = chat_member.old_chat_member.status
     
+    if not is_private:
+        # Публичный канал: Telegram сам сообщает о вступлении и выходе - обновляем зеркало подписок
+        membership_cache.pop((user.id, chat.id))
+        await db.set_channel_membership(user.id, chat.id, new_status)
+        return
+    
     # Пользователь принят в канал
     if new_status in ['member', 'administrator'] and old_status in ['left', 'kicked']:
-        db.add_channel_request(user.id, chat.id, 'approved')
+        await db.add_channel_request(user.id, chat.id, 'approved')
         logger.info(f"Foydalanuvchi qabul qilindi: {user.id} -> {chat.id}")
     
     # Пользователь вышел из канала
     elif new_status in ['left', 'kicked'] and old_status in ['member', 'administrator']:
-        db.add_channel_request(user.id, chat.id, 'cancelled')
+        await db.add_channel_request(user.id, chat.id, 'cancelled')
         logger.info(f"Foydalanuvchi chiqib ketdi: {user.id} -> {chat.id}")
 
+# МАРШРУТИЗАЦИЯ CALLBACK
+# Форматы callback_data (Telegram ограничивает их 64 байтами):
+#   v2: 2<тег>[:<аргумент>...] - короткий тег маршрута, дорамы по doramas.id, числа в base36
+#   v1: <маршрут>[:<аргумент>...] - коды дорам как есть (\w+, двоеточия в них не бывает)
+#   v0: <префикс>_<аргументы> - самые старые кнопки, разбираются через таблицу префиксов
+# Новые кнопки собираются в v2; если id дорамы еще неизвестен - в v1.
+CALLBACK_SEP = ':'
+CALLBACK_VERSION = '2'
+BASE36_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+def callback_data(route, *args):
+    """Собирает callback_data маршрута в самом компактном доступном формате"""
+    return callbacks.encode(route, *args)
+
+def optional(value):
+    """Декодер необязательного аргумента: пустая строка - None"""
+    return value or None
+
+def to_base36(number):
+    number = int(number)
+    if number < 0:
+        return '-' + to_base36(-number)
+    digits = ''
+    while True:
+        number, digit = divmod(number, 36)
+        digits = BASE36_DIGITS[digit] + digits
+        if not number:
+            return digits
+
+def from_base36(raw):
+    return int(raw, 36)
+
+def encode_dorama_id(dorama_code):
+    dorama_id = db.dorama_ids.id_of(dorama_code)
+    if dorama_id is None:
+        raise ValueError(f"id дорамы {dorama_code} неизвестен")
+    return to_base36(dorama_id)
+
+def encode_dorama_anchor(dorama_code):
+    return encode_dorama_id(dorama_code) if dorama_code else ''
+
+def decode_dorama_anchor(raw):
+    """Якорь каталога: id -> код дорамы; удаленная дорама - None (первая страница)"""
+    return db.dorama_ids.code_of(from_base36(raw)) if raw else None
+
+# Кодеки аргументов v2: (кодирование, декодирование)
+BASE36_INT = (to_base36, from_base36)
+DORAMA_ID = (encode_dorama_id, from_base36)       # обработчик получает int id
+DORAMA_ANCHOR = (encode_dorama_anchor, decode_dorama_anchor)  # обработчик получает код или None
+
+class CallbackRoute:
+    """Маршрут callback: обработчик, декодеры аргументов и счетчики"""
+
+    def __init__(self, name, handler, decoders=(), admin=False, check_subscription=True, tag=None, compact=()):
+        self.name = name
+        self.handler = handler
+        self.decoders = tuple(decoders)
+        self.admin = admin
+        self.check_subscription = check_subscription
+        self.tag = tag
+        self.encoders = tuple(encode for encode, _ in compact)
+        self.compact_decoders = tuple(decode for _, decode in compact)
+
+        # Метрики
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+
+    def decode(self, raw_args, decoders=None):
+        """Приводит строковые аргументы к типам маршрута; ValueError при несовпадении"""
+        decoders = self.decoders if decoders is None else decoders
+        missing = len(decoders) - len(raw_args)
+        if not missing:
+            return list(map(operator.call, decoders, raw_args))
+        if missing < 0:
+            raise ValueError(f"лишние аргументы для {self.name}")
+        if missing:
+            # Недостающие хвостовые аргументы - пустые (подходят только для optional)
+            raw_args = [*raw_args, *[''] * missing]
+        return [decode(raw) for decode, raw in zip(decoders, raw_args)]
+
+class CallbackRouter:
+    """Таблица маршрутов callback_data с поиском по голове данных за O(1)
+
+    Голова - все до первого ":". Для v2 это версия и тег ("2w"), для v1 - имя маршрута;
+    оба вида лежат в одном словаре, так что маршрут находится одним поиском.
+    Кнопки самых старых форматов еще живут в чатах пользователей - для них есть
+    словарь префиксов v0 по первому слову до "_" (внутри - длинные префиксы первыми).
+    Разбор v0 не зависит от состояния каталога, поэтому его результат запоминается:
+    одни и те же старые кнопки нажимают многие пользователи.
+    Каждый вызов проходит через хуки инструментирования hook(route, elapsed, error).
+    """
+
+    def __init__(self):
+        self._routes = {}
+        self._heads = {}   # голова -> (маршрут, декодеры, компактный ли формат)
+        self._legacy = {}  # первое слово v0 "<слово>_" -> ((префикс, маршрут, разбор хвоста), ...)
+        self._legacy_cache = {}  # callback_data v0 -> (маршрут, аргументы)
+        self.legacy_cache_size = CALLBACK_LEGACY_CACHE_SIZE
+        self.hooks = []
+        self.unknown = 0
+        self.legacy_hits = 0
+        self.compact_hits = 0
+
+    def add(self, name, handler, *decoders, admin=False, check_subscription=True, tag=None, compact=()):
+        route = CallbackRoute(name, handler, decoders, admin, check_subscription, tag, compact)
+        self._routes[name] = route
+        self._heads[name] = (route, route.decoders, False)
+        if tag:
+            self._heads[CALLBACK_VERSION + tag] = (route, route.compact_decoders, True)
+
+    def encode(self, name, *args):
+        """callback_data для маршрута: v2, если у маршрута есть тег и все аргументы кодируются"""
+        route = self._routes.get(name)
+        if route is not None and route.tag:
+            try:
+                return CALLBACK_VERSION + route.tag + ''.join(
+                    CALLBACK_SEP + encode(arg) for encode, arg in zip(route.encoders, args)
+                )
+            except ValueError:
+                pass
+        if not args:
+            return name
+        return CALLBACK_SEP.join((name, *('' if arg is None else str(arg) for arg in args)))
+
+    def add_legacy(self, prefix, name, parse=lambda rest: ()):
+        head = prefix[:prefix.index('_') + 1]
+        entries = (*self._legacy.get(head, ()), (prefix, self._routes[name], parse))
+        self._legacy[head] = tuple(sorted(entries, key=lambda entry: -len(entry[0])))
+
+    def _resolve_legacy(self, data):
+        """Разбор v0 без кэша: (маршрут, аргументы) или None; ValueError при неверных аргументах"""
+        for prefix, route, parse in self._legacy.get(data[:data.find('_') + 1], ()):
+            if data.startswith(prefix):
+                return route, tuple(route.decode(parse(data[len(prefix):])))
+        return None
+
+    def resolve(self, data):
+        """Возвращает (маршрут, аргументы) или (None, None), если данные не распознаны"""
+        head, sep, rest = data.partition(CALLBACK_SEP)
+        try:
+            entry = self._heads.get(head)
+            if entry is not None:
+                route, decoders, compact = entry
+                if compact:
+                    self.compact_hits += 1
+                if not sep:
+                    return route, route.decode((), decoders) if decoders else ()
+                # Самый частый случай - один аргумент: без split и без общего декодера
+                if len(decoders) == 1 and CALLBACK_SEP not in rest:
+                    return route, [decoders[0](rest)]
+                return route, route.decode(rest.split(CALLBACK_SEP), decoders)
+            if not sep:
+                resolved = self._legacy_cache.get(data)
+                if resolved is None:
+                    resolved = self._resolve_legacy(data)
+                    if resolved is not None and self.legacy_cache_size:
+                        if len(self._legacy_cache) >= self.legacy_cache_size:
+                            self._legacy_cache.clear()
+                        self._legacy_cache[data] = resolved
+                if resolved is not None:
+                    self.legacy_hits += 1
+                    return resolved
+        except ValueError:
+            pass
+        self.unknown += 1
+        return None, None
+
+    async def dispatch(self, route, args, update, context):
+        started = time.perf_counter()
+        error = None
+        try:
+            await route.handler(update, context, *args)
+        except Exception as e:
+            error = e
+            route.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            route.calls += 1
+            route.total_time += elapsed
+            for hook in self.hooks:
+                hook(route, elapsed, error)
+
+    def stats(self):
+        stats = {'routes': len(self._routes), 'compact_hits': self.compact_hits,
+                 'legacy_hits': self.legacy_hits, 'legacy_cached': len(self._legacy_cache), 'unknown': self.unknown}
+        busiest = sorted(self._routes.values(), key=lambda route: -route.calls)[:5]
+        for route in busiest:
+            if route.calls:
+                stats[route.name] = (f"{route.calls} ta, {route.total_time / route.calls * 1000:.1f} ms,"
+                                     f" xato {route.errors}")
+        return stats
+
+def parse_legacy_catalog_page(rest):
+    """Старый хвост каталога <страница>[_n|p_<код>] -> [страница, after, before]"""
+    page, _, anchor = rest.partition("_")
+    direction, _, code = anchor.partition("_")
+    if direction == "n" and code:
+        return [page, code, '']
+    if direction == "p" and code:
+        return [page, '', code]
+    # Старые кнопки без якоря - открываем первую страницу
+    return ['0']
+
+def parse_legacy_code_and_number(rest):
+    """Старый хвост <код>_<число>: число - после последнего "_", в коде "_" допустим"""
+    code, _, number = rest.rpartition("_")
+    return [code, number]
+
+def dorama_code_of(dorama_ref):
+    """Код дорамы по ссылке из callback: int - doramas.id (v2), str - сам код"""
+    if isinstance(dorama_ref, int):
+        return db.dorama_ids.code_of(dorama_ref)
+    return dorama_ref
+
+async def get_dorama_by_ref(dorama_ref):
+    """Дорама по ссылке из callback: по первичному ключу для v2, по коду для старых кнопок"""
+    if isinstance(dorama_ref, int):
+        return await db.get_dorama_by_id(dorama_ref)
+    return await db.get_dorama(dorama_ref)
+
+callbacks = CallbackRouter()
+register_metrics('callbacks', callbacks.stats)
+
+# КЭШ ОТРИСОВКИ
+class RenderCache:
+    """LRU-кэш готовых карточек дорам и клавиатур
+
+    Ключ - (вид, dorama_id, catalog.version, страница). Любое изменение каталога
+    увеличивает catalog.version: при первом обращении с новой версией кэш очищается,
+    так что устаревшие карточки не показываются и не занимают память.
+    """
+
+    def __init__(self, maxsize=RENDER_CACHE_SIZE):
+        self.maxsize = max(1, maxsize)
+        self._entries = OrderedDict()  # ключ -> (значение, время отрисовки)
+        self._version = None
+
+        # Метрики
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.saved_time = 0.0
+
+    def _check_version(self, version):
+        if version != self._version:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._version = version
+
+    def get(self, key, version):
+        self._check_version(version)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        self.saved_time += entry[1]
+        return entry[0]
+
+    def put(self, key, version, value, render_time):
+        # Каталог изменился, пока шла отрисовка - результат уже устарел
+        if version != self._version:
+            return
+        self._entries[key] = (value, render_time)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hit_rate': f"{(self.hits / total * 100) if total else 0:.1f}%",
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'saved_ms': round(self.saved_time * 1000, 1),
+        }
+
+render_cache = RenderCache()
+register_metrics('render_cache', render_cache.stats)
+
+def dorama_card_text(dorama, total_episodes):
+    """Общая часть карточки дорамы (без последней строки с действием)"""
+    code, title, description, release_year, genre, rating, poster = dorama
+    
+    text = f"📺 **{title}**\n\n"
+    
+    if description:
+        text += f"📖 {description}\n\n"
+    
+    text += f"📊 **Ma'lumotlar:**\n"
+    text += f"• 🎬 Kod: `{code}`\n"
+    text += f"• 📋 Jami qismlar: {total_episodes} ta\n"
+    
+    if release_year:
+        text += f"• 🗓️ Yil: {release_year}\n"
+    
+    if genre:
+        text += f"• 🎭 Janr: {genre}\n"
+    
+    if rating and rating > 0:
+        text += f"• ⭐ Reyting: {rating}/10\n"
+    
+    return text
+
+async def render_dorama_card(dorama_ref):
+    """Карточка дорамы из кэша: (код, название, эпизодов, текст, клавиатура) или None"""
+    version = db.catalog.version
+    dorama_id = dorama_ref if isinstance(dorama_ref, int) else db.dorama_ids.id_of(dorama_ref)
+    key = ('card', dorama_id, version, 0)
+    card = render_cache.get(key, version) if dorama_id is not None else None
+    if card is not None:
+        return card
+
+    started = time.perf_counter()
+    dorama = await get_dorama_by_ref(dorama_ref)
+    if not dorama:
+        return None
+    dorama_code, title = dorama[0], dorama[1]
+    total_episodes = await db.get_total_episodes(dorama_code)
+    card = (dorama_code, title, total_episodes, dorama_card_text(dorama, total_episodes),
+            get_dorama_keyboard(dorama_code, total_episodes))
+    if dorama_id is not None:
+        render_cache.put(key, version, card, time.perf_counter() - started)
+    return card
+
+async def render_episodes_page(dorama_ref, page):
+    """Страница списка эпизодов из кэша: (текст, клавиатура) или None"""
+    version = db.catalog.version
+    dorama_id = dorama_ref if isinstance(dorama_ref, int) else db.dorama_ids.id_of(dorama_ref)
+    key = ('episodes', dorama_id, version, page)
+    rendered = render_cache.get(key, version) if dorama_id is not None else None
+    if rendered is not None:
+        return rendered
+
+    started = time.perf_counter()
+    dorama = await get_dorama_by_ref(dorama_ref)
+    if not dorama:
+        return None
+    dorama_code, title = dorama[0], dorama[1]
+    # Номера эпизодов кэшируются - клавиатура ниже возьмет ту же страницу из памяти
+    _, total_episodes = await db.get_episode_numbers_page(dorama_code, page)
+    if not total_episodes:
+        return None
+    
+    text = f"📺 {title}\n\n"
+    text += f"📋 Barcha qismlar ({total_episodes} ta):\n\n"
+    text += "Kerakli qismni tanlang yoki barchasini yuborish tugmasini bosing:"
+    
+    rendered = (text, await get_all_episodes_keyboard(dorama_code, page))
+    if dorama_id is not None:
+        render_cache.put(key, version, rendered, time.perf_counter() - started)
+    return rendered
+
 # КЛАВИАТУРЫ
+@functools.lru_cache(maxsize=None)
 def get_main_keyboard():
-    """Главная клавиатура"""
+    """Главная клавиатура (неизменяемая - собирается один раз)"""
     keyboard = [
         [KeyboardButton("🔍 Qidirish"), KeyboardButton("📚 Barcha doramalar")],
         [KeyboardButton("🆕 Yangi qo'shilgan"), KeyboardButton("📊 Mashhurlar")],
@@ -723,34 +2934,37 @@ def get_main_keyboard():
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
+@functools.lru_cache(maxsize=None)
 def get_main_menu_keyboard():
-    """Inline клавиатура для главного меню"""
+    """Inline клавиатура для главного меню (неизменяемая - собирается один раз)"""
     keyboard = [
         [InlineKeyboardButton("🔍 Qidirish", callback_data="search")],
-        [InlineKeyboardButton("📚 Barcha doramalar", callback_data="all_doramas_0")],
-        [InlineKeyboardButton("🆕 Yangi qo'shilgan", callback_data="recent_doramas_0")],
-        [InlineKeyboardButton("📊 Mashhurlar", callback_data="popular_doramas_0")],
+        [InlineKeyboardButton("📚 Barcha doramalar", callback_data=callback_data("all_doramas", 0))],
+        [InlineKeyboardButton("🆕 Yangi qo'shilgan", callback_data="recent_doramas")],
+        [InlineKeyboardButton("📊 Mashhurlar", callback_data="popular_doramas")],
         [InlineKeyboardButton("⭐ Tasodifiy dorama", callback_data="random_dorama")],
         [InlineKeyboardButton("ℹ️ Yordam", callback_data="help")]
     ]
     return InlineKeyboardMarkup(keyboard)
 
+@functools.lru_cache(maxsize=None)
 def get_admin_keyboard():
-    """Клавиатура для админов"""
+    """Клавиатура для админов (неизменяемая - собирается один раз)"""
     keyboard = [
         [InlineKeyboardButton("📊 Statistika", callback_data="admin_stats")],
-        [InlineKeyboardButton("🎬 Doramalar", callback_data="admin_doramas_0")],
-        [InlineKeyboardButton("🗑️ O'chirish", callback_data="admin_delete_0")],
+        [InlineKeyboardButton("🎬 Doramalar", callback_data=callback_data("admin_doramas", 0))],
+        [InlineKeyboardButton("🗑️ O'chirish", callback_data=callback_data("admin_delete", 0))],
         [InlineKeyboardButton("📢 Kanallar", callback_data="admin_channels")],
         [InlineKeyboardButton("⚙️ Sozlamalar", callback_data="admin_settings")],
-        [InlineKeyboardButton("🆕 So'rovlar", callback_data="admin_requests_0")],
+        [InlineKeyboardButton("🆕 So'rovlar", callback_data=callback_data("admin_requests", 0))],
         [InlineKeyboardButton("📢 Xabar yuborish", callback_data="admin_broadcast")],
         [InlineKeyboardButton("🔙 Bosh menyu", callback_data="main_menu")]
     ]
     return InlineKeyboardMarkup(keyboard)
 
+@functools.lru_cache(maxsize=None)
 def get_admin_settings_keyboard():
-    """Клавиатура для настроек"""
+    """Клавиатура для настроек (неизменяемая - собирается один раз)"""
     keyboard = [
         [InlineKeyboardButton("👋 Xush kelish xabarini o'zgartirish", callback_data="admin_set_welcome")],
         [InlineKeyboardButton("ℹ️ Yordam xabarini o'zgartirish", callback_data="admin_set_help")],
@@ -771,56 +2985,64 @@ def get_dorama_keyboard(dorama_code, total_episodes):
         row = []
         for j in range(i, min(i + 5, episodes_to_show)):
             ep_num = j + 1
-            row.append(InlineKeyboardButton(f"{ep_num}", callback_data=f"watch_{dorama_code}_{ep_num}"))
+            row.append(InlineKeyboardButton(f"{ep_num}", callback_data=callback_data("watch", dorama_code, ep_num)))
         keyboard.append(row)
     
     # Если эпизодов больше 10, добавляем кнопку "Все эпизоды"
     if total_episodes > 10:
-        keyboard.append([InlineKeyboardButton("📋 Barcha qismlar", callback_data=f"all_episodes_{dorama_code}")])
+        keyboard.append([InlineKeyboardButton("📋 Barcha qismlar", callback_data=callback_data("all_episodes", dorama_code))])
     
-    keyboard.append([InlineKeyboardButton("🎬 Barcha qismlarni yuborish", callback_data=f"send_all_{dorama_code}")])
+    keyboard.append([InlineKeyboardButton("🎬 Barcha qismlarni yuborish", callback_data=callback_data("send_all", dorama_code))])
     keyboard.append([InlineKeyboardButton("🔙 Bosh menyu", callback_data="main_menu")])
     
     return InlineKeyboardMarkup(keyboard)
 
-def get_all_episodes_keyboard(dorama_code, page=0, episodes_per_page=15):
+async def get_all_episodes_keyboard(dorama_code, page=0, episodes_per_page=15):
     """Клавиатура для всех эпизодов с пагинацией"""
-    episodes = db.get_all_episodes(dorama_code)
-    total_episodes = len(episodes)
+    page_numbers, total_episodes = await db.get_episode_numbers_page(dorama_code, page, episodes_per_page)
     total_pages = (total_episodes + episodes_per_page - 1) // episodes_per_page
     
     keyboard = []
     
     # Эпизоды текущей страницы
-    start_idx = page * episodes_per_page
-    end_idx = min(start_idx + episodes_per_page, total_episodes)
-    
-    for i in range(start_idx, end_idx, 3):
+    for i in range(0, len(page_numbers), 3):
         row = []
-        for j in range(i, min(i + 3, end_idx)):
-            ep_num = episodes[j][0]
-            row.append(InlineKeyboardButton(f"{ep_num}", callback_data=f"watch_{dorama_code}_{ep_num}"))
+        for ep_num in page_numbers[i:i + 3]:
+            row.append(InlineKeyboardButton(f"{ep_num}", callback_data=callback_data("watch", dorama_code, ep_num)))
         keyboard.append(row)
     
     # Навигация по страницам
     if total_pages > 1:
         nav_buttons = []
         if page > 0:
-            nav_buttons.append(InlineKeyboardButton("⬅️", callback_data=f"episodes_{dorama_code}_{page-1}"))
+            nav_buttons.append(InlineKeyboardButton("⬅️", callback_data=callback_data("episodes", dorama_code, page - 1)))
         
         nav_buttons.append(InlineKeyboardButton(f"{page+1}/{total_pages}", callback_data="current_page"))
         
         if page < total_pages - 1:
-            nav_buttons.append(InlineKeyboardButton("➡️", callback_data=f"episodes_{dorama_code}_{page+1}"))
+            nav_buttons.append(InlineKeyboardButton("➡️", callback_data=callback_data("episodes", dorama_code, page + 1)))
         
         keyboard.append(nav_buttons)
     
-    keyboard.append([InlineKeyboardButton("🎬 Barcha qismlarni yuborish", callback_data=f"send_all_{dorama_code}")])
-    keyboard.append([InlineKeyboardButton("🔙 Orqaga", callback_data=f"dorama_{dorama_code}")])
+    keyboard.append([InlineKeyboardButton("🎬 Barcha qismlarni yuborish", callback_data=callback_data("send_all", dorama_code))])
+    keyboard.append([InlineKeyboardButton("🔙 Orqaga", callback_data=callback_data("dorama", dorama_code))])
     
     return InlineKeyboardMarkup(keyboard)
 
-def get_dorama_list_keyboard(doramas, prefix="dorama"):
+def get_catalog_nav_buttons(callback_prefix, doramas, page, total_pages, has_prev, has_next):
+    """Кнопки листания каталога: в callback - номер страницы и код дорамы-якоря (after или before)"""
+    nav_buttons = []
+    if has_prev:
+        nav_buttons.append(InlineKeyboardButton("⬅️", callback_data=callback_data(callback_prefix, page - 1, None, doramas[0][0])))
+    
+    nav_buttons.append(InlineKeyboardButton(f"{page+1}/{total_pages}", callback_data="current_page"))
+    
+    if has_next:
+        nav_buttons.append(InlineKeyboardButton("➡️", callback_data=callback_data(callback_prefix, page + 1, doramas[-1][0], None)))
+    
+    return nav_buttons
+
+def get_dorama_list_keyboard(doramas, prefix="dorama", nav_buttons=None):
     """Клавиатура списка дорам"""
     keyboard = []
     
@@ -840,12 +3062,14 @@ def get_dorama_list_keyboard(doramas, prefix="dorama"):
         if episode_count:
             display_text += f" - {episode_count}qism"
         
-        keyboard.append([InlineKeyboardButton(display_text, callback_data=f"{prefix}_{dorama_code}")])
+        keyboard.append([InlineKeyboardButton(display_text, callback_data=callback_data(prefix, dorama_code))])
     
+    if nav_buttons:
+        keyboard.append(nav_buttons)
     keyboard.append([InlineKeyboardButton("🔙 Bosh menyu", callback_data="main_menu")])
     return InlineKeyboardMarkup(keyboard)
 
-def get_admin_dorama_list_keyboard(doramas, page, total_pages, delete_mode=False):
+def get_admin_dorama_list_keyboard(doramas, nav_buttons, delete_mode=False):
     """Клавиатура списка дорам для админов"""
     keyboard = []
     
@@ -862,83 +3086,323 @@ def get_admin_dorama_list_keyboard(doramas, page, total_pages, delete_mode=False
         display_text = f"📺 {title} ({episode_count}q)"
         if delete_mode:
             keyboard.append([
-                InlineKeyboardButton(display_text, callback_data=f"admin_dorama_info_{dorama_code}"),
-                InlineKeyboardButton("❌", callback_data=f"admin_delete_confirm_{dorama_code}")
+                InlineKeyboardButton(display_text, callback_data=callback_data("admin_dorama_info", dorama_code)),
+                InlineKeyboardButton("❌", callback_data=callback_data("admin_delete_confirm", dorama_code))
             ])
         else:
-            keyboard.append([InlineKeyboardButton(display_text, callback_data=f"admin_dorama_info_{dorama_code}")])
+            keyboard.append([InlineKeyboardButton(display_text, callback_data=callback_data("admin_dorama_info", dorama_code))])
     
     # Пагинация
-    nav_buttons = []
-    if page > 0:
-        nav_buttons.append(InlineKeyboardButton("⬅️", callback_data=f"admin_doramas_{page-1}" if not delete_mode else f"admin_delete_{page-1}"))
-    
-    nav_buttons.append(InlineKeyboardButton(f"{page+1}/{total_pages}", callback_data="current_page"))
-    
-    if page < total_pages - 1:
-        nav_buttons.append(InlineKeyboardButton("➡️", callback_data=f"admin_doramas_{page+1}" if not delete_mode else f"admin_delete_{page+1}"))
-    
     if nav_buttons:
         keyboard.append(nav_buttons)
     
     # Кнопки действий
     action_buttons = []
     if not delete_mode:
-        action_buttons.append(InlineKeyboardButton("🗑️ O'chirish", callback_data="admin_delete_0"))
+        action_buttons.append(InlineKeyboardButton("🗑️ O'chirish", callback_data=callback_data("admin_delete", 0)))
     else:
-        action_buttons.append(InlineKeyboardButton("📋 Ko'rish", callback_data="admin_doramas_0"))
+        action_buttons.append(InlineKeyboardButton("📋 Ko'rish", callback_data=callback_data("admin_doramas", 0)))
     
     action_buttons.append(InlineKeyboardButton("🔙 Admin", callback_data="admin_menu"))
     keyboard.append(action_buttons)
     
     return InlineKeyboardMarkup(keyboard)
 
-def get_admin_delete_confirmation_keyboard(dorama_code):
-    """Клавиатура подтверждения удаления дорамы"""
-    keyboard = [
-        [
-            InlineKeyboardButton("✅ HA", callback_data=f"admin_confirm_delete_{dorama_code}"),
-            InlineKeyboardButton("❌ BEKOR", callback_data="admin_delete_0")
-        ],
-        [InlineKeyboardButton("🔙 Admin", callback_data="admin_menu")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+def get_admin_delete_confirmation_keyboard(dorama_code):
+    """Клавиатура подтверждения удаления дорамы"""
+    keyboard = [
+        [
+            InlineKeyboardButton("✅ HA", callback_data=callback_data("admin_confirm_delete", dorama_code)),
+            InlineKeyboardButton("❌ BEKOR", callback_data=callback_data("admin_delete", 0))
+        ],
+        [InlineKeyboardButton("🔙 Admin", callback_data="admin_menu")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+def get_admin_requests_keyboard(requests, page, total_pages):
+    """Клавиатура для управления заявками"""
+    keyboard = []
+    
+    for user_id, channel_id, status, created_at, username, first_name, title in requests:
+        user_display = f"@{username}" if username else first_name
+        request_text = f"{user_display} - {title[:20]}..."
+        keyboard.append([
+            InlineKeyboardButton(request_text, callback_data=callback_data("admin_request_info", user_id, channel_id)),
+            InlineKeyboardButton("✅", callback_data=callback_data("admin_approve_request", user_id, channel_id))
+        ])
+    
+    # Пагинация
+    nav_buttons = []
+    if page > 0:
+        nav_buttons.append(InlineKeyboardButton("⬅️", callback_data=callback_data("admin_requests", page - 1)))
+    
+    nav_buttons.append(InlineKeyboardButton(f"{page+1}/{total_pages}", callback_data="current_page"))
+    
+    if page < total_pages - 1:
+        nav_buttons.append(InlineKeyboardButton("➡️", callback_data=callback_data("admin_requests", page + 1)))
+    
+    if nav_buttons:
+        keyboard.append(nav_buttons)
+    
+    keyboard.append([InlineKeyboardButton("🔙 Admin", callback_data="admin_menu")])
+    
+    return InlineKeyboardMarkup(keyboard)
+
+# ДОСТАВКА ЭПИЗОДОВ
+
+def episode_caption(title, episode_number, caption):
+    return caption or f"📺 {title}\n\nQism: {episode_number}"
+
+# Темп отправки задает общий rate_limiter бота; RetryAfter он же и переживает
+async def send_episode_video(bot, chat_id, title, episode, protect_content=PROTECT_CONTENT):
+    """Отправляет один эпизод как массовую отправку"""
+    episode_number, file_id, caption = episode[:3]
+    await bot.send_video(
+        chat_id=chat_id,
+        video=file_id,
+        caption=episode_caption(title, episode_number, caption),
+        protect_content=protect_content,
+        rate_limit_args=BULK
+    )
+
+def is_broken_episode(error):
+    """Ошибка из-за самого эпизода (битый file_id и т.п.): повтор не поможет, эпизод пропускаем"""
+    return isinstance(error, BadRequest) and classify_send_error(error) == TRANSIENT
+
+async def send_episodes_one_by_one(bot, chat_id, title, episodes, protect_content=PROTECT_CONTENT):
+    """Отправляет эпизоды по одному; возвращает (доставленные номера, курсор, ошибка).
+
+    Курсор - последний обработанный эпизод (доставлен или пропущен как битый), None - ни одного.
+    На любой другой ошибке отправка останавливается: ошибка возвращается, чтобы задание
+    повторило оставшиеся эпизоды
+    """
+    delivered, cursor = [], None
+    for episode in episodes:
+        try:
+            await send_episode_video(bot, chat_id, title, episode, protect_content)
+            delivered.append(episode[0])
+        except Exception as e:
+            if not is_broken_episode(e):
+                return delivered, cursor, e
+            logger.error(f"Video yuborish xatosi (qism {episode[0]}), o'tkazib yuborildi: {e}")
+        cursor = episode[0]
+    return delivered, cursor, None
+
+async def send_episode_album(bot, chat_id, title, episodes, protect_content=PROTECT_CONTENT):
+    """Отправляет до 10 эпизодов одним альбомом; результат - как у send_episodes_one_by_one"""
+    media = [
+        InputMediaVideo(media=file_id, caption=episode_caption(title, episode_number, caption))
+        for episode_number, file_id, caption in (episode[:3] for episode in episodes)
+    ]
+    try:
+        await bot.send_media_group(chat_id=chat_id, media=media, protect_content=protect_content, rate_limit_args=BULK)
+        return [episode[0] for episode in episodes], episodes[-1][0], None
+    except Exception as e:
+        if not is_broken_episode(e):
+            return [], None, e
+        # Один битый file_id роняет весь альбом - досылаем эпизоды по одному
+        logger.warning(f"Albom yuborilmadi ({title}, {episodes[0][0]}-{episodes[-1][0]}): {e}")
+    return await send_episodes_one_by_one(bot, chat_id, title, episodes, protect_content)
+
+async def deliver_batch(bot, chat_id, dorama_code, title, batch):
+    """Доставляет пачку эпизодов (альбом или одно видео) и считает просмотры.
+
+    Возвращает (доставленные номера, курсор, ошибка) - см. send_episodes_one_by_one
+    """
+    if len(batch) > 1:
+        delivered, cursor, error = await send_episode_album(bot, chat_id, title, batch)
+    else:
+        delivered, cursor, error = await send_episodes_one_by_one(bot, chat_id, title, batch)
+
+    # Просмотры засчитываем после доставки каждого альбома
+    for episode_number in delivered:
+        await db.increment_views(dorama_code, episode_number)
+    if delivered:
+        await db.record_watch(chat_id, dorama_code)
+    return delivered, cursor, error
+
+# ОЧЕРЕДЬ ДОСТАВКИ
+class DeliveryQueue:
+    """Фоновые воркеры, которые выполняют задания delivery_jobs
+
+    Задания одного чата всегда попадают к одному воркеру (chat_id % workers), поэтому
+    выполняются строго по порядку. Курсор сохраняется после каждой пачки и стоит на
+    последнем доставленном эпизоде: после перезапуска бота или временной ошибки задание
+    продолжается со следующего. При временной ошибке задание возвращается в очередь
+    с растущей паузой, после DELIVERY_MAX_RETRIES повторов без прогресса - failed.
+    """
+
+    def __init__(self, workers=DELIVERY_WORKERS, mode=EPISODE_DELIVERY_MODE):
+        self.workers = max(1, workers)
+        self.batch_size = MEDIA_GROUP_SIZE if mode == 'album' else 1
+        self.bot = None
+        self._queues = []
+        self._tasks = []
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.resumed = 0
+        self.retried = 0
+        self._retries = {}  # job_id -> повторов подряд без прогресса
+
+    async def start(self, bot):
+        """Запускает воркеров и возвращает в очередь незавершенные задания"""
+        self.bot = bot
+        self._queues = [asyncio.Queue() for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._worker(queue)) for queue in self._queues]
+        for job_id, chat_id in await db.get_unfinished_delivery_jobs():
+            self._queue_for(chat_id).put_nowait(job_id)
+            self.resumed += 1
+        if self.resumed:
+            logger.info(f"♻️ Yuborish navbati tiklandi: {self.resumed} ta vazifa")
+
+    async def stop(self):
+        """Останавливает воркеров; прерванные задания останутся в таблице и продолжатся после запуска"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _queue_for(self, chat_id):
+        return self._queues[chat_id % self.workers]
+
+    async def enqueue(self, chat_id, dorama_code, total, progress_message_id=None):
+        """Ставит задание в очередь; None - такое задание уже выполняется"""
+        if await db.find_active_delivery_job(chat_id, dorama_code):
+            return None
+        job_id = await db.create_delivery_job(chat_id, dorama_code, total, progress_message_id)
+        self._queue_for(chat_id).put_nowait(job_id)
+        return job_id
+
+    async def _worker(self, queue):
+        while True:
+            job_id = await queue.get()
+            self.running += 1
+            try:
+                await self._run_job(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"❌ Yuborish vazifasi {job_id} xatosi: {e}")
+                await db.update_delivery_job(job_id, status='failed', error=str(e))
+            finally:
+                self.running -= 1
+                queue.task_done()
+
+    async def _run_job(self, job_id):
+        job = await db.get_delivery_job(job_id)
+        if not job or job[3] not in ['pending', 'running']:
+            return
+        _, chat_id, dorama_code, status, cursor, sent, total, progress_message_id = job
+
+        dorama = await db.get_dorama(dorama_code)
+        if not dorama:
+            await db.update_delivery_job(job_id, status='failed', error='dorama not found')
+            self.failed += 1
+            return
+        title = dorama[1]
+
+        await db.update_delivery_job(job_id, status='running')
+        last_progress = 0.0
+        while True:
+            batch = await db.get_episodes_after(dorama_code, cursor, self.batch_size)
+            if not batch:
+                break
+            delivered, batch_cursor, error = await deliver_batch(self.bot, chat_id, dorama_code, title, batch)
+            if batch_cursor is not None:
+                # Курсор двигаем только до последнего доставленного (или битого) эпизода
+                cursor = batch_cursor
+                sent += len(delivered)
+                await db.update_delivery_job(job_id, cursor=cursor, sent=sent)
+                self._retries.pop(job_id, None)
+            if error is not None:
+                await self._handle_error(job_id, chat_id, title, sent, total, progress_message_id, error)
+                return
+
+            if progress_message_id and sent < total and time.monotonic() - last_progress >= DELIVERY_PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                await self._report_progress(chat_id, progress_message_id, f"⏳ {title}: {sent}/{total} qism yuborildi...")
+
+        await db.update_delivery_job(job_id, status='done')
+        self._retries.pop(job_id, None)
+        self.completed += 1
+        if progress_message_id:
+            await self._report_progress(chat_id, progress_message_id, f"✅ {title}: {sent}/{total} qism yuborildi")
+
+        # Отправляем сообщение о завершении
+        completion_text = f"✅ **{title}**\n\n"
+        if sent >= total:
+            completion_text += f"🎬 Barcha {sent} qism muvaffaqiyatli yuklandi!\n\n"
+        else:
+            completion_text += f"🎬 {sent}/{total} qism yuklandi, {total - sent} qismni yuborib bo'lmadi.\n\n"
+        completion_text += "Boshqa dorama qidirish uchun /start ni bosing"
+        await self.bot.send_message(chat_id=chat_id, text=completion_text, reply_markup=get_main_menu_keyboard(),
+                                    rate_limit_args=BULK)
+
+    async def _handle_error(self, job_id, chat_id, title, sent, total, progress_message_id, error):
+        """Ошибка посреди задания: недостижимый чат - failed, временная - повтор с паузой"""
+        if classify_send_error(error) != TRANSIENT:
+            # Пользователь заблокировал бота или чата нет - продолжать бессмысленно
+            await db.update_delivery_job(job_id, status='failed', error=str(error))
+            await db.mark_users_unreachable([chat_id])
+            self.failed += 1
+            return
+
+        attempt = self._retries.get(job_id, 0) + 1
+        if attempt > DELIVERY_MAX_RETRIES:
+            self._retries.pop(job_id, None)
+            await db.update_delivery_job(job_id, status='failed', error=str(error))
+            self.failed += 1
+            logger.error(f"❌ Yuborish vazifasi {job_id} to'xtatildi ({sent}/{total}): {error}")
+            text = f"❌ {title}: {sent}/{total} qism yuborildi. Keyinroq qayta urinib ko'ring."
+            if progress_message_id:
+                await self._report_progress(chat_id, progress_message_id, text)
+            else:
+                await self.bot.send_message(chat_id=chat_id, text=text, rate_limit_args=BULK)
+            return
+
+        self._retries[job_id] = attempt
+        self.retried += 1
+        delay = DELIVERY_RETRY_DELAY * 2 ** (attempt - 1)
+        if isinstance(error, RetryAfter):
+            delay = max(delay, retry_after_seconds(error))
+        logger.warning(f"Yuborish vazifasi {job_id}: {error}, {delay:.0f}s dan keyin qayta urinish ({attempt})")
+        # Задание остается running: если бот остановится раньше, оно продолжится после запуска
+        await db.update_delivery_job(job_id, error=str(error))
+        asyncio.get_running_loop().call_later(delay, self._requeue, chat_id, job_id)
 
-def get_admin_requests_keyboard(requests, page, total_pages):
-    """Клавиатура для управления заявками"""
-    keyboard = []
-    
-    for user_id, channel_id, status, created_at, username, first_name, title in requests:
-        user_display = f"@{username}" if username else first_name
-        request_text = f"{user_display} - {title[:20]}..."
-        keyboard.append([
-            InlineKeyboardButton(request_text, callback_data=f"admin_request_info_{user_id}_{channel_id}"),
-            InlineKeyboardButton("✅", callback_data=f"admin_approve_request_{user_id}_{channel_id}")
-        ])
-    
-    # Пагинация
-    nav_buttons = []
-    if page > 0:
-        nav_buttons.append(InlineKeyboardButton("⬅️", callback_data=f"admin_requests_{page-1}"))
-    
-    nav_buttons.append(InlineKeyboardButton(f"{page+1}/{total_pages}", callback_data="current_page"))
-    
-    if page < total_pages - 1:
-        nav_buttons.append(InlineKeyboardButton("➡️", callback_data=f"admin_requests_{page+1}"))
-    
-    if nav_buttons:
-        keyboard.append(nav_buttons)
-    
-    keyboard.append([InlineKeyboardButton("🔙 Admin", callback_data="admin_menu")])
-    
-    return InlineKeyboardMarkup(keyboard)
+    def _requeue(self, chat_id, job_id):
+        if self._queues:
+            self._queue_for(chat_id).put_nowait(job_id)
+
+    async def _report_progress(self, chat_id, message_id, text):
+        try:
+            await self.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, rate_limit_args=BULK)
+        except Exception as e:
+            # Прогресс - не главное: сообщение могли удалить, текст мог не измениться
+            logger.debug(f"Progress yangilanmadi ({chat_id}): {e}")
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'queued': sum(queue.qsize() for queue in self._queues),
+            'running': self.running,
+            'completed': self.completed,
+            'failed': self.failed,
+            'resumed': self.resumed,
+            'retried': self.retried,
+        }
+
+delivery = DeliveryQueue()
+register_metrics('delivery', delivery.stats)
 
 # ОСНОВНЫЕ ФУНКЦИИ
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     user = update.effective_user
-    db.add_user(user.id, user.username, user.first_name, user.last_name)
-    db.update_user_activity(user.id)
+    await db.add_user(user.id, user.username, user.first_name, user.last_name)
+    await db.update_user_activity(user.id)
     
     if user.id in ADMIN_IDS:
         await update.message.reply_text(
@@ -950,7 +3414,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await require_subscription(update, context):
         return
     
-    welcome_message = db.get_setting('welcome_message') or "🎬 Xush kelibsiz! Koreys doramalarini tomosha qilish uchun maxsus bot."
+    welcome_message = await db.get_setting('welcome_message') or "🎬 Xush kelibsiz! Koreys doramalarini tomosha qilish uchun maxsus bot."
     
     await update.message.reply_text(
         f"{welcome_message}\n\n"
@@ -963,7 +3427,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     text = update.message.text.strip()
     
-    db.update_user_activity(user.id)
+    await db.update_user_activity(user.id)
     
     if user.id not in ADMIN_IDS:
         if not await require_subscription(update, context):
@@ -1000,7 +3464,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def search_doramas(update: Update, context: ContextTypes.DEFAULT_TYPE, query):
     """Поиск дорам"""
-    doramas = db.search_doramas(query)
+    doramas, source, similarity = await db.search_doramas(query)
     
     if not doramas:
         await update.message.reply_text(
@@ -1009,11 +3473,16 @@ async def search_doramas(update: Update, context: ContextTypes.DEFAULT_TYPE, que
         )
         return
     
-    if len(doramas) == 1:
+    # Сразу шлем все серии только при уверенном совпадении, а не по догадке нечеткого поиска
+    certain = source != SEARCH_FUZZY or similarity >= SEARCH_AUTOSEND_SIMILARITY
+    if len(doramas) == 1 and certain:
         dorama_code = doramas[0][0]
         await send_all_episodes(update, context, dorama_code)
     else:
-        text = f"🔍 '{query}' bo'yicha topilgan doramalar ({len(doramas)} ta):\n\n"
+        if source == SEARCH_FUZZY:
+            text = f"🤔 '{query}' topilmadi. Balki shulardan birini qidirgandirsiz:\n\n"
+        else:
+            text = f"🔍 '{query}' bo'yicha topilgan doramalar ({len(doramas)} ta):\n\n"
         for i, dorama in enumerate(doramas, 1):
             # Безопасная распаковка
             if len(dorama) >= 5:
@@ -1030,12 +3499,11 @@ async def search_doramas(update: Update, context: ContextTypes.DEFAULT_TYPE, que
         
         await update.message.reply_text(text, reply_markup=get_dorama_list_keyboard(doramas))
 
-async def send_all_episodes(update: Update, context: ContextTypes.DEFAULT_TYPE, dorama_code):
-    """Отправляет все эпизоды дорамы подряд"""
-    dorama = db.get_dorama(dorama_code)
-    episodes = db.get_all_episodes(dorama_code)
+async def send_all_episodes(update: Update, context: ContextTypes.DEFAULT_TYPE, dorama_ref):
+    """Ставит в очередь отправку всех эпизодов дорамы (dorama_ref - код или doramas.id)"""
+    card = await render_dorama_card(dorama_ref)
     
-    if not dorama or not episodes:
+    if not card or not card[2]:
         # Проверяем тип обновления
         if hasattr(update, 'callback_query') and update.callback_query:
             await update.callback_query.edit_message_text("❌ Dorama yoki qismlar topilmadi")
@@ -1043,7 +3511,7 @@ async def send_all_episodes(update: Update, context: ContextTypes.DEFAULT_TYPE,
             await update.message.reply_text("❌ Dorama yoki qismlar topilmadi")
         return
     
-    code, title, description, release_year, genre, rating, poster = dorama
+    dorama_code, title, total_episodes, card_text, _ = card
     
     # Определяем пользователя в зависимости от типа обновления
     if hasattr(update, 'callback_query') and update.callback_query:
@@ -1054,71 +3522,25 @@ async def send_all_episodes(update: Update, context: ContextTypes.DEFAULT_TYPE,
         is_callback = False
     
     # Отправляем информацию о дораме
-    info_text = f"📺 **{title}**\n\n"
-    
-    if description:
-        info_text += f"📖 {description}\n\n"
-    
-    info_text += f"📊 **Ma'lumotlar:**\n"
-    info_text += f"• 🎬 Kod: `{code}`\n"
-    info_text += f"• 📋 Jami qismlar: {len(episodes)} ta\n"
-    
-    if release_year:
-        info_text += f"• 🗓️ Yil: {release_year}\n"
-    
-    if genre:
-        info_text += f"• 🎭 Janr: {genre}\n"
-    
-    if rating and rating > 0:
-        info_text += f"• ⭐ Reyting: {rating}/10\n"
-    
-    info_text += f"\n🎬 **{len(episodes)} ta qism yuklanmoqda...**"
+    info_text = card_text + f"\n🎬 **{total_episodes} ta qism yuklanmoqda...**"
     
     if is_callback:
         await update.callback_query.edit_message_text(info_text)
         chat_id = user.id
     else:
-        info_message = await update.message.reply_text(info_text)
+        await update.message.reply_text(info_text)
         chat_id = update.message.chat_id
     
-    # Отправляем все эпизоды подряд
-    sent_count = 0
-    for episode in episodes:
-        episode_number, file_id, caption, duration, file_size, views = episode
-        
-        try:
-            message_caption = caption or f"📺 {title}\n\nQism: {episode_number}"
-            
-            await context.bot.send_video(
-                chat_id=chat_id,
-                video=file_id,
-                caption=message_caption,
-                protect_content=True
-            )
-            
-            # Увеличиваем счетчик просмотров
-            db.increment_views(dorama_code, episode_number)
-            
-            sent_count += 1
-            await asyncio.sleep(1)  # Задержка между отправками
-            
-        except Exception as e:
-            logger.error(f"Video yuborish xatosi (qism {episode_number}): {e}")
-            continue
-    
-    # Отправляем сообщение о завершении
-    completion_text = f"✅ **{title}**\n\n"
-    completion_text += f"🎬 Barcha {sent_count} qism muvaffaqiyatli yuklandi!\n\n"
-    completion_text += "Boshqa dorama qidirish uchun /start ni bosing"
-    
-    if is_callback:
-        await context.bot.send_message(chat_id=chat_id, text=completion_text, reply_markup=get_main_menu_keyboard())
-    else:
-        await update.message.reply_text(completion_text, reply_markup=get_main_keyboard())
+    # Отправка идет в фоне: обработчик только ставит задание в очередь
+    progress_message = await context.bot.send_message(chat_id=chat_id, text=f"⏳ {title}: navbatga qo'yildi...")
+    job_id = await delivery.enqueue(chat_id, dorama_code, total_episodes, progress_message.message_id)
+    if job_id is None:
+        await progress_message.edit_text(f"⏳ {title}: bu dorama allaqachon yuborilmoqda")
 
-async def send_single_episode(update: Update, context: ContextTypes.DEFAULT_TYPE, dorama_code, episode_number):
-    """Отправляет один эпизод"""
-    episode = db.get_episode(dorama_code, episode_number)
+async def send_single_episode(update: Update, context: ContextTypes.DEFAULT_TYPE, dorama_ref, episode_number):
+    """Отправляет один эпизод (dorama_ref - код или doramas.id)"""
+    dorama_code = dorama_code_of(dorama_ref)
+    episode = await db.get_episode(dorama_code, episode_number) if dorama_code else None
     
     if not episode:
         await update.callback_query.answer("❌ Qism topilmadi", show_alert=True)
@@ -1135,11 +3557,12 @@ async def send_single_episode(update: Update, context: ContextTypes.DEFAULT_TYPE
             chat_id=user.id,
             video=file_id,
             caption=message_caption,
-            protect_content=True
+            protect_content=PROTECT_CONTENT
         )
         
         # Увеличиваем счетчик просмотров
-        db.increment_views(dorama_code, episode_number)
+        await db.increment_views(dorama_code, episode_number)
+        await db.record_watch(user.id, dorama_code)
         
         await update.callback_query.answer(f"✅ {episode_number}-qism yuklandi")
         
@@ -1147,76 +3570,57 @@ async def send_single_episode(update: Update, context: ContextTypes.DEFAULT_TYPE
         logger.error(f"Video yuborish xatosi: {e}")
         await update.callback_query.answer("❌ Video yuborishda xato", show_alert=True)
 
-async def show_dorama_info(update: Update, context: ContextTypes.DEFAULT_TYPE, dorama_code):
-    """Показывает информацию о дораме с выбором действия"""
-    dorama = db.get_dorama(dorama_code)
-    total_episodes = db.get_total_episodes(dorama_code)
+async def show_dorama_info(update: Update, context: ContextTypes.DEFAULT_TYPE, dorama_ref):
+    """Показывает информацию о дораме с выбором действия (dorama_ref - код или doramas.id)"""
+    card = await render_dorama_card(dorama_ref)
     
-    if not dorama:
+    if not card:
         if hasattr(update, 'callback_query') and update.callback_query:
             await update.callback_query.edit_message_text("❌ Dorama topilmadi")
         else:
             await update.message.reply_text("❌ Dorama topilmadi")
         return
     
-    code, title, description, release_year, genre, rating, poster = dorama
-    
-    text = f"📺 **{title}**\n\n"
-    
-    if description:
-        text += f"📖 {description}\n\n"
-    
-    text += f"📊 **Ma'lumotlar:**\n"
-    text += f"• 🎬 Kod: `{code}`\n"
-    text += f"• 📋 Jami qismlar: {total_episodes} ta\n"
-    
-    if release_year:
-        text += f"• 🗓️ Yil: {release_year}\n"
-    
-    if genre:
-        text += f"• 🎭 Janr: {genre}\n"
-    
-    if rating and rating > 0:
-        text += f"• ⭐ Reyting: {rating}/10\n"
-    
-    text += f"\n🎬 **Tanlang:**"
-    
-    keyboard = get_dorama_keyboard(dorama_code, total_episodes)
+    dorama_code, title, total_episodes, card_text, keyboard = card
+    text = card_text + f"\n🎬 **Tanlang:**"
     
     if hasattr(update, 'callback_query') and update.callback_query:
         await update.callback_query.edit_message_text(text, reply_markup=keyboard)
     else:
         await update.message.reply_text(text, reply_markup=keyboard)
 
-async def show_all_episodes(update: Update, context: ContextTypes.DEFAULT_TYPE, dorama_code, page=0):
-    """Показывает все эпизоды дорамы для выбора"""
-    episodes = db.get_all_episodes(dorama_code)
-    dorama = db.get_dorama(dorama_code)
+async def show_all_episodes(update: Update, context: ContextTypes.DEFAULT_TYPE, dorama_ref, page=0):
+    """Показывает все эпизоды дорамы для выбора (dorama_ref - код или doramas.id)"""
+    rendered = await render_episodes_page(dorama_ref, page)
     
-    if not episodes or not dorama:
+    if not rendered:
         await update.callback_query.edit_message_text("❌ Bu dorama uchun qismlar topilmadi")
         return
     
-    title = dorama[1]
-    total_episodes = len(episodes)
-    
-    text = f"📺 {title}\n\n"
-    text += f"📋 Barcha qismlar ({total_episodes} ta):\n\n"
-    text += "Kerakli qismni tanlang yoki barchasini yuborish tugmasini bosing:"
-    
-    keyboard = get_all_episodes_keyboard(dorama_code, page)
+    text, keyboard = rendered
     await update.callback_query.edit_message_text(text, reply_markup=keyboard)
 
-async def show_all_doramas(update: Update, context: ContextTypes.DEFAULT_TYPE, page=0):
-    """Показывает все дорамы"""
-    doramas = db.get_all_doramas()
+async def show_all_doramas(update: Update, context: ContextTypes.DEFAULT_TYPE, page=0, after=None, before=None):
+    """Показывает каталог дорам постранично"""
+    doramas, has_prev, has_next = await db.get_doramas_page(after=after, before=before)
+    if not has_prev:
+        page = 0
+    
+    if update.callback_query:
+        send = update.callback_query.edit_message_text
+    else:
+        send = update.message.reply_text
     
     if not doramas:
-        await update.message.reply_text("📚 Hozircha doramalar mavjud emas")
+        await send("📚 Hozircha doramalar mavjud emas")
         return
     
-    text = "📚 Barcha doramalar:\n\n"
-    for i, dorama in enumerate(doramas, 1):
+    total_count = await db.get_doramas_count()
+    total_pages = max(1, math.ceil(total_count / CATALOG_PAGE_SIZE))
+    page = min(page, total_pages - 1)
+    
+    text = f"📚 Barcha doramalar (Sahifa {page+1}/{total_pages}):\n\n"
+    for i, dorama in enumerate(doramas, page * CATALOG_PAGE_SIZE + 1):
         # Безопасная распаковка
         if len(dorama) == 6:
             code, title, year, genre, rating, episode_count = dorama
@@ -1233,19 +3637,18 @@ async def show_all_doramas(update: Update, context: ContextTypes.DEFAULT_TYPE, p
             text += f" - {episode_count} qism"
         text += "\n"
     
-    await update.message.reply_text(text, reply_markup=get_dorama_list_keyboard(doramas))
+    nav_buttons = get_catalog_nav_buttons("all_doramas", doramas, page, total_pages, has_prev, has_next)
+    await send(text, reply_markup=get_dorama_list_keyboard(doramas, nav_buttons=nav_buttons))
 
 async def show_recent_doramas(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает недавно добавленные дорамы"""
-    doramas = db.get_all_doramas()
+    # Берем последние 10 дорам
+    recent_doramas = await db.get_recent_doramas(10)
     
-    if not doramas:
+    if not recent_doramas:
         await update.message.reply_text("🆕 Hozircha yangi doramalar yo'q")
         return
     
-    # Берем последние 10 дорам
-    recent_doramas = doramas[:10]
-    
     text = "🆕 So'ngi qo'shilgan doramalar:\n\n"
     for i, dorama in enumerate(recent_doramas, 1):
         # Безопасная распаковка
@@ -1268,7 +3671,7 @@ async def show_recent_doramas(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 async def show_popular_doramas(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает популярные дорамы"""
-    stats = db.get_admin_stats()
+    stats = await db.get_admin_stats()
     
     if not stats['popular_doramas']:
         await update.message.reply_text("📊 Hozircha mashhur doramalar yo'q")
@@ -1282,7 +3685,7 @@ async def show_popular_doramas(update: Update, context: ContextTypes.DEFAULT_TYP
 
 async def send_random_dorama(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Отправляет случайную дораму"""
-    doramas = db.get_all_doramas()
+    doramas = await db.get_all_doramas()
     
     if not doramas:
         if update.callback_query:
@@ -1319,8 +3722,10 @@ async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # АДМИН ФУНКЦИИ
 async def show_admin_stats(query):
     """Показывает статистику для админа"""
-    stats = db.get_admin_stats()
-    active_users = db.get_active_users_count()
+    stats = await db.get_admin_stats()
+    active_users = await db.get_active_users_count()
+    pending_requests = await db.get_pending_requests_count()
+    unreachable, saved_sends = await db.get_unreachable_stats()
     
     text = (
         f"📊 **Admin statistikasi:**\n\n"
@@ -1329,7 +3734,8 @@ async def show_admin_stats(query):
         f"👥 **Foydalanuvchilar:** {stats['total_users']} ta\n"
         f"📈 **Faol foydalanuvchilar (30 kun):** {active_users} ta\n"
         f"📈 **Kunlik aktiv:** {stats['daily_active']} ta\n"
-        f"🆕 **Kutilayotgan so'rovlar:** {db.get_pending_requests_count()} ta\n\n"
+        f"🚫 **Botni bloklaganlar:** {unreachable} ta (tejalgan yuborishlar: {saved_sends})\n"
+        f"🆕 **Kutilayotgan so'rovlar:** {pending_requests} ta\n\n"
         f"🔥 **Eng mashhur doramalar:**\n"
     )
     
@@ -1339,18 +3745,18 @@ async def show_admin_stats(query):
     keyboard = [[InlineKeyboardButton("🔙 Orqaga", callback_data="admin_menu")]]
     await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
 
-async def show_admin_doramas(query, page=0, delete_mode=False):
+async def show_admin_doramas(query, page=0, delete_mode=False, after=None, before=None):
     """Показывает список дорам в админ-панели"""
-    limit = 10
+    limit = CATALOG_PAGE_SIZE
+    
+    page_doramas, has_prev, has_next = await db.get_doramas_page(after=after, before=before, limit=limit)
+    if not has_prev:
+        page = 0
+    total_count = await db.get_doramas_count()
+    total_pages = max(1, math.ceil(total_count / limit))
+    page = min(page, total_pages - 1)
     offset = page * limit
     
-    doramas = db.get_all_doramas()
-    total_count = len(doramas)
-    total_pages = (total_count + limit - 1) // limit if total_count > 0 else 1
-    
-    # Берем только нужную страницу
-    page_doramas = doramas[offset:offset + limit]
-    
     if not page_doramas:
         await query.edit_message_text(
             "📭 Hozircha doramalar mavjud emas",
@@ -1377,17 +3783,20 @@ async def show_admin_doramas(query, page=0, delete_mode=False):
             
         text += f"{i}. 🎬 {title}\n   🔗 Kod: {code}\n   📺 Qismlar: {episode_count} ta\n\n"
     
-    await query.edit_message_text(text, reply_markup=get_admin_dorama_list_keyboard(page_doramas, page, total_pages, delete_mode))
+    callback_prefix = "admin_delete" if delete_mode else "admin_doramas"
+    nav_buttons = get_catalog_nav_buttons(callback_prefix, page_doramas, page, total_pages, has_prev, has_next)
+    await query.edit_message_text(text, reply_markup=get_admin_dorama_list_keyboard(page_doramas, nav_buttons, delete_mode))
 
-async def show_delete_confirmation(query, dorama_code):
-    """Показывает подтверждение удаления дорамы"""
-    dorama = db.get_dorama(dorama_code)
+async def show_delete_confirmation(query, dorama_ref):
+    """Показывает подтверждение удаления дорамы (dorama_ref - код или doramas.id)"""
+    dorama = await get_dorama_by_ref(dorama_ref)
     if not dorama:
         await query.answer("❌ Dorama topilmadi", show_alert=True)
         return
     
     code, title, description, release_year, genre, rating, poster = dorama
-    total_episodes = db.get_total_episodes(dorama_code)
+    dorama_code = code
+    total_episodes = await db.get_total_episodes(dorama_code)
     
     text = (
         f"⚠️ **DORAMANI O'CHIRISH** ⚠️\n\n"
@@ -1401,30 +3810,32 @@ async def show_delete_confirmation(query, dorama_code):
     
     await query.edit_message_text(text, reply_markup=get_admin_delete_confirmation_keyboard(dorama_code))
 
-async def delete_dorama_confirmed(query, dorama_code):
-    """Удаляет дораму после подтверждения"""
-    success = db.delete_dorama(dorama_code)
+async def delete_dorama_confirmed(query, dorama_ref):
+    """Удаляет дораму после подтверждения (dorama_ref - код или doramas.id)"""
+    dorama_code = dorama_code_of(dorama_ref)
+    success = await db.delete_dorama(dorama_code) if dorama_code else False
     
     if success:
         await query.edit_message_text(
             f"✅ Dorama #{dorama_code} o'chirildi!",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Doramalar ro'yxati", callback_data="admin_delete_0")]])
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Doramalar ro'yxati", callback_data=callback_data("admin_delete", 0))]])
         )
     else:
         await query.edit_message_text(
             f"❌ Doramani o'chirishda xato!",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Doramalar ro'yxati", callback_data="admin_delete_0")]])
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Doramalar ro'yxati", callback_data=callback_data("admin_delete", 0))]])
         )
 
-async def show_admin_dorama_info(query, dorama_code):
-    """Показывает детальную информацию о дораме для админа"""
-    dorama = db.get_dorama(dorama_code)
+async def show_admin_dorama_info(query, dorama_ref):
+    """Показывает детальную информацию о дораме для админа (dorama_ref - код или doramas.id)"""
+    dorama = await get_dorama_by_ref(dorama_ref)
     if not dorama:
         await query.answer("❌ Dorama topilmadi", show_alert=True)
         return
     
     code, title, description, release_year, genre, rating, poster = dorama
-    total_episodes = db.get_total_episodes(dorama_code)
+    dorama_code = code
+    total_episodes = await db.get_total_episodes(dorama_code)
     
     text = f"🎬 **Dorama ma'lumotlari**\n\n"
     text += f"📝 **Nomi:** {title}\n"
@@ -1444,30 +3855,35 @@ async def show_admin_dorama_info(query, dorama_code):
         text += f"\n📄 **Tavsif:**\n{description[:200]}..."
     
     keyboard = [
-        [InlineKeyboardButton("🗑️ O'chirish", callback_data=f"admin_delete_confirm_{dorama_code}")],
-        [InlineKeyboardButton("🔙 Doramalar ro'yxati", callback_data="admin_doramas_0")]
+        [InlineKeyboardButton("🗑️ O'chirish", callback_data=callback_data("admin_delete_confirm", dorama_code))],
+        [InlineKeyboardButton("🔙 Doramalar ro'yxati", callback_data=callback_data("admin_doramas", 0))]
     ]
     
     await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
 
 async def show_admin_channels(query):
     """Показывает каналы для админа"""
-    channels = db.get_all_channels()
+    channels = await db.get_all_channels()
     
     text = "📢 **Kanallar ro'yxati:**\n\n"
     if channels:
-        for channel_id, username, title, invite_link, is_private in channels:
+        for channel_id, username, title, invite_link, is_private, fail_open in channels:
             channel_type = "🔒 Maxfiy" if is_private else "📢 Ochiq"
             text += f"• {channel_type} {title or username or f'Kanal {channel_id}'}\n"
             if invite_link:
                 text += f"  🔗 Link: {invite_link}\n"
-            text += f"  🆔 ID: {channel_id}\n\n"
+            text += f"  🆔 ID: {channel_id}\n"
+            if not is_private:
+                policy = "o'tkazish" if fail_open else "bloklash"
+                text += f"  ⚠️ Xatoda: {policy}\n"
+            text += "\n"
     else:
         text += "📭 Hozircha kanallar yo'q\n"
     
     text += "\n**Kanal qo'shish:** /addchannel <id> <@username> [nomi] [invite_link] [private]"
     text += "\n**Maxfiy kanal qo'shish:** /addprivatechannel <id> <invite_link> [nomi]"
     text += "\n**Kanal o'chirish:** /deletechannel <id>"
+    text += "\n**Xato siyosati:** /channelpolicy <id> open|closed"
     
     keyboard = [[InlineKeyboardButton("🔙 Orqaga", callback_data="admin_menu")]]
     await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
@@ -1476,8 +3892,9 @@ async def show_admin_requests(query, page=0):
     """Показывает список заявок для админа"""
     # В реальной реализации здесь будет запрос к базе данных
     # Для примера покажем заглушку
+    pending_requests = await db.get_pending_requests_count()
     text = "🆕 **Kutilayotgan so'rovlar:**\n\n"
-    text += f"📊 Jami so'rovlar: {db.get_pending_requests_count()} ta\n\n"
+    text += f"📊 Jami so'rovlar: {pending_requests} ta\n\n"
     text += "Bu yerda foydalanuvchilarning maxfiy kanallarga so'rovlari ko'rsatiladi."
     
     # Заглушка для демонстрации
@@ -1488,9 +3905,9 @@ async def show_admin_requests(query, page=0):
 
 async def show_admin_settings(query):
     """Показывает настройки бота"""
-    welcome_message = db.get_setting('welcome_message')
-    help_message = db.get_setting('help_message')
-    archive_channel = db.get_setting('archive_channel')
+    welcome_message = await db.get_setting('welcome_message')
+    help_message = await db.get_setting('help_message')
+    archive_channel = await db.get_setting('archive_channel')
     
     text = (
         f"⚙️ **Bot sozlamalari:**\n\n"
@@ -1578,7 +3995,7 @@ async def handle_settings_message(update: Update, context: ContextTypes.DEFAULT_
     
     if context.user_data.get('awaiting_welcome_message'):
         # Сохраняем новое приветственное сообщение
-        db.update_setting('welcome_message', text)
+        await db.update_setting('welcome_message', text)
         await update.message.reply_text(
             "✅ Xush kelish xabari muvaffaqiyatli o'zgartirildi!",
             reply_markup=get_admin_keyboard()
@@ -1587,7 +4004,7 @@ async def handle_settings_message(update: Update, context: ContextTypes.DEFAULT_
         
     elif context.user_data.get('awaiting_help_message'):
         # Сохраняем новое сообщение помощи
-        db.update_setting('help_message', text)
+        await db.update_setting('help_message', text)
         await update.message.reply_text(
             "✅ Yordam xabari muvaffaqiyatli o'zgartirildi!",
             reply_markup=get_admin_keyboard()
@@ -1596,21 +4013,176 @@ async def handle_settings_message(update: Update, context: ContextTypes.DEFAULT_
         
     elif context.user_data.get('awaiting_archive_channel'):
         # Сохраняем новый ID архива канала
-        db.update_setting('archive_channel', text)
+        await db.update_setting('archive_channel', text)
         await update.message.reply_text(
             "✅ Arxiv kanali muvaffaqiyatli o'zgartirildi!",
             reply_markup=get_admin_keyboard()
         )
         context.user_data.pop('awaiting_archive_channel', None)
 
-# ПРОСТАЯ ФУНКЦИЯ РАССЫЛКИ
+# РАССЫЛКИ
+class BroadcastEngine:
+    """Рассылка сообщения пользователям (всем или сегменту) в фоне
+
+    Пользователи сегмента читаются страницами по user_id, каждую страницу отправляют
+    BROADCAST_SENDERS параллельных отправителей (темп задает общий rate_limiter).
+    Курсор и счетчики сохраняются после каждой страницы, поэтому после перезапуска
+    рассылка продолжается с места остановки.
+    """
+
+    def __init__(self, senders=BROADCAST_SENDERS, page_size=BROADCAST_PAGE_SIZE):
+        self.senders = max(1, senders)
+        self.page_size = max(1, page_size)
+        self.bot = None
+        self._tasks = {}  # broadcast_id -> задача
+
+    async def start(self, bot):
+        """Продолжает рассылки, прерванные остановкой бота"""
+        self.bot = bot
+        for broadcast_id in await db.get_running_broadcasts():
+            logger.info(f"♻️ Xabar yuborish davom ettirilmoqda: #{broadcast_id}")
+            self._spawn(broadcast_id)
+
+    async def stop(self):
+        """Останавливает рассылки; они продолжатся после следующего запуска"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def launch(self, admin_chat_id, from_chat_id, message_id, progress_message_id,
+                     active_days=None, dorama_code=None):
+        """Создает рассылку по сегменту (по умолчанию - все пользователи) и запускает ее в фоне"""
+        total = await db.get_segment_count(active_days, dorama_code)
+        skipped = await db.get_segment_count(active_days, dorama_code, reachable=False)
+        broadcast_id = await db.create_broadcast(
+            admin_chat_id, from_chat_id, message_id, progress_message_id, total, active_days, dorama_code, skipped
+        )
+        self._spawn(broadcast_id)
+        return broadcast_id
+
+    def _spawn(self, broadcast_id):
+        task = asyncio.create_task(self._run(broadcast_id))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda done: self._finished(broadcast_id, done))
+
+    def _finished(self, broadcast_id, task):
+        self._tasks.pop(broadcast_id, None)
+        if not task.cancelled() and task.exception():
+            logger.error(f"❌ Xabar yuborish #{broadcast_id} to'xtadi: {task.exception()}")
+
+    async def _send(self, user_id, from_chat_id, message_id, slots):
+        """Пересылает сообщение одному пользователю и возвращает исход (SENT или класс ошибки)"""
+        async with slots:
+            try:
+                await self.bot.forward_message(
+                    chat_id=user_id,
+                    from_chat_id=from_chat_id,
+                    message_id=message_id,
+                    rate_limit_args=BULK
+                )
+                return SENT
+            except Exception as e:
+                outcome = classify_send_error(e)
+                if outcome == TRANSIENT:
+                    logger.warning(f"Xabar yuborishda xato {user_id}: {e}")
+                return outcome
+
+    async def _run(self, broadcast_id):
+        broadcast = await db.get_broadcast(broadcast_id)
+        if not broadcast:
+            return
+        (_, admin_chat_id, from_chat_id, message_id, progress_message_id,
+         status, cursor, total, sent, failed, unreachable, elapsed, active_days, dorama_code) = broadcast
+
+        slots = asyncio.Semaphore(self.senders)
+        started = time.monotonic() - elapsed
+        last_progress = 0.0
+        # При остановке бота задача отменяется, курсор последней страницы уже сохранен
+        while True:
+            user_ids = await db.get_user_ids_after(cursor, self.page_size, active_days, dorama_code)
+            if not user_ids:
+                break
+            outcomes = await asyncio.gather(*(
+                self._send(user_id, from_chat_id, message_id, slots) for user_id in user_ids
+            ))
+            # Заблокировавших бота и удаленные чаты больше не трогаем ни в этой, ни в следующих рассылках
+            dead = [user_id for user_id, outcome in zip(user_ids, outcomes) if outcome in (FORBIDDEN, CHAT_NOT_FOUND)]
+            await db.mark_users_unreachable(dead)
+            sent += outcomes.count(SENT)
+            unreachable += len(dead)
+            failed += len(outcomes) - outcomes.count(SENT) - len(dead)
+            cursor = user_ids[-1]
+            await db.update_broadcast(broadcast_id, cursor, sent, failed, unreachable, time.monotonic() - started)
+
+            if time.monotonic() - last_progress >= BROADCAST_PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                await self._edit_progress(admin_chat_id, progress_message_id, (
+                    f"📤 Xabar yuborilmoqda...\n\n"
+                    f"📊 Progress: {sent + failed + unreachable}/{total}\n"
+                    f"✅ Muvaffaqiyatli: {sent}\n"
+                    f"🚫 Bloklagan: {unreachable}\n"
+                    f"❌ Xatolar: {failed}"
+                ))
+
+        elapsed = time.monotonic() - started
+        await db.update_broadcast(broadcast_id, cursor, sent, failed, unreachable, elapsed, status='done')
+        processed = sent + failed + unreachable
+        logger.info(f"✅ Xabar yuborish #{broadcast_id} yakunlandi: {sent}/{processed}, {elapsed:.1f}s")
+
+        # Финальный результат
+        result_text = (
+            f"✅ **Xabar yuborish yakunlandi!**\n\n"
+            f"📊 **Natijalar:**\n"
+            f"• 👥 Jami: {processed} ta\n"
+            f"• ✅ Muvaffaqiyatli: {sent} ta\n"
+            f"• 🚫 Bloklagan (endi o'tkazib yuboriladi): {unreachable} ta\n"
+            f"• ❌ Xatolar: {failed} ta\n"
+            f"• 📈 Muvaffaqiyat darajasi: {(sent / processed * 100) if processed else 0:.1f}%\n"
+            f"• ⏱️ Vaqt: {elapsed:.1f} s ({(processed / elapsed) if elapsed else 0:.1f} xabar/s)"
+        )
+        await self._edit_progress(admin_chat_id, progress_message_id, result_text)
+
+    async def _edit_progress(self, chat_id, message_id, text):
+        if not message_id:
+            return
+        try:
+            await self.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, rate_limit_args=BULK)
+        except Exception as e:
+            logger.debug(f"Progress yangilanmadi ({chat_id}): {e}")
+
+    def stats(self):
+        return {'running': len(self._tasks), 'senders': self.senders, 'page_size': self.page_size}
+
+broadcasts = BroadcastEngine()
+register_metrics('broadcasts', broadcasts.stats)
+
 async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда для рассылки сообщения всем пользователям"""
+    """Команда для рассылки сообщения всем пользователям или сегменту"""
     user = update.effective_user
     if user.id not in ADMIN_IDS:
         await update.message.reply_text("❌ Bu komanda faqat adminlar uchun!")
         return
     
+    try:
+        active_days, dorama_code, dry_run = parse_broadcast_segment(context.args or [])
+    except ValueError:
+        await update.message.reply_text(
+            "❌ Noto'g'ri format!\n\n"
+            "Misol: /broadcast active=7 dorama=DR001 dry"
+        )
+        return
+    if dorama_code and not await db.get_dorama(dorama_code):
+        await update.message.reply_text(f"❌ {dorama_code} kodli dorama topilmadi")
+        return
+    segment = describe_broadcast_segment(active_days, dorama_code)
+    total_users = await db.get_segment_count(active_days, dorama_code)
+    
+    # Пробный запуск: только размер сегмента, без отправки
+    if dry_run:
+        await update.message.reply_text(f"🔎 Sinov: {segment} - {total_users} ta foydalanuvchi")
+        return
+    
     # Проверяем, является ли сообщение ответом на другое сообщение
     if not update.message.reply_to_message:
         await update.message.reply_text(
@@ -1618,70 +4190,63 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "Barcha foydalanuvchilarga xabar yuborish uchun:\n\n"
             "1. Xabaringizni yuboring (text, rasm, video)\n"
             "2. Shu xabarga javoban /broadcast buyrug'ini yozing\n\n"
-            "Yoki shunchaki /broadcast buyrug'iga javoban xabar yuboring."
+            "Yoki shunchaki /broadcast buyrug'iga javoban xabar yuboring.\n\n"
+            "🎯 Filtrlar (ixtiyoriy):\n"
+            "• active=7 - oxirgi 7 kunda faol bo'lganlar\n"
+            "• dorama=KOD - shu doramani ko'rganlar\n"
+            "• dry - yubormasdan, faqat sonini ko'rsatish"
         )
         return
     
     # Получаем сообщение для рассылки
     message_to_forward = update.message.reply_to_message
-    users = db.get_all_users()
-    total_users = len(users)
     
     if total_users == 0:
-        await update.message.reply_text("❌ Hozircha foydalanuvchilar mavjud emas")
+        await update.message.reply_text(f"❌ Hozircha foydalanuvchilar mavjud emas ({segment})")
         return
     
-    # Начинаем рассылку сразу без подтверждения
+    # Начинаем рассылку сразу без подтверждения; отправка идет в фоне
     progress_message = await update.message.reply_text(
-        f"📤 Xabar yuborilmoqda...\n\n"
+        f"📤 Xabar yuborilmoqda ({segment})...\n\n"
         f"📊 Progress: 0/{total_users}\n"
         f"✅ Muvaffaqiyatli: 0\n"
         f"❌ Xatolar: 0"
     )
     
-    successful = 0
-    failed = 0
-    
-    for i, (user_id, username, first_name, last_name) in enumerate(users, 1):
-        try:
-            # Пересылаем сообщение
-            await message_to_forward.forward(chat_id=user_id)
-            successful += 1
-            
-            # Обновляем прогресс каждые 10 сообщений
-            if i % 10 == 0 or i == total_users:
-                await context.bot.edit_message_text(
-                    chat_id=update.message.chat_id,
-                    message_id=progress_message.message_id,
-                    text=f"📤 Xabar yuborilmoqda...\n\n"
-                         f"📊 Progress: {i}/{total_users}\n"
-                         f"✅ Muvaffaqiyatli: {successful}\n"
-                         f"❌ Xatolar: {failed}"
-                )
-            
-            # Задержка чтобы не превысить лимиты Telegram
-            await asyncio.sleep(0.1)
-            
-        except Exception as e:
-            failed += 1
-            logger.error(f"Xabar yuborishda xato {user_id}: {e}")
-    
-    # Финальный результат
-    result_text = (
-        f"✅ **Xabar yuborish yakunlandi!**\n\n"
-        f"📊 **Natijalar:**\n"
-        f"• 👥 Jami: {total_users} ta\n"
-        f"• ✅ Muvaffaqiyatli: {successful} ta\n"
-        f"• ❌ Xatolar: {failed} ta\n"
-        f"• 📈 Muvaffaqiyat darajasi: {(successful/total_users)*100:.1f}%"
-    )
-    
-    await context.bot.edit_message_text(
-        chat_id=update.message.chat_id,
-        message_id=progress_message.message_id,
-        text=result_text
+    await broadcasts.launch(
+        update.message.chat_id,
+        message_to_forward.chat_id,
+        message_to_forward.message_id,
+        progress_message.message_id,
+        active_days,
+        dorama_code
     )
 
+def parse_broadcast_segment(args):
+    """Разбирает аргументы /broadcast: active=N, dorama=CODE, dry; ValueError при ошибке"""
+    active_days, dorama_code, dry_run = None, None, False
+    for arg in args:
+        key, _, value = arg.partition('=')
+        key = key.lower()
+        if key == 'dry' and not value:
+            dry_run = True
+        elif key == 'active' and value.isdigit() and int(value) > 0:
+            active_days = int(value)
+        elif key == 'dorama' and value:
+            dorama_code = value
+        else:
+            raise ValueError(arg)
+    return active_days, dorama_code, dry_run
+
+def describe_broadcast_segment(active_days, dorama_code):
+    """Описание сегмента рассылки для админа"""
+    parts = []
+    if active_days:
+        parts.append(f"oxirgi {active_days} kunda faol")
+    if dorama_code:
+        parts.append(f"{dorama_code} ni ko'rganlar")
+    return ', '.join(parts) if parts else "barcha foydalanuvchilar"
+
 async def handle_broadcast_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обрабатывает подтверждение рассылки (теперь не используется)"""
     # Эта функция больше не нужна, но оставлю для совместимости
@@ -1730,7 +4295,7 @@ async def handle_admin_video(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     try:
         # Проверяем, существует ли дорама
-        dorama = db.get_dorama(dorama_code)
+        dorama = await db.get_dorama(dorama_code)
         if not dorama:
             # Создаем новую дораму с названием из caption
             title_match = re.search(r'#nomi[_:]?([^#\n]+)', caption, re.IGNORECASE)
@@ -1743,12 +4308,12 @@ async def handle_admin_video(update: Update, context: ContextTypes.DEFAULT_TYPE)
             genre_match = re.search(r'#(\w+)', caption)
             genre = genre_match.group(1) if genre_match else ""
             
-            db.add_dorama(dorama_code, title, "", year, genre)
+            await db.add_dorama(dorama_code, title, "", year, genre)
             logger.info(f"✅ Yangi dorama yaratildi: {title} ({dorama_code})")
         
         # Добавляем эпизод
-        if db.add_episode(dorama_code, episode_number, file_id, caption, duration, file_size):
-            total_episodes = db.get_total_episodes(dorama_code)
+        if await db.add_episode(dorama_code, episode_number, file_id, caption, duration, file_size):
+            total_episodes = await db.get_total_episodes(dorama_code)
             await message.reply_text(
                 f"✅ #{dorama_code} doramasiga {episode_number}-qism qo'shildi!\n\n"
                 f"📊 Jami qismlar: {total_episodes} ta\n\n"
@@ -1791,7 +4356,7 @@ async def add_channel_command(update: Update, context: ContextTypes.DEFAULT_TYPE
             if not title:
                 title = f"@{username}" if username else f"Kanal {channel_id}"
             
-            success = db.add_channel(channel_id, username, title, invite_link, is_private)
+            success = await db.add_channel(channel_id, username, title, invite_link, is_private)
             
             if success:
                 await update.message.reply_text(
@@ -1831,7 +4396,7 @@ async def add_private_channel_command(update: Update, context: ContextTypes.DEFA
             # Название канала (опционально)
             title = context.args[2] if len(context.args) > 2 else f"Maxfiy kanal {channel_id}"
             
-            success = db.add_channel(channel_id, "", title, invite_link, True)
+            success = await db.add_channel(channel_id, "", title, invite_link, True)
             
             if success:
                 await update.message.reply_text(
@@ -1864,7 +4429,7 @@ async def delete_channel_command(update: Update, context: ContextTypes.DEFAULT_T
     if context.args:
         try:
             channel_id = int(context.args[0])
-            success = db.delete_channel(channel_id)
+            success = await db.delete_channel(channel_id)
             
             if success:
                 await update.message.reply_text("✅ Kanal o'chirildi!")
@@ -1875,6 +4440,32 @@ async def delete_channel_command(update: Update, context: ContextTypes.DEFAULT_T
     else:
         await update.message.reply_text("❌ Kanal ID sini ko'rsating: /deletechannel <id>")
 
+async def channel_policy_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Задает политику канала при ошибке проверки подписки"""
+    user = update.effective_user
+    if user.id not in ADMIN_IDS:
+        return
+    
+    if len(context.args) == 2 and context.args[1].lower() in ['open', 'closed']:
+        try:
+            channel_id = int(context.args[0])
+            fail_open = context.args[1].lower() == 'open'
+            success = await db.set_channel_fail_open(channel_id, fail_open)
+            
+            if success:
+                policy = "foydalanuvchi o'tkaziladi" if fail_open else "obuna talab qilinadi"
+                await update.message.reply_text(f"✅ Kanal {channel_id}: tekshirishda xato bo'lsa {policy}")
+            else:
+                await update.message.reply_text("❌ Kanal topilmadi")
+        except ValueError:
+            await update.message.reply_text("❌ Kanal ID raqam bo'lishi kerak")
+    else:
+        await update.message.reply_text(
+            "❌ Foydalanish: /channelpolicy <id> open|closed\n\n"
+            "• open - Telegram javob bermasa, kanal o'tkazib yuboriladi\n"
+            "• closed - Telegram javob bermasa, obuna talab qilinadi (standart)"
+        )
+
 async def delete_dorama_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда для удаления дорамы по коду"""
     user = update.effective_user
@@ -1883,7 +4474,7 @@ async def delete_dorama_command(update: Update, context: ContextTypes.DEFAULT_TY
     
     if context.args:
         dorama_code = context.args[0]
-        success = db.delete_dorama(dorama_code)
+        success = await db.delete_dorama(dorama_code)
         
         if success:
             await update.message.reply_text(f"✅ Dorama #{dorama_code} o'chirildi!")
@@ -1894,6 +4485,20 @@ async def delete_dorama_command(update: Update, context: ContextTypes.DEFAULT_TY
             "❌ Foydalanish: /deletedorama <kod>"
         )
 
+async def metrics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показывает внутренние метрики бота"""
+    user = update.effective_user
+    if user.id not in ADMIN_IDS:
+        return
+
+    text = "📈 Metrikalar:\n"
+    for name, provider in METRICS.items():
+        text += f"\n[{name}]\n"
+        for key, value in provider().items():
+            text += f"• {key}: {value}\n"
+
+    await update.message.reply_text(text)
+
 # ОБРАБОТЧИК CALLBACK
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -1902,112 +4507,374 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = query.from_user
     data = query.data
     
-    db.update_user_activity(user.id)
+    await db.update_user_activity(user.id)
     
-    if user.id not in ADMIN_IDS:
+    route, args = callbacks.resolve(data)
+    if route is None:
+        logger.debug(f"Noma'lum callback: {data}")
+        return
+    if route.admin and user.id not in ADMIN_IDS:
+        return
+    
+    # «✅ Tekshirish» сам проверяет подписку в обход кэша - не проверяем дважды
+    if user.id not in ADMIN_IDS and route.check_subscription:
         if not await require_subscription(update, context):
             return
     
-    # Основные обработчики
-    if data == "main_menu":
-        if user.id in ADMIN_IDS:
-            await query.edit_message_text("👨‍💻 Admin paneli:", reply_markup=get_admin_keyboard())
-        else:
-            await query.edit_message_text("Bosh menyu:", reply_markup=get_main_menu_keyboard())
-    
-    elif data == "search":
-        await query.edit_message_text(
-            "🔍 Dorama nomi yoki kodini kiriting:\n\n"
-            "Misol: <code>Yulduzlar</code> yoki <code>YL2024</code>",
-            parse_mode="HTML"
-        )
-    
-    elif data.startswith("all_doramas_"):
-        page = int(data.split("_")[2])
-        await show_all_doramas(update, context, page)
-    
-    elif data.startswith("recent_doramas_"):
-        page = int(data.split("_")[2])
-        await show_recent_doramas(update, context)
-    
-    elif data.startswith("popular_doramas_"):
-        page = int(data.split("_")[2])
-        await show_popular_doramas(update, context)
-    
-    elif data == "random_dorama":
-        await send_random_dorama(update, context)
-    
-    elif data == "help":
-        await show_help(update, context)
-    
-    elif data.startswith("dorama_"):
-        dorama_code = data.split("_")[1]
-        await show_dorama_info(update, context, dorama_code)
-    
-    elif data.startswith("send_all_"):
-        dorama_code = data.split("_")[2]
-        await send_all_episodes(update, context, dorama_code)
-    
-    elif data.startswith("watch_"):
-        parts = data.split("_")
-        dorama_code = parts[1]
-        episode_number = int(parts[2])
-        await send_single_episode(update, context, dorama_code, episode_number)
-    
-    elif data.startswith("all_episodes_"):
-        dorama_code = data.split("_")[2]
-        await show_all_episodes(update, context, dorama_code)
-    
-    elif data.startswith("episodes_"):
-        parts = data.split("_")
-        dorama_code = parts[1]
-        page = int(parts[2])
-        await show_all_episodes(update, context, dorama_code, page)
-    
-    elif data == "check_subscription":
-        await check_subscription_callback(update, context)
+    await callbacks.dispatch(route, args, update, context)
 
-    # АДМИН ОБРАБОТЧИКИ
-    elif data == "admin_menu":
+async def main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Возврат в главное меню (для админа - в админ-панель)"""
+    query = update.callback_query
+    if query.from_user.id in ADMIN_IDS:
         await query.edit_message_text("👨‍💻 Admin paneli:", reply_markup=get_admin_keyboard())
-    elif data == "admin_stats":
-        await show_admin_stats(query)
-    elif data.startswith("admin_doramas_"):
-        page = int(data.split("_")[2])
-        await show_admin_doramas(query, page)
-    elif data.startswith("admin_delete_"):
-        if data == "admin_delete_0":
-            await show_admin_doramas(query, 0, delete_mode=True)
-        elif data.startswith("admin_delete_confirm_"):
-            dorama_code = data.split("_")[3]
-            await show_delete_confirmation(query, dorama_code)
-        elif data.startswith("admin_delete_"):
-            page = int(data.split("_")[2])
-            await show_admin_doramas(query, page, delete_mode=True)
-    elif data.startswith("admin_confirm_delete_"):
-        dorama_code = data.split("_")[3]
-        await delete_dorama_confirmed(query, dorama_code)
-    elif data.startswith("admin_dorama_info_"):
-        dorama_code = data.split("_")[3]
-        await show_admin_dorama_info(query, dorama_code)
-    elif data == "admin_channels":
-        await show_admin_channels(query)
-    elif data.startswith("admin_requests_"):
-        page = int(data.split("_")[2])
-        await show_admin_requests(query, page)
-    elif data == "admin_settings":
-        await show_admin_settings(query)
-    elif data == "admin_broadcast":
-        await admin_broadcast_callback(update, context)
-    elif data == "admin_set_welcome":
-        await admin_set_welcome_callback(update, context)
-    elif data == "admin_set_help":
-        await admin_set_help_callback(update, context)
-    elif data == "admin_set_archive":
-        await admin_set_archive_callback(update, context)
-    
-    elif data == "current_page":
-        await query.answer()
+    else:
+        await query.edit_message_text("Bosh menyu:", reply_markup=get_main_menu_keyboard())
+
+async def search_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Подсказка для поиска"""
+    await update.callback_query.edit_message_text(
+        "🔍 Dorama nomi yoki kodini kiriting:\n\n"
+        "Misol: <code>Yulduzlar</code> yoki <code>YL2024</code>",
+        parse_mode="HTML"
+    )
+
+async def admin_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Админ-панель"""
+    await update.callback_query.edit_message_text("👨‍💻 Admin paneli:", reply_markup=get_admin_keyboard())
+
+async def current_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Кнопка с номером страницы ничего не делает (ответ на callback уже отправлен)"""
+
+# Таблица маршрутов: имя, обработчик (update, context, *аргументы), декодеры аргументов v1,
+# тег и кодеки v2 (дорамы - по doramas.id, обработчик получает int вместо кода)
+callbacks.add("main_menu", main_menu_callback)
+callbacks.add("search", search_callback)
+callbacks.add("all_doramas", show_all_doramas, int, optional, optional,
+              tag="c", compact=(BASE36_INT, DORAMA_ANCHOR, DORAMA_ANCHOR))
+callbacks.add("recent_doramas", show_recent_doramas)
+callbacks.add("popular_doramas", show_popular_doramas)
+callbacks.add("random_dorama", send_random_dorama)
+callbacks.add("help", show_help)
+callbacks.add("dorama", show_dorama_info, str, tag="d", compact=(DORAMA_ID,))
+callbacks.add("send_all", send_all_episodes, str, tag="s", compact=(DORAMA_ID,))
+callbacks.add("watch", send_single_episode, str, int, tag="w", compact=(DORAMA_ID, BASE36_INT))
+callbacks.add("all_episodes", show_all_episodes, str, tag="a", compact=(DORAMA_ID,))
+callbacks.add("episodes", show_all_episodes, str, int, tag="e", compact=(DORAMA_ID, BASE36_INT))
+callbacks.add("check_subscription", check_subscription_callback, check_subscription=False)
+callbacks.add("current_page", current_page_callback)
+
+callbacks.add("admin_menu", admin_menu_callback, admin=True)
+callbacks.add("admin_stats", lambda update, context: show_admin_stats(update.callback_query), admin=True)
+callbacks.add("admin_doramas", lambda update, context, page, after, before: show_admin_doramas(
+    update.callback_query, page, after=after, before=before), int, optional, optional, admin=True,
+    tag="ad", compact=(BASE36_INT, DORAMA_ANCHOR, DORAMA_ANCHOR))
+callbacks.add("admin_delete", lambda update, context, page, after, before: show_admin_doramas(
+    update.callback_query, page, delete_mode=True, after=after, before=before), int, optional, optional, admin=True,
+    tag="ax", compact=(BASE36_INT, DORAMA_ANCHOR, DORAMA_ANCHOR))
+callbacks.add("admin_delete_confirm", lambda update, context, code: show_delete_confirmation(
+    update.callback_query, code), str, admin=True, tag="ac", compact=(DORAMA_ID,))
+callbacks.add("admin_confirm_delete", lambda update, context, code: delete_dorama_confirmed(
+    update.callback_query, code), str, admin=True, tag="ay", compact=(DORAMA_ID,))
+callbacks.add("admin_dorama_info", lambda update, context, code: show_admin_dorama_info(
+    update.callback_query, code), str, admin=True, tag="ai", compact=(DORAMA_ID,))
+callbacks.add("admin_channels", lambda update, context: show_admin_channels(update.callback_query), admin=True)
+callbacks.add("admin_requests", lambda update, context, page: show_admin_requests(
+    update.callback_query, page), int, admin=True, tag="ar", compact=(BASE36_INT,))
+callbacks.add("admin_settings", lambda update, context: show_admin_settings(update.callback_query), admin=True)
+callbacks.add("admin_broadcast", admin_broadcast_callback, admin=True)
+callbacks.add("admin_set_welcome", admin_set_welcome_callback, admin=True)
+callbacks.add("admin_set_help", admin_set_help_callback, admin=True)
+callbacks.add("admin_set_archive", admin_set_archive_callback, admin=True)
+
+# Кнопки старого формата "<префикс>_<аргументы>", уже отправленные пользователям
+callbacks.add_legacy("all_doramas_", "all_doramas", parse_legacy_catalog_page)
+callbacks.add_legacy("recent_doramas_", "recent_doramas")
+callbacks.add_legacy("popular_doramas_", "popular_doramas")
+callbacks.add_legacy("dorama_", "dorama", lambda rest: [rest])
+callbacks.add_legacy("send_all_", "send_all", lambda rest: [rest])
+callbacks.add_legacy("watch_", "watch", parse_legacy_code_and_number)
+callbacks.add_legacy("all_episodes_", "all_episodes", lambda rest: [rest])
+callbacks.add_legacy("episodes_", "episodes", parse_legacy_code_and_number)
+callbacks.add_legacy("admin_doramas_", "admin_doramas", parse_legacy_catalog_page)
+callbacks.add_legacy("admin_delete_confirm_", "admin_delete_confirm", lambda rest: [rest])
+callbacks.add_legacy("admin_delete_", "admin_delete", parse_legacy_catalog_page)
+callbacks.add_legacy("admin_confirm_delete_", "admin_confirm_delete", lambda rest: [rest])
+callbacks.add_legacy("admin_dorama_info_", "admin_dorama_info", lambda rest: [rest])
+callbacks.add_legacy("admin_requests_", "admin_requests", lambda rest: [rest])
+
+# ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА ОБНОВЛЕНИЙ
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    """Обрабатывает обновления разных пользователей параллельно, одного - строго по порядку
+
+    Для каждого ключа (пользователь, иначе чат) держится цепочка: обновление ждет, пока
+    завершится предыдущее обновление того же ключа, и только потом занимает один из
+    UPDATE_WORKERS слотов. Поэтому ожидающие своей очереди не отнимают слоты у других
+    пользователей, а context.user_data и сценарии настроек не видят гонок.
+
+    Семафор базового класса (UPDATE_BACKLOG) ограничивает общее число обновлений в работе
+    и в ожидании; пока он не исчерпан, задачи регистрируются в порядке поступления.
+    """
+
+    def __init__(self, workers=UPDATE_WORKERS, backlog=UPDATE_BACKLOG):
+        super().__init__(max(backlog, workers))
+        self.workers = max(1, workers)
+        self._slots = asyncio.Semaphore(self.workers)
+        self._tails = {}  # ключ -> событие завершения последнего обновления этого ключа
+        self._pending = 0
+
+        # Метрики
+        self.processed = 0
+        self.serialized = 0
+        self.busy = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @staticmethod
+    def update_key(update):
+        """Ключ упорядочивания: пользователь, иначе чат; None - порядок не важен"""
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self.update_key(update)
+        previous = self._tails.get(key) if key is not None else None
+        done = asyncio.Event()
+        if key is not None:
+            self._tails[key] = done
+        self._pending += 1
+        try:
+            if previous is not None:
+                self.serialized += 1
+                await previous.wait()
+            async with self._slots:
+                self.busy += 1
+                try:
+                    await coroutine
+                finally:
+                    self.busy -= 1
+        finally:
+            self._pending -= 1
+            self.processed += 1
+            done.set()
+            if key is not None and self._tails.get(key) is done:
+                del self._tails[key]
+
+    def pending(self):
+        """Обновления в работе и в ожидании"""
+        return self._pending
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'busy': self.busy,
+            'pending': self._pending,
+            'keys': len(self._tails),
+            'processed': self.processed,
+            'serialized': self.serialized,
+        }
+
+update_processor = KeyedUpdateProcessor()
+register_metrics('updates', update_processor.stats)
+
+# ВЕБХУК
+class WebhookServer:
+    """Минимальный HTTP/1.1 сервер на asyncio, принимающий обновления Telegram
+
+    Запрос проверяется по X-Telegram-Bot-Api-Secret-Token, обновление кладется в
+    ограниченную очередь приложения без ожидания обработки, и сразу уходит ответ 200.
+    Если очередь заполнена, отвечаем 503 - Telegram повторит доставку позже.
+    """
+
+    MAX_BODY = 1024 * 1024
+    MAX_HEADERS = 64
+    IDLE_TIMEOUT = 75  # keep-alive: Telegram переиспользует соединения
+
+    REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+               405: 'Method Not Allowed', 413: 'Payload Too Large', 503: 'Service Unavailable'}
+
+    def __init__(self, update_queue, bot, path=WEBHOOK_PATH, secret=None, backlog=None):
+        self.update_queue = update_queue
+        self.bot = bot
+        self.path = path
+        self.secret = secret
+        # Очередь приложения сразу разбирается в задачи, поэтому перегрузку видно по обработчику
+        self.backlog = backlog
+        self._server = None
+
+        # Метрики
+        self.accepted = 0
+        self.rejected_full = 0
+        self.rejected_secret = 0
+        self.bad_requests = 0
+        self.connections = 0
+
+    async def start(self, host=WEBHOOK_LISTEN, port=WEBHOOK_PORT):
+        self._server = await asyncio.start_server(self._serve, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(self, reader, writer):
+        self.connections += 1
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    request = await asyncio.wait_for(self._read_request(reader), self.IDLE_TIMEOUT)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                if request is None:
+                    break
+                status, keep_alive = await self._dispatch(*request)
+                writer.write(
+                    f"HTTP/1.1 {status} {self.REASONS[status]}\r\n"
+                    f"Content-Length: 0\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode()
+                )
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def _read_request(self, reader):
+        """Читает один запрос; возвращает (метод, путь, заголовки, тело) или None при закрытии"""
+        line = await reader.readline()
+        if not line:
+            return None
+        parts = line.decode('latin-1').split()
+        if len(parts) != 3:
+            return 'BAD', '', {}, b''
+        method, path, _ = parts
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            if len(headers) >= self.MAX_HEADERS:
+                return 'BAD', path, headers, b''
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        length = headers.get('content-length', '0')
+        if not length.isdigit() or int(length) > self.MAX_BODY:
+            return 'TOO_LARGE', path, headers, b''
+        body = await reader.readexactly(int(length)) if int(length) else b''
+        return method, path, headers, body
+
+    async def _dispatch(self, method, path, headers, body):
+        """Обрабатывает запрос; возвращает (HTTP статус, оставить ли соединение)"""
+        keep_alive = headers.get('connection', '').lower() != 'close'
+        if method == 'BAD':
+            self.bad_requests += 1
+            return 400, False
+        if method == 'TOO_LARGE':
+            self.bad_requests += 1
+            return 413, False
+        if path.split('?', 1)[0] != self.path:
+            return 404, keep_alive
+        if method != 'POST':
+            return 405, keep_alive
+        if self.secret and headers.get('x-telegram-bot-api-secret-token') != self.secret:
+            self.rejected_secret += 1
+            return 403, keep_alive
+
+        try:
+            update = Update.de_json(json.loads(body), self.bot)
+        except Exception:
+            self.bad_requests += 1
+            return 400, keep_alive
+        try:
+            if self.backlog and self.backlog() >= self.update_queue.maxsize > 0:
+                raise asyncio.QueueFull
+            self.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.rejected_full += 1
+            return 503, keep_alive
+        self.accepted += 1
+        return 200, keep_alive
+
+    def stats(self):
+        return {
+            'queued': self.update_queue.qsize(),
+            'queue_size': self.update_queue.maxsize,
+            'connections': self.connections,
+            'accepted': self.accepted,
+            'rejected_full': self.rejected_full,
+            'rejected_secret': self.rejected_secret,
+            'bad_requests': self.bad_requests,
+        }
+
+def webhook_secret():
+    """Секрет вебхука: из окружения или детерминированно из токена, чтобы совпадал на всех репликах"""
+    if WEBHOOK_SECRET:
+        return WEBHOOK_SECRET
+    return hashlib.sha256(f"webhook:{BOT_TOKEN}".encode()).hexdigest()
+
+async def run_webhook(application: Application):
+    """Запускает бота в режиме вебхука (вместо run_polling)"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    secret = webhook_secret()
+    server = WebhookServer(application.update_queue, application.bot, WEBHOOK_PATH, secret,
+                           backlog=update_processor.pending)
+    register_metrics('webhook', server.stats)
+
+    await application.initialize()
+    try:
+        # post_init/post_shutdown вызывает только run_polling/run_webhook - здесь вызываем сами
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        port = await server.start(WEBHOOK_LISTEN, WEBHOOK_PORT)
+        # Повторный setWebhook с других реплик безопасен; необработанные обновления не сбрасываем
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=secret,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=WEBHOOK_MAX_CONNECTIONS
+        )
+        logger.info(f"🌐 Webhook tinglanmoqda: {WEBHOOK_LISTEN}:{port}{WEBHOOK_PATH}")
+        await stop_event.wait()
+    finally:
+        await server.stop()
+        if application.running:
+            await application.stop()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await application.shutdown()
+
+async def on_startup(application: Application):
+    """Запускает фоновые задачи после инициализации бота"""
+    db.start_flusher()
+    await delivery.start(application.bot)
+    await broadcasts.start(application.bot)
+
+async def on_shutdown(application: Application):
+    """Завершает работу с базой при остановке бота"""
+    await delivery.stop()
+    await broadcasts.stop()
+    await db.close()
+    logger.info("📴 Ma'lumotlar bazasi yopildi")
 
 def main():
     """Главная функция"""
@@ -2020,7 +4887,18 @@ def main():
         logger.info("🚀 Starting Korean Doramas Bot...")
         logger.info(f"👑 Admin IDs: {ADMIN_IDS}")
         
-        application = Application.builder().token(BOT_TOKEN).build()
+        builder = (
+            Application.builder()
+            .token(BOT_TOKEN)
+            .rate_limiter(rate_limiter)
+            .concurrent_updates(update_processor)
+            .post_init(on_startup)
+            .post_shutdown(on_shutdown)
+        )
+        if BOT_MODE == 'webhook':
+            # Ограниченная очередь: при перегрузке вебхук отвечает 503, а не копит обновления в памяти
+            builder = builder.update_queue(asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE))
+        application = builder.build()
         
         # Обработчики команд
         application.add_handler(CommandHandler("start", start))
@@ -2028,7 +4906,9 @@ def main():
         application.add_handler(CommandHandler("addchannel", add_channel_command))
         application.add_handler(CommandHandler("addprivatechannel", add_private_channel_command))
         application.add_handler(CommandHandler("deletechannel", delete_channel_command))
+        application.add_handler(CommandHandler("channelpolicy", channel_policy_command))
         application.add_handler(CommandHandler("deletedorama", delete_dorama_command))
+        application.add_handler(CommandHandler("metrics", metrics_command))
         
         # Обработчики для заявок
         application.add_handler(ChatJoinRequestHandler(handle_chat_join_request))
@@ -2054,10 +4934,16 @@ def main():
         logger.info("✅ Bot successfully configured and ready")
         
         # Запуск бота
-        application.run_polling(
-            drop_pending_updates=True,
-            allowed_updates=Update.ALL_TYPES
-        )
+        if BOT_MODE == 'webhook':
+            if not WEBHOOK_URL:
+                logger.error("❌ WEBHOOK_URL not set in environment variables")
+                return
+            asyncio.run(run_webhook(application))
+        else:
+            application.run_polling(
+                drop_pending_updates=True,
+                allowed_updates=Update.ALL_TYPES
+            )
         
     except Exception as e:
         logger.error(f"❌ Xato: {e}")